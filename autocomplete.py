@@ -0,0 +1,97 @@
+import threading
+from bisect import bisect_left, insort
+from heapq import nsmallest
+
+# Most suggestions a single request may ask for
+MAX_SUGGESTIONS = 20
+
+# Prefixes matching more tags than this get a precomputed top list instead of a range scan
+SCAN_LIMIT = 256
+
+# Precomputed lists keep extra entries so a few count decrements don't change the answer
+TOP_SIZE = MAX_SUGGESTIONS * 2
+
+def prefix_end(prefix: str) -> str:
+    """Smallest string greater than every string starting with prefix"""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+class TagAutocomplete:
+    """Prefix lookup over tag names, ranked by post count
+
+    Tag names are kept in a sorted array searched with bisect. Short prefixes
+    that match many tags (like 's') would need a large scan, so their best
+    TOP_SIZE tags are precomputed and then maintained as counts change.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.names = []    # sorted tag names
+        self.counts = {}   # tag_name -> post_count
+        self.id_names = {}  # tag_id -> tag_name
+        self.top = {}      # prefix -> tag names, best first
+
+    def rank(self, name: str):
+        return (-self.counts[name], name)
+
+    def build(self, conn):
+        """(Re)build from the tags table"""
+        rows = conn.execute("SELECT id, tag_name, post_count FROM tags ORDER BY tag_name").fetchall()
+        names = [row[1] for row in rows]
+        with self.lock:
+            self.names = names
+            self.counts = {row[1]: row[2] for row in rows}
+            self.id_names = {row[0]: row[1] for row in rows}
+            self.top = {}
+            # Walk the implicit trie over the sorted names, only descending into big ranges
+            stack = [("", 0, len(names))]
+            while stack:
+                prefix, lo, hi = stack.pop()
+                if hi - lo <= SCAN_LIMIT:
+                    continue
+                if prefix:
+                    self.top[prefix] = nsmallest(TOP_SIZE, names[lo:hi], key=self.rank)
+                depth = len(prefix)
+                i = lo
+                while i < hi:
+                    if len(names[i]) == depth:
+                        i += 1
+                        continue
+                    child = names[i][:depth + 1]
+                    j = bisect_left(names, prefix_end(child), i, hi)
+                    stack.append((child, i, j))
+                    i = j
+
+    def update_tags(self, rows):
+        """Add new tags and take the post counts of known ones from (tag_id, tag_name, post_count) rows"""
+        with self.lock:
+            for tag_id, tag_name, post_count in rows:
+                if tag_name not in self.counts:
+                    insort(self.names, tag_name)
+                    self.id_names[tag_id] = tag_name
+                self.counts[tag_name] = post_count
+                self.reposition(tag_name)
+
+    def reposition(self, name: str):
+        """Re-rank a tag inside every precomputed list for its prefixes"""
+        for depth in range(1, len(name) + 1):
+            best = self.top.get(name[:depth])
+            if best is None:
+                continue
+            if name in best:
+                best.sort(key=self.rank)
+            elif len(best) < TOP_SIZE or self.rank(name) < self.rank(best[-1]):
+                insort(best, name, key=self.rank)
+                del best[TOP_SIZE:]
+
+    def suggest(self, prefix: str, limit: int = 10) -> list:
+        """Tags starting with prefix, most used first"""
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+        with self.lock:
+            best = self.top.get(prefix)
+            if best is None:
+                lo = bisect_left(self.names, prefix)
+                hi = bisect_left(self.names, prefix_end(prefix), lo)
+                best = nsmallest(limit, self.names[lo:hi], key=self.rank)
+            return [{"tag_name": name, "post_count": self.counts[name]} for name in best[:limit]]
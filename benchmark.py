@@ -0,0 +1,362 @@
+"""Concurrent load benchmark for the SheepBooru API.
+
+Drives the ASGI app in-process (through httpx) on a throwaway database filled
+by seed_db.py, and reports requests per second, latency percentiles and
+(where the app exports /metrics) SQL queries per request.
+
+Compare two versions of the code, e.g. before/after a change:
+
+    python benchmark.py HEAD~1 WORKTREE
+
+Each target is a git revision (or WORKTREE for the files on disk). It is
+extracted into a temporary directory and benchmarked in its own subprocess, so
+each run imports that revision's main.py and init_db.py.
+
+Scenarios (--scenario):
+    mixed       --readers logged-in clients replaying TRAFFIC_MIX: post
+                listings, single posts, the tag list, favorite toggles and
+                uploads; reported per operation (default)
+    readwrite   concurrent readers plus one favorite-toggling writer
+    login       concurrent readers while --logins tasks log in back to back;
+                shows login throughput and what password hashing does to
+                everyone else's latency
+
+Regression check against a stored baseline (one target, WORKTREE by default):
+
+    python benchmark.py --save-baseline bench.json    record the current numbers
+    python benchmark.py --baseline bench.json         exit 1 if any got worse
+
+Latencies and queries per request may grow, and throughput may drop, by
+--tolerance (a fraction; at least QUERY_SLACK for query counts) before a
+metric counts as regressed. An N+1 loop multiplies the query count, so it
+fails the check even though timings are noisy.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import struct
+import tempfile
+import time
+import zlib
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Relative frequency of each operation in the mixed scenario
+TRAFFIC_MIX = {
+    "list_posts": 40,
+    "get_post": 30,
+    "list_tags": 10,
+    "toggle_favorite": 15,
+    "create_post": 5,
+}
+
+# The (method, route) each operation is reported under in /metrics
+OPERATION_ROUTES = {
+    "list_posts": ("GET", "/api/posts"),
+    "get_post": ("GET", "/api/posts/{post_id}"),
+    "list_tags": ("GET", "/api/tags"),
+    "toggle_favorite": ("POST", "/api/posts/{post_id}/favorite"),
+    "create_post": ("POST", "/api/posts"),
+}
+
+# Smallest increase in queries per request that a baseline check reports
+QUERY_SLACK = 0.5
+
+# ============== SEEDING ==============
+
+def seed(db_name: str, posts: int, tags: int, rng: random.Random):
+    """Fill an empty database with a skewed dataset scaled to the number of posts"""
+    import seed_db
+    seed_db.seed(
+        db_name, posts=posts, users=max(100, posts // 10), tags=tags,
+        pools=max(10, posts // 200), favorites=posts * 5, rng=rng
+    )
+
+def png_bytes(rng: random.Random, size: int = 16) -> bytes:
+    """A small random RGB PNG, different on every call so uploads aren't deduplicated"""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    rows = b"".join(b"\x00" + rng.randbytes(size * 3) for _ in range(size))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b""))
+
+# ============== LOAD DRIVER ==============
+
+def percentile(values, pct: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+async def drive(app, duration: float, readers: int, posts: int, scenario: str = "readwrite", logins: int = 4) -> dict:
+    """Hammer the app with concurrent readers plus a writer or a stream of logins"""
+    import httpx
+
+    latencies = {"read": [], "write": [], "login": []}
+    errors = 0
+    deadline = time.perf_counter() + duration
+    transport = httpx.ASGITransport(app=app)
+
+    async def timed(kind, request):
+        nonlocal errors
+        start = time.perf_counter()
+        response = await request
+        latencies[kind].append((time.perf_counter() - start) * 1000)
+        if response.status_code >= 400:
+            errors += 1
+
+    async def reader(client, rng):
+        while time.perf_counter() < deadline:
+            await timed("read", client.get(f"/api/posts/{rng.randint(1, posts)}"))
+
+    async def writer(client, rng):
+        await client.post("/api/auth/register", json={"username": "benchwriter", "password": "benchpass"})
+        await client.post("/api/auth/login", json={"username": "benchwriter", "password": "benchpass"})
+        while time.perf_counter() < deadline:
+            await timed("write", client.post(f"/api/posts/{rng.randint(1, posts)}/favorite"))
+
+    async def login_loop(client, i):
+        credentials = {"username": f"benchlogin{i}", "password": "benchpass"}
+        await client.post("/api/auth/register", json=credentials)
+        while time.perf_counter() < deadline:
+            await timed("login", client.post("/api/auth/login", json=credentials))
+
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as read_client, \
+                   httpx.AsyncClient(transport=transport, base_url="http://bench") as write_client:
+            if scenario == "login":
+                background = [login_loop(write_client, i) for i in range(logins)]
+            else:
+                background = [writer(write_client, random.Random(0))]
+            start = time.perf_counter()
+            await asyncio.gather(
+                *background,
+                *(reader(read_client, random.Random(i + 1)) for i in range(readers))
+            )
+            elapsed = time.perf_counter() - start
+
+    total = sum(len(values) for values in latencies.values())
+    result = {
+        "requests": total,
+        "rps": total / elapsed,
+        "read_p50_ms": percentile(latencies["read"], 50),
+        "read_p99_ms": percentile(latencies["read"], 99),
+    }
+    if scenario == "login":
+        result["logins_per_s"] = len(latencies["login"]) / elapsed
+        result["login_p99_ms"] = percentile(latencies["login"], 99)
+    else:
+        result["writes"] = len(latencies["write"])
+        result["write_p99_ms"] = percentile(latencies["write"], 99)
+    result["errors"] = errors
+    return result
+
+def query_counts(metrics_text: str) -> dict:
+    """(method, route) -> [total queries, requests] from the queries-per-request histogram in /metrics"""
+    counts = {}
+    for line in metrics_text.splitlines():
+        for suffix, index in (("_sum", 0), ("_count", 1)):
+            prefix = f"sheepbooru_http_request_queries{suffix}{{"
+            if line.startswith(prefix):
+                labels, value = line[len(prefix):].rsplit("} ", 1)
+                fields = dict(pair.split("=", 1) for pair in labels.split(","))
+                key = (fields["method"].strip('"'), fields["route"].strip('"'))
+                counts.setdefault(key, [0.0, 0])[index] = float(value)
+    return counts
+
+async def drive_mixed(app, duration: float, clients: int, posts: int) -> dict:
+    """Run logged-in clients that each pick operations at random according to TRAFFIC_MIX"""
+    import httpx
+
+    latencies = {operation: [] for operation in TRAFFIC_MIX}
+    errors = 0
+    transport = httpx.ASGITransport(app=app)
+    operations = list(TRAFFIC_MIX)
+    weights = list(TRAFFIC_MIX.values())
+
+    async def run_client(client, rng, tag_names, deadline):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            operation = rng.choices(operations, weights)[0]
+            post_id = rng.randint(1, posts)
+            if operation == "list_posts":
+                params = rng.choice([{}, {}, {"tag": rng.choice(tag_names)}, {"order": "popular"}])
+                request = client.get("/api/posts", params=params)
+            elif operation == "get_post":
+                request = client.get(f"/api/posts/{post_id}")
+            elif operation == "list_tags":
+                request = client.get("/api/tags")
+            elif operation == "toggle_favorite":
+                request = client.post(f"/api/posts/{post_id}/favorite")
+            else:
+                request = client.post(
+                    "/api/posts",
+                    files={"image": ("bench.png", png_bytes(rng), "image/png")},
+                    data={"tags": f"bench {rng.choice(tag_names)}", "description": "benchmark upload"},
+                )
+            start = time.perf_counter()
+            response = await request
+            latencies[operation].append((time.perf_counter() - start) * 1000)
+            if response.status_code >= 400:
+                errors += 1
+
+    async with app.router.lifespan_context(app):
+        http_clients = [httpx.AsyncClient(transport=transport, base_url="http://bench") for _ in range(clients)]
+        try:
+            for i, client in enumerate(http_clients):
+                credentials = {"username": f"benchclient{i}", "password": "benchpass"}
+                await client.post("/api/auth/register", json=credentials)
+                await client.post("/api/auth/login", json=credentials)
+            # Popular tags are listed first, so sampling the list's head favours them like real traffic
+            tag_names = [tag["tag_name"] for tag in (await http_clients[0].get("/api/tags")).json()[:200]]
+            metrics_before = await http_clients[0].get("/metrics")
+
+            start = time.perf_counter()
+            deadline = start + duration
+            await asyncio.gather(*(run_client(client, random.Random(i + 1), tag_names, deadline)
+                                   for i, client in enumerate(http_clients)))
+            elapsed = time.perf_counter() - start
+
+            metrics_after = await http_clients[0].get("/metrics")
+        finally:
+            for client in http_clients:
+                await client.aclose()
+
+    total = sum(len(values) for values in latencies.values())
+    result = {"requests": total, "rps": total / elapsed, "errors": errors}
+    for operation, values in latencies.items():
+        result[f"{operation}_rps"] = len(values) / elapsed
+        result[f"{operation}_p50_ms"] = percentile(values, 50)
+        result[f"{operation}_p99_ms"] = percentile(values, 99)
+
+    # Apps from before /metrics existed just don't get a queries column
+    if metrics_before.status_code == 200 and metrics_after.status_code == 200:
+        before, after = query_counts(metrics_before.text), query_counts(metrics_after.text)
+        for operation, route in OPERATION_ROUTES.items():
+            queries, requests = after.get(route, [0.0, 0])
+            old_queries, old_requests = before.get(route, [0.0, 0])
+            if requests > old_requests:
+                result[f"{operation}_queries"] = (queries - old_queries) / (requests - old_requests)
+    return result
+
+def run_here(args) -> dict:
+    """Benchmark the main.py in the current directory against a fresh seeded database"""
+    sys.path.insert(0, os.getcwd())
+    import init_db
+    init_db.init_db()
+    seed(init_db.DB_NAME, args.posts, args.tags, random.Random(42))
+    import main
+    if args.scenario == "mixed":
+        return asyncio.run(drive_mixed(main.app, args.duration, args.readers, args.posts))
+    return asyncio.run(drive(main.app, args.duration, args.readers, args.posts, args.scenario, args.logins))
+
+# ============== REVISION COMPARISON ==============
+
+def extract(target: str, dest: str):
+    """Copy the Python sources of a git revision (or the working tree) into dest"""
+    if target == "WORKTREE":
+        for name in os.listdir(REPO_DIR):
+            if name.endswith(".py"):
+                shutil.copy(os.path.join(REPO_DIR, name), dest)
+    else:
+        archive = subprocess.run(["git", "archive", target, "--", "*.py"], cwd=REPO_DIR, check=True, capture_output=True).stdout
+        subprocess.run(["tar", "-x", "-C", dest], input=archive, check=True)
+    # Older revisions get today's harness and seeder too
+    for name in ("benchmark.py", "seed_db.py"):
+        shutil.copy(os.path.join(REPO_DIR, name), os.path.join(dest, name))
+    os.makedirs(os.path.join(dest, "uploads"), exist_ok=True)
+
+def run_target(target: str, args) -> dict:
+    with tempfile.TemporaryDirectory(prefix="sheepbench_") as workdir:
+        extract(target, workdir)
+        cmd = [sys.executable, "benchmark.py", "--run",
+               "--duration", str(args.duration), "--readers", str(args.readers),
+               "--posts", str(args.posts), "--tags", str(args.tags),
+               "--scenario", args.scenario, "--logins", str(args.logins)]
+        out = subprocess.run(cmd, cwd=workdir, check=True, capture_output=True, text=True).stdout
+        return json.loads(out.strip().splitlines()[-1])
+
+# ============== BASELINES ==============
+
+def regressions(result: dict, baseline: dict, tolerance: float) -> list:
+    """Metrics in result that are worse than in baseline by more than the allowed slack"""
+    worse = []
+    for key, old in baseline.items():
+        new = result.get(key)
+        if new is None:
+            continue
+        if key.endswith("_ms"):
+            failed = new > old * (1 + tolerance)
+        elif key.endswith("rps") or key.endswith("_per_s"):
+            failed = new < old * (1 - tolerance)
+        elif key.endswith("_queries"):
+            failed = new > max(old * (1 + tolerance), old + QUERY_SLACK)
+        elif key == "errors":
+            failed = new > old
+        else:
+            continue
+        if failed:
+            worse.append(f"{key}: {old:.2f} -> {new:.2f}")
+    return worse
+
+def print_results(results: dict):
+    """One row per metric, one column per target"""
+    rows = list(dict.fromkeys(key for result in results.values() for key in result))
+    print(f"{'metric':<24}" + "".join(f"{target:>14}" for target in results))
+    for row in rows:
+        cells = [result.get(row) for result in results.values()]
+        print(f"{row:<24}" + "".join(f"{'-':>14}" if cell is None else f"{cell:>14.2f}" for cell in cells))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("targets", nargs="*", help="git revisions to compare (WORKTREE = files on disk; default HEAD WORKTREE)")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load per target")
+    parser.add_argument("--readers", type=int, default=32, help="concurrent reader tasks (clients in the mixed scenario)")
+    parser.add_argument("--posts", type=int, default=5000, help="posts to seed")
+    parser.add_argument("--tags", type=int, default=500, help="tags to seed")
+    parser.add_argument("--scenario", choices=["mixed", "readwrite", "login"], default="mixed", help="traffic mix")
+    parser.add_argument("--logins", type=int, default=4, help="concurrent login tasks (login scenario)")
+    parser.add_argument("--baseline", help="fail if results are worse than this saved baseline")
+    parser.add_argument("--save-baseline", help="save the results as a baseline to this file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed latency/throughput regression (fraction)")
+    parser.add_argument("--run", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_here(args)))
+        return
+
+    checking = args.baseline or args.save_baseline
+    targets = args.targets or (["WORKTREE"] if checking else ["HEAD", "WORKTREE"])
+    if checking and len(targets) != 1:
+        parser.error("--baseline and --save-baseline take a single target")
+
+    # The settings that shape the numbers; a baseline only compares fairly against the same ones
+    settings = {name: getattr(args, name) for name in ("scenario", "duration", "readers", "posts", "tags", "logins")}
+    results = {target: run_target(target, args) for target in targets}
+    print_results(results)
+    result = results[targets[0]]
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({"settings": settings, "result": result}, f, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["settings"] != settings:
+            print(f"warning: baseline was recorded with {baseline['settings']}", file=sys.stderr)
+        worse = regressions(result, baseline["result"], args.tolerance)
+        if worse:
+            print("Regressed against baseline:\n  " + "\n  ".join(worse))
+            sys.exit(1)
+        print("No regressions against baseline")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Bulk-import images and their tags into SheepBooru.
+
+    python bulk_import.py --user USERNAME manifest.jsonl
+    python bulk_import.py --user USERNAME some/directory
+
+A manifest has one JSON object per line; paths are relative to the manifest:
+
+    {"image": "art/bweh.png", "tags": "sheep, wool", "description": "optional"}
+
+("tags" may also be a list.) A directory is scanned for image files, and each
+image's comma-separated tags are read from a sidecar text file next to it
+(bweh.png.txt or bweh.txt).
+
+Records are written in large batches, one transaction per batch. A running
+server picks the new posts up in its in-memory tag indexes within a few seconds
+(rebuilding them if the import outpaces it; see index_sync.py). Afterwards run
+`python derivatives.py backfill` for thumbnails and `python phash.py backfill`
+for duplicate detection.
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+
+from db import ConnectionPool
+from init_db import DB_NAME, UPLOAD_DIR, migrate
+from related_tags import count_tag_pairs
+from storage import hash_file, add_blob_ref, blob_path, clean_extension, link_or_copy
+from tagging import split_tags, resolve_tags
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".webp", ".avif", ".bmp"}
+
+# Records per transaction
+BATCH_SIZE = 1000
+
+def read_manifest(path: str):
+    """Yield import records from a JSON Lines manifest"""
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            tags = entry.get("tags", "")
+            yield {
+                "image": os.path.join(base, entry["image"]),
+                "tags": split_tags(tags if isinstance(tags, str) else ",".join(tags)),
+                "description": entry.get("description"),
+            }
+
+def read_directory(path: str):
+    """Yield import records for every image in a directory tree, with tags from sidecar .txt files"""
+    for root, _, files in os.walk(path):
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() not in IMAGE_EXTENSIONS:
+                continue
+            image = os.path.join(root, name)
+            tags = ""
+            for sidecar in (f"{image}.txt", f"{os.path.splitext(image)[0]}.txt"):
+                if os.path.exists(sidecar):
+                    with open(sidecar, encoding="utf-8") as f:
+                        tags = f.read()
+                    break
+            yield {"image": image, "tags": split_tags(tags), "description": None}
+
+def import_batch(conn, records: list, uploader_id: int) -> int:
+    """Insert one batch of records in a single transaction; returns the number imported"""
+    cursor = conn.cursor()
+    tag_ids = resolve_tags(cursor, [name for record in records for name in record["tags"]])
+    post_tags = []
+    record_tag_ids = []
+    for record in records:
+        digest = hash_file(record["image"])
+        path = add_blob_ref(cursor, digest, blob_path(digest, clean_extension(record["image"])), os.path.getsize(record["image"]))
+        # Blobs are links to the source files, so placing them before commit is harmless on rollback
+        link_or_copy(record["image"], os.path.join(UPLOAD_DIR, path))
+        cursor.execute(
+            "INSERT INTO posts (image_filename, file_hash, uploader_id, upload_date, description, favorite_count) VALUES (?, ?, ?, ?, ?, 0)",
+            (path, digest, uploader_id, datetime.datetime.now().isoformat(), record["description"])
+        )
+        post_tags.extend((cursor.lastrowid, tag_ids[name]) for name in record["tags"])
+        record_tag_ids.append([tag_ids[name] for name in record["tags"]])
+    cursor.executemany("INSERT OR IGNORE INTO post_tags (post_id, tag_id) VALUES (?, ?)", post_tags)
+    count_tag_pairs(cursor, record_tag_ids)
+    conn.commit()
+    return len(records)
+
+def bulk_import(records, username: str) -> int:
+    """Import records in BATCH_SIZE transactions as the given user"""
+    migrate(DB_NAME)
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    conn = ConnectionPool(DB_NAME).connect()
+    user = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
+    if not user:
+        conn.close()
+        sys.exit(f"No such user: {username}")
+
+    imported = 0
+    batch = []
+    for record in records:
+        if not os.path.isfile(record["image"]):
+            print(f"Skipping missing file {record['image']}", file=sys.stderr)
+            continue
+        batch.append(record)
+        if len(batch) >= BATCH_SIZE:
+            imported += import_batch(conn, batch, user["id"])
+            batch = []
+            print(f"Imported {imported} posts")
+    if batch:
+        imported += import_batch(conn, batch, user["id"])
+    conn.close()
+    return imported
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="JSON Lines manifest or a directory of images")
+    parser.add_argument("--user", required=True, help="username to upload as")
+    args = parser.parse_args()
+
+    records = read_directory(args.source) if os.path.isdir(args.source) else read_manifest(args.source)
+    print(f"Done: {bulk_import(records, args.user)} posts imported")
+
+if __name__ == "__main__":
+    main()
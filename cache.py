@@ -0,0 +1,124 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi import Request, Response
+from fastapi.staticfiles import StaticFiles
+
+from responses import MIN_COMPRESS_BYTES, accepted_encoding, compress, weak_etag
+
+# Entries kept per cache before the least recently used are dropped
+MAX_ENTRIES = 10000
+
+# Seconds an entry may be served; invalidate() only reaches this process, so this bounds how long
+# other workers keep serving a response after a write
+MAX_AGE = 10
+
+class CachedBody:
+    """A serialized JSON response body, its strong ETag and when it was built"""
+
+    def __init__(self, body: bytes, last_modified: float = None):
+        self.body = body
+        self.etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        self.last_modified = last_modified
+        self.encoded = {}
+
+    def compressed(self, encoding: str) -> bytes:
+        """The body in a content coding, compressed once and kept with the entry"""
+        body = self.encoded.get(encoding)
+        if body is None:
+            body = self.encoded[encoding] = compress(self.body, encoding)
+        return body
+
+class ResponseCache:
+    """In-process LRU cache of serialized responses, invalidated when the data behind them changes
+
+    Writes in other worker processes can't invalidate it, so entries also
+    expire max_age seconds after they were built.
+    """
+
+    def __init__(self, max_entries: int = MAX_ENTRIES, max_age: float = MAX_AGE):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.generation = 0
+
+    def get(self, key):
+        """Return the cached body for key, or None if it is missing or expired"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry.last_modified >= self.max_age:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, body: bytes, generation: int) -> CachedBody:
+        """Store a body built from data read at `generation`; stale builds are returned but not kept"""
+        entry = CachedBody(body, last_modified=time.time())
+        with self.lock:
+            if generation == self.generation:
+                self.entries[key] = entry
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, keys=None):
+        """Drop the given keys, or everything if keys is None; call after committing a write"""
+        with self.lock:
+            self.generation += 1
+            if keys is None:
+                self.entries.clear()
+                return
+            for key in keys:
+                self.entries.pop(key, None)
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Whether the request's If-None-Match header already names this ETag"""
+    header = request.headers.get("if-none-match", "")
+    return header.strip() == "*" or etag in [tag.strip().removeprefix("W/") for tag in header.split(",")]
+
+def not_modified(request: Request, entry: CachedBody) -> bool:
+    """Whether the client's copy is current; If-None-Match takes precedence over If-Modified-Since"""
+    if "if-none-match" in request.headers:
+        return etag_matches(request, entry.etag)
+    since = request.headers.get("if-modified-since")
+    if since and entry.last_modified is not None:
+        try:
+            return int(entry.last_modified) <= parsedate_to_datetime(since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def cached_json_response(request: Request, entry: CachedBody) -> Response:
+    """200 with the cached body (compressed if the client accepts it), or an empty 304 if the client's copy is current"""
+    headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+    if entry.last_modified is not None:
+        headers["Last-Modified"] = formatdate(entry.last_modified, usegmt=True)
+    encoding = None
+    if len(entry.body) >= MIN_COMPRESS_BYTES:
+        headers["Vary"] = "Accept-Encoding"
+        encoding = accepted_encoding(request.headers.get("accept-encoding", ""))
+    if encoding:
+        # Same weak ETag CompressionMiddleware would give it; etag_matches ignores the W/
+        headers["ETag"] = weak_etag(entry.etag)
+    if not_modified(request, entry):
+        return Response(status_code=304, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+        return Response(content=entry.compressed(encoding), media_type="application/json", headers=headers)
+    return Response(content=entry.body, media_type="application/json", headers=headers)
+
+class ImmutableStaticFiles(StaticFiles):
+    """StaticFiles for content-addressed files, which are never rewritten in place"""
+
+    def file_response(self, *args, **kwargs) -> Response:
+        response = super().file_response(*args, **kwargs)
+        if response.status_code in (200, 304):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
@@ -0,0 +1,121 @@
+import contextvars
+import queue
+import sqlite3
+
+from metrics import InstrumentedConnection
+
+# Per-connection tuning applied to every pooled connection
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA cache_size = -16000",
+)
+
+# Number of compiled statements sqlite3 keeps per connection
+STATEMENT_CACHE_SIZE = 256
+
+# Connections acquired while handling the current request (None outside requests); see ConnectionScope
+checked_out = contextvars.ContextVar("checked_out", default=None)
+
+class PooledConnection:
+    """Wrapper around a pooled sqlite3 connection; close() hands it back to the pool"""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.release(self._conn)
+            self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self._conn.commit()
+        self.close()
+
+    def __del__(self):
+        # Last resort for connections acquired outside a request (requests have ConnectionScope)
+        self.close()
+
+class ConnectionPool:
+    """Keeps configured sqlite3 connections around for reuse across requests and threads"""
+
+    def __init__(self, path: str, max_idle: int = 16):
+        self.path = path
+        self.idle = queue.LifoQueue(maxsize=max_idle)
+
+    def connect(self) -> sqlite3.Connection:
+        """Open a new connection with WAL mode and the pool's pragmas; its queries feed the metrics"""
+        conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            factory=InstrumentedConnection,
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self) -> PooledConnection:
+        """Take an idle connection, or open a new one if none is free"""
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = self.connect()
+        pooled = PooledConnection(self, conn)
+        request_connections = checked_out.get()
+        if request_connections is not None:
+            request_connections.append(pooled)
+        return pooled
+
+    def release(self, conn: sqlite3.Connection):
+        """Return a connection to the pool, discarding uncommitted work"""
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close_all(self):
+        """Close every idle connection"""
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+class ConnectionScope:
+    """ASGI middleware that returns every connection a request acquired to the pool once it is handled
+
+    Handlers close their connections themselves; this covers the ones that
+    raised first, rolling back whatever transaction they left open.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        connections = []
+        token = checked_out.set(connections)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            checked_out.reset(token)
+            for conn in connections:
+                conn.close()
@@ -0,0 +1,212 @@
+"""Thumbnail and sample image generation.
+
+Derivatives are written next to their original blob, e.g. for
+ab/cd/<hash>.png: ab/cd/<hash>.thumbnail.webp and ab/cd/<hash>.sample.webp.
+Animated GIFs get stills of their first frame.
+
+Backfill derivatives for existing uploads with:
+
+    python derivatives.py backfill
+"""
+import logging
+import multiprocessing
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; without it posts just use their originals
+    Image = None
+
+# Longest side, in pixels, of each derivative size
+SIZES = {"thumbnail": 300, "sample": 1200}
+
+# Output format (Pillow format name, file extension); ("AVIF", ".avif") also works on Pillow 11.3+
+OUTPUT_FORMAT = ("WEBP", ".webp")
+OUTPUT_QUALITY = 80
+
+# Worker processes for image work (CPU-bound, so kept off the request threads)
+WORKERS = max(1, (os.cpu_count() or 2) // 2)
+
+# Attempts at recording a finished render (e.g. while the database is locked), and the first retry delay, doubled after each
+RECORD_ATTEMPTS = 5
+RECORD_RETRY_DELAY = 1
+
+logger = logging.getLogger("sheepbooru")
+
+def derivative_path(path: str, size: str) -> str:
+    """Path of a derivative relative to the upload dir"""
+    return f"{os.path.splitext(path)[0]}.{size}{OUTPUT_FORMAT[1]}"
+
+def render(upload_dir: str, path: str) -> bool:
+    """Create every derivative size for one original; runs in a worker process"""
+    if Image is None:
+        return False
+    with Image.open(os.path.join(upload_dir, path)) as im:
+        im.seek(0)
+        has_alpha = im.mode in ("RGBA", "LA", "PA") or "transparency" in im.info
+        frame = im.convert("RGBA" if has_alpha else "RGB")
+    for size, max_side in SIZES.items():
+        resized = frame.copy()
+        resized.thumbnail((max_side, max_side), Image.LANCZOS)
+        target = os.path.join(upload_dir, derivative_path(path, size))
+        temp = f"{target}.tmp"
+        resized.save(temp, OUTPUT_FORMAT[0], quality=OUTPUT_QUALITY)
+        os.replace(temp, target)
+    return True
+
+def remove_derivatives(upload_dir: str, path: str):
+    """Delete every derivative of an original that is being removed"""
+    for size in SIZES:
+        target = os.path.join(upload_dir, derivative_path(path, size))
+        if os.path.exists(target):
+            os.remove(target)
+
+def safe_render(upload_dir: str, path: str) -> bool:
+    """render() that reports unreadable, missing or oversized images as not rendered"""
+    try:
+        return render(upload_dir, path)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return False
+
+class DerivativePipeline:
+    """Process pool for image work: renders derivatives in the background after uploads
+
+    Finished renders are recorded by a thread of the pipeline's own, so a slow
+    or failing database write neither holds up the executor's result handling
+    nor gets lost: it is retried RECORD_ATTEMPTS times. Blobs it gives up on
+    keep has_derivatives = 0 and are picked up by `backfill`.
+    """
+
+    def __init__(self, upload_dir: str, workers: int = WORKERS):
+        self.upload_dir = upload_dir
+        self.workers = workers
+        self.executor = None
+        self.finished = queue.Queue()  # (on_done, digest) of renders to record; None stops the recorder
+        self.recorder = None
+        self.lock = threading.Lock()
+
+    def pool(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            return self.executor
+
+    def replace_broken(self, executor: ProcessPoolExecutor):
+        """Drop an executor whose worker died (BrokenProcessPool) so the next pool() starts a fresh one"""
+        with self.lock:
+            if self.executor is not executor:
+                return  # already replaced, e.g. by another of its failed futures
+            self.executor = None
+        logger.warning("An image worker process died; starting a new pool")
+        executor.shutdown(wait=False)
+
+    def submit_to_pool(self, fn, *args):
+        """pool().submit(), replacing the pool once if it is broken"""
+        executor = self.pool()
+        try:
+            return executor, executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self.replace_broken(executor)
+            executor = self.pool()
+            return executor, executor.submit(fn, *args)
+
+    def record(self):
+        """Recorder thread: call on_done for each finished render, retrying failures with backoff"""
+        while (item := self.finished.get()) is not None:
+            on_done, digest = item
+            for attempt in range(RECORD_ATTEMPTS):
+                try:
+                    on_done(digest)
+                    break
+                except Exception:
+                    if attempt == RECORD_ATTEMPTS - 1:
+                        logger.exception("Giving up on recording derivatives of %s", digest)
+                    else:
+                        logger.warning("Recording derivatives of %s failed; retrying", digest, exc_info=True)
+                        time.sleep(RECORD_RETRY_DELAY * 2 ** attempt)
+
+    def run(self, fn, *args):
+        """Run fn(*args) in a worker process and wait for its result (call from a worker thread)
+
+        If the worker dies, the pool is replaced and BrokenProcessPool is raised.
+        """
+        executor, future = self.submit_to_pool(fn, *args)
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            self.replace_broken(executor)
+            raise
+
+    def submit(self, digest: str, path: str, on_done):
+        """Queue rendering for a blob; on_done(digest) is called on the recorder thread if it succeeds"""
+        if Image is None:
+            return
+        with self.lock:
+            if self.recorder is None:
+                self.recorder = threading.Thread(target=self.record, name="derivative-recorder", daemon=True)
+                self.recorder.start()
+        executor, future = self.submit_to_pool(safe_render, self.upload_dir, path)
+        
+        def finished(f):
+            if f.cancelled():
+                return
+            if isinstance(f.exception(), BrokenProcessPool):
+                self.replace_broken(executor)
+            elif f.exception() is None and f.result():
+                self.finished.put((on_done, digest))
+        future.add_done_callback(finished)
+
+    def shutdown(self):
+        """Wait for queued renders and for their results to be recorded"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        if self.recorder is not None:
+            self.finished.put(None)
+            self.recorder.join()
+            self.recorder = None
+
+# ============== BACKFILL ==============
+
+def backfill(db_name: str, upload_dir: str, batch_size: int = 100):
+    """Render derivatives for every stored blob that does not have them yet"""
+    if Image is None:
+        sys.exit("Pillow is not installed; cannot render derivatives")
+    conn = sqlite3.connect(db_name)
+    pending = conn.execute("SELECT hash, path FROM files WHERE has_derivatives = 0").fetchall()
+    done = failed = 0
+    with ProcessPoolExecutor(max_workers=WORKERS) as executor:
+        results = executor.map(safe_render, [upload_dir] * len(pending), [path for _, path in pending], chunksize=8)
+        ready = []
+        for (digest, path), ok in zip(pending, results):
+            if not ok:
+                failed += 1
+                continue
+            ready.append((digest,))
+            if len(ready) >= batch_size:
+                conn.executemany("UPDATE files SET has_derivatives = 1 WHERE hash = ?", ready)
+                conn.commit()
+                done += len(ready)
+                ready = []
+        conn.executemany("UPDATE files SET has_derivatives = 1 WHERE hash = ?", ready)
+        conn.commit()
+        done += len(ready)
+    conn.close()
+    print(f"Rendered derivatives for {done} files ({failed} failed)")
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["backfill"]:
+        sys.exit(__doc__)
+    from init_db import DB_NAME, UPLOAD_DIR, migrate
+    migrate(DB_NAME)
+    backfill(DB_NAME, UPLOAD_DIR)
@@ -0,0 +1,95 @@
+"""Buffered posts.favorite_count updates.
+
+Toggling a favorite writes the favorites row plus a +1/-1 in
+favorite_count_deltas, in the same transaction, and leaves posts alone;
+flush() applies the pending deltas in batches, so a burst of clicks on a hot
+post becomes one UPDATE of the posts row and its indexes. reconcile()
+recomputes counts from the favorites table to repair any drift:
+
+    python favorites.py reconcile
+
+Pending deltas live in the database rather than in process memory, so they
+survive restarts, and flushes and reconciliations from any process (other
+workers, the CLI) see exactly the deltas of the committed favorites rows.
+"""
+import sys
+
+# How often buffered count deltas are written to posts.favorite_count
+FLUSH_INTERVAL = 2
+
+# How often favorite counts are recomputed from the favorites table
+RECONCILE_INTERVAL = 3600
+
+# Post ids recounted per reconcile transaction, so writers wait for one batch rather than the whole table
+RECONCILE_BATCH_SIZE = 5000
+
+def add_favorite_delta(cursor, post_id: int, delta: int):
+    """Buffer a favorite_count change in the caller's transaction (the one changing the favorites row)"""
+    cursor.execute("""
+        INSERT INTO favorite_count_deltas (post_id, delta) VALUES (?, ?)
+        ON CONFLICT (post_id) DO UPDATE SET delta = delta + excluded.delta
+    """, (post_id, delta))
+
+def current_favorite_count(cursor, post_id: int) -> int:
+    """A post's favorite count including deltas that haven't been flushed yet"""
+    cursor.execute("""
+        SELECT p.favorite_count + COALESCE(d.delta, 0)
+        FROM posts p LEFT JOIN favorite_count_deltas d ON d.post_id = p.id
+        WHERE p.id = ?
+    """, (post_id,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+def flush_favorite_deltas(conn) -> list:
+    """Apply all pending deltas in one transaction; returns the ids of the posts updated"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        deltas = [(row[1], row[0]) for row in conn.execute("DELETE FROM favorite_count_deltas RETURNING post_id, delta").fetchall() if row[1]]
+        conn.executemany("UPDATE posts SET favorite_count = favorite_count + ? WHERE id = ?", deltas)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return [post_id for _, post_id in deltas]
+
+def reconcile_batch(conn, low: int, high: int) -> set:
+    """Recount the posts with ids in [low, high] in one transaction; returns the ids whose count changed"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        pending = conn.execute(
+            "DELETE FROM favorite_count_deltas WHERE post_id BETWEEN ? AND ? RETURNING post_id", (low, high)
+        ).fetchall()
+        repaired = conn.execute("""
+            UPDATE posts SET favorite_count = (SELECT COUNT(*) FROM favorites f WHERE f.post_id = posts.id)
+            WHERE id BETWEEN ? AND ?
+              AND favorite_count != (SELECT COUNT(*) FROM favorites f WHERE f.post_id = posts.id)
+            RETURNING id
+        """, (low, high)).fetchall()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return {row[0] for row in pending} | {row[0] for row in repaired}
+
+def reconcile_favorite_counts(conn) -> list:
+    """Reset every favorite_count that disagrees with the favorites table, dropping the pending deltas it covers
+
+    Runs RECONCILE_BATCH_SIZE posts per transaction; each batch recounts its
+    posts and drops their deltas atomically. Returns the ids of all posts whose
+    count changed.
+    """
+    max_post_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM posts").fetchone()[0]
+    changed = set()
+    for low in range(1, max_post_id + 1, RECONCILE_BATCH_SIZE):
+        changed |= reconcile_batch(conn, low, low + RECONCILE_BATCH_SIZE - 1)
+    return list(changed)
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["reconcile"]:
+        sys.exit("usage: python favorites.py reconcile")
+    from db import ConnectionPool
+    from init_db import DB_NAME, migrate
+    migrate(DB_NAME)
+    conn = ConnectionPool(DB_NAME).connect()
+    print(f"Corrected favorite counts for {len(reconcile_favorite_counts(conn))} posts")
+    conn.close()
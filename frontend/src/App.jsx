@@ -7,6 +7,8 @@ function App() {
   const [currentUser, setCurrentUser] = useState(null);
   const [users, setUsers] = useState([]);
   const [posts, setPosts] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null); // cursor for the next page of posts from the API
+  const postsQuery = useRef(''); // server-side tag query the loaded posts were fetched with
   const [tags, setTags] = useState([]);
   const [selectedTag, setSelectedTag] = useState(null);
   const [tagSearch, setTagSearch] = useState(''); // search input for tags (comma-separated)
@@ -14,6 +16,8 @@ function App() {
   const [poolSearch, setPoolSearch] = useState(''); // search input for adding to pool
   const [pools, setPools] = useState([]);
   const [favorites, setFavorites] = useState([]); // user's favorited posts
+  const [tagSuggestions, setTagSuggestions] = useState([]); // autocomplete for the tag being typed
+  const [relatedTags, setRelatedTags] = useState([]); // tags that co-occur with the last searched tag
 
   // Pagination
   const [postsPage, setPostsPage] = useState(0);
@@ -33,6 +37,7 @@ function App() {
 
   // Detail state
   const [selectedPost, setSelectedPost] = useState(null);
+  const [recommendedPosts, setRecommendedPosts] = useState([]); // favorited by the same users as selectedPost
   const [selectedPool, setSelectedPool] = useState(null);
 
   // Carousel
@@ -46,49 +51,44 @@ function App() {
     loadAll();
   }, [selectedTag]);
 
-  useEffect(() => {
-    // try to restore current user (session cookie)
-    (async () => {
-      try {
-        const me = await api.getMe();
-        setCurrentUser(me.data || null);
-        // Load favorites if user is logged in
-        if (me.data) {
-          const favs = await api.getUserFavorites(me.data.id);
-          setFavorites(favs.data || []);
-        }
-      } catch (e) {
-        // ignore
-      }
-    })();
-  }, []);
-
+  // one request for the session user (from the cookie) and the first page of everything
   const loadAll = async () => {
     try {
-      const [postsRes, tagsRes, usersRes, poolsRes] = await Promise.all([
-        api.getPosts(),
-        api.getTags(),
-        api.getUsers(),
-        api.getPools()
-      ]);
-      setPosts(postsRes.data || []);
-      setTags(tagsRes.data || []);
-      setUsers(usersRes.data || []);
-      setPools(poolsRes.data || []);
+      const { data } = await api.bootstrap();
+      setCurrentUser(data.user || null);
+      if (!postsQuery.current) {
+        // bootstrap's page is unfiltered; keep the results of an active tag search
+        setPosts(data.posts?.posts || []);
+        setNextCursor(data.posts?.next_cursor || null);
+      }
+      setTags(data.tags || []);
+      setUsers(data.users || []);
+      setPools(data.pools || []);
+      setFavorites(data.favorites || []);
     } catch (error) {
       console.error('Error loading data:', error);
     }
   };
 
+  // fetch the next page of posts and append it to the list
+  const loadMorePosts = async () => {
+    if (!nextCursor) return;
+    try {
+      const res = await api.getPosts(null, null, nextCursor, null, postsQuery.current || null);
+      setPosts(prev => [...prev, ...(res.data?.posts || [])]);
+      setNextCursor(res.data?.next_cursor || null);
+    } catch (error) {
+      console.error('Error loading more posts:', error);
+    }
+  };
+
   // AUTH: register, login, logout
   const handleRegister = async (e) => {
     e.preventDefault();
     try {
       await api.register(username, password);
-      // try auto-login
+      // try auto-login; loadAll picks up the new session
       await api.login(username, password);
-      const me = await api.getMe();
-      setCurrentUser(me.data || null);
       setUsername('');
       setPassword('');
       setView('posts');
@@ -102,15 +102,11 @@ function App() {
     e.preventDefault();
     try {
       await api.login(username, password);
-      const me = await api.getMe();
-      setCurrentUser(me.data || null);
       setUsername('');
       setPassword('');
       setView('posts');
-      loadAll();
-      // Load favorites after successful login
-      const favs = await api.getUserFavorites(me.data.id);
-      setFavorites(favs.data || []);
+      // loadAll also brings the user and their favorites
+      await loadAll();
     } catch (error) {
       alert(error.response?.data?.detail || 'Login failed');
     }
@@ -123,6 +119,7 @@ function App() {
       // ignore
     }
     setCurrentUser(null);
+    setFavorites([]);
   };
 
   // UPLOAD
@@ -176,19 +173,13 @@ function App() {
     try {
       const res = await api.getPost(postId);
       const post = res.data;
-      // determine if current user has favorited this post
-      let favorited = false;
-      if (currentUser) {
-        try {
-          const favs = await api.getUserFavorites(currentUser.id);
-          favorited = (favs.data || []).some(f => f.post_id === postId || f.id === postId);
-        } catch (e) {
-          // ignore
-        }
-      }
-      // Store the pools that contain this post from the API response
-      setSelectedPost({ ...post, _favorited: favorited, _containingPools: post.pools || [] });
+      // Store the viewer's favorite status and the pools that contain this post from the API response
+      setSelectedPost({ ...post, _favorited: !!post.is_favorited, _containingPools: post.pools || [] });
+      setRecommendedPosts([]);
       setView('postDetail');
+      api.getRecommendedPosts(postId)
+        .then(rec => setRecommendedPosts(rec.data || []))
+        .catch(() => setRecommendedPosts([]));
     } catch (error) {
       alert('Error loading post');
     }
@@ -201,17 +192,19 @@ function App() {
     }
     try {
       const res = await api.toggleFavorite(postId);
-      // the API could return updated post or status; refresh selected post if open
+      // the response carries the new status and count, so patch local state instead of refetching
+      const { is_favorited, favorite_count } = res.data;
+      const withCount = (post) => (post.id === postId ? { ...post, favorite_count } : post);
       if (selectedPost && selectedPost.id === postId) {
-        // re-fetch full post
-        const updated = await api.getPost(postId);
-        const favs = await api.getUserFavorites(currentUser.id);
-        const fav = (favs.data || []).some(f => f.post_id === postId || f.id === postId);
-        setSelectedPost({ ...updated.data, _favorited: fav });
+        setSelectedPost(prev => ({ ...prev, favorite_count, _favorited: is_favorited }));
       }
-      // refresh posts list counts and favorites
-      loadAll();
-      loadUserFavorites();
+      setPosts(prev => prev.map(withCount));
+      setFavorites(prev => {
+        if (!is_favorited) return prev.filter(post => post.id !== postId);
+        const post = posts.find(p => p.id === postId) || (selectedPost?.id === postId ? selectedPost : null);
+        if (!post || prev.some(p => p.id === postId)) return prev.map(withCount);
+        return [{ ...post, favorite_count }, ...prev];
+      });
       return res.data;
     } catch (error) {
       alert('Error toggling favorite');
@@ -245,6 +238,9 @@ function App() {
     return s.split(',').map(t => t.trim().toLowerCase()).filter(Boolean);
   };
 
+  // helper: server-side tag query (GET /api/posts?tags=) for a comma-separated search: every tag quoted and required
+  const toTagQuery = (s) => parseTagTokens(s).map(t => `"${t}"`).join(' ');
+
   // helper: check if a tag already exists in the search string
   const tagExistsInSearch = (tagName, searchString) => {
     return parseTagTokens(searchString).includes(tagName.toLowerCase());
@@ -281,17 +277,65 @@ function App() {
         post_count: 0
       }));
     }
+    // While browsing a tag search, show the tags that go with its last tag
+    if (view === 'posts' && relatedTags.length > 0) {
+      return relatedTags.map(tag => ({ ...tag, id: tag.tag_name }));
+    }
     // Show top 20 most popular tags for all other views
     return tags.slice(0, 20);
   };
 
-  // derived filtered posts based on tagSearchQuery (AND semantics)
-  const filteredPosts = posts.filter(post => {
-    const postTags = (post.tags || []).map(t => String(t).toLowerCase());
-    const searchTags = parseTagTokens(tagSearchQuery);
-    if (searchTags.length === 0) return true;
-    return searchTags.every(rt => postTags.includes(rt));
-  });
+  // fetch autocomplete suggestions for the tag currently being typed (the last comma-separated part)
+  useEffect(() => {
+    const current = tagSearch.split(',').pop().trim();
+    if (!current) {
+      setTagSuggestions([]);
+      return;
+    }
+    let cancelled = false;
+    const timer = setTimeout(async () => {
+      try {
+        const res = await api.autocompleteTags(current);
+        if (!cancelled) setTagSuggestions(res.data || []);
+      } catch (e) {
+        // ignore
+      }
+    }, 150);
+    return () => { cancelled = true; clearTimeout(timer); };
+  }, [tagSearch]);
+
+  // fetch related tags for the last tag of the submitted search
+  useEffect(() => {
+    const last = parseTagTokens(tagSearchQuery).pop();
+    if (!last) {
+      setRelatedTags([]);
+      return;
+    }
+    let cancelled = false;
+    api.getRelatedTags(last)
+      .then(res => { if (!cancelled) setRelatedTags(res.data || []); })
+      .catch(() => { if (!cancelled) setRelatedTags([]); });
+    return () => { cancelled = true; };
+  }, [tagSearchQuery]);
+
+  // search posts on the server when the submitted query changes, starting over from its first page
+  useEffect(() => {
+    const query = toTagQuery(tagSearchQuery);
+    if (query === postsQuery.current) return;
+    postsQuery.current = query;
+    setPosts([]);
+    setNextCursor(null);
+    setPostsPage(0);
+    let cancelled = false;
+    api.getPosts(null, null, null, null, query || null)
+      .then(res => {
+        if (cancelled) return;
+        setPosts(res.data?.posts || []);
+        setNextCursor(res.data?.next_cursor || null);
+      })
+      .catch(error => console.error('Error searching posts:', error));
+    return () => { cancelled = true; };
+  }, [tagSearchQuery]);
 
   const handleCreatePool = async (name, description) => {
     try {
@@ -313,6 +357,16 @@ function App() {
     }
   };
 
+  const loadMorePoolPosts = async () => {
+    if (!selectedPool?.next_cursor) return;
+    try {
+      const res = await api.getPool(selectedPool.id, selectedPool.next_cursor);
+      setSelectedPool(prev => ({ ...res.data, posts: [...(prev.posts || []), ...(res.data.posts || [])] }));
+    } catch (e) {
+      alert('Error loading pool');
+    }
+  };
+
   const addPostToPool = async (poolId, postId) => {
     try {
       await api.addPostToPool(poolId, postId);
@@ -381,9 +435,9 @@ function App() {
     // robust helper to get number of posts in a pool regardless of API shape
     const poolPostCount = (pool) => {
       if (!pool) return 0;
+      if (typeof pool.post_count === 'number') return pool.post_count;
       if (Array.isArray(pool.posts)) return pool.posts.length;
       // common alternative fields returned by some APIs
-      if (typeof pool.post_count === 'number') return pool.post_count;
       if (typeof pool.postCount === 'number') return pool.postCount;
       if (typeof pool.count === 'number') return pool.count;
       if (typeof pool.size === 'number') return pool.size;
@@ -399,9 +453,9 @@ function App() {
           <button onClick={() => { setView('upload'); }}>Upload</button>
           <button onClick={() => { setView('register'); }}>Register</button>
           <button onClick={() => { setView('login'); }}>Login</button>
-          <button onClick={() => { setView('pools'); }}>Pools</button>
+          <button onClick={() => { setView('pools'); loadPools(); }}>Pools</button>
           {currentUser && (
-            <button onClick={() => { setView('favorites'); setPostsPage(0); }}>Favorites</button>
+            <button onClick={() => { setView('favorites'); setPostsPage(0); loadUserFavorites(); }}>Favorites</button>
           )}
         </nav>
 
@@ -445,12 +499,12 @@ function App() {
                 const parts = tagSearch.split(',');
                 const current = parts[parts.length - 1].trim().toLowerCase();
                 const tokens = parseTagTokens(tagSearch);
-                const suggestions = current.length > 0 ? tags.filter(t => t.tag_name.toLowerCase().includes(current) && !tokens.includes(t.tag_name.toLowerCase())) : [];
+                const suggestions = current.length > 0 ? tagSuggestions.filter(t => t.tag_name.toLowerCase().startsWith(current) && !tokens.includes(t.tag_name.toLowerCase())) : [];
                 if (suggestions.length === 0) return null;
                 return (
                   <div className="suggestion-list" style={{ marginTop: 6 }}>
                     {suggestions.map(s => (
-                      <button key={s.id} className="suggestion-btn" onClick={() => {
+                      <button key={s.tag_name} className="suggestion-btn" onClick={() => {
                         // Replace the incomplete tag with the complete one
                         setTagSearch(prev => replaceIncompleteTag(prev, s.tag_name));
                       }}>{s.tag_name}</button>
@@ -555,13 +609,13 @@ function App() {
           {view === 'posts' && (
             <div>
               <div className="posts-grid">
-                {filteredPosts.length === 0 ? (
+                {posts.length === 0 ? (
                   <p>No posts match the selected tags or search.</p>
                 ) : (
-                  filteredPosts.slice(postsPage * POSTS_PER_PAGE, (postsPage + 1) * POSTS_PER_PAGE).map(post => (
+                  posts.slice(postsPage * POSTS_PER_PAGE, (postsPage + 1) * POSTS_PER_PAGE).map(post => (
                     <div key={post.id} className="post-card" onClick={() => onPostCardClick(post)}>
                       <img 
-                        src={`http://localhost:8000/uploads/${post.image_filename}`} 
+                        src={post.thumbnail_url ? `http://localhost:8000${post.thumbnail_url}` : `http://localhost:8000/uploads/${post.image_filename}`} 
                         alt={post.description || 'Post'}
                       />
                       <div className="post-info">
@@ -591,15 +645,20 @@ function App() {
                 )}
               </div>
               {/* Posts pagination */}
-              {filteredPosts.length > POSTS_PER_PAGE && (
+              {posts.length > POSTS_PER_PAGE && (
                 <div className="pagination">
-                  {Array.from({ length: Math.ceil(filteredPosts.length / POSTS_PER_PAGE) }).map((_, i) => (
+                  {Array.from({ length: Math.ceil(posts.length / POSTS_PER_PAGE) }).map((_, i) => (
                     <button key={i} className={`page-btn ${postsPage === i ? 'active' : ''}`} onClick={() => { setPostsPage(i); window.scrollTo({ top: 0, behavior: 'smooth' }); }}>
                       {i + 1}
                     </button>
                   ))}
                 </div>
               )}
+              {nextCursor && (
+                <div className="pagination">
+                  <button className="page-btn" onClick={loadMorePosts}>Load more</button>
+                </div>
+              )}
             </div>
           )}
 
@@ -608,7 +667,7 @@ function App() {
           <div className="post-detail">
             <div className="detail-content">
               <div className="detail-image">
-                <img src={`http://localhost:8000/uploads/${selectedPost.image_filename}`} alt={selectedPost.description || 'Post'} />
+                <img src={selectedPost.sample_url ? `http://localhost:8000${selectedPost.sample_url}` : `http://localhost:8000/uploads/${selectedPost.image_filename}`} alt={selectedPost.description || 'Post'} />
               </div>
               <div className="detail-info">
                 {/* Description + Favorite Button */}
@@ -650,6 +709,7 @@ function App() {
                     <input
                       placeholder="Search pools by name"
                       value={poolSearch}
+                      onFocus={loadPools}
                       onChange={(e) => setPoolSearch(e.target.value)}
                       style={{ width: '100%', padding: '8px 10px', borderRadius: 6, border: '1px solid rgba(20,40,80,0.06)', marginBottom: 8 }}
                     />
@@ -677,6 +737,19 @@ function App() {
                 </div>
               </div>
             </div>
+
+            {recommendedPosts.length > 0 && (
+              <div className="detail-section">
+                <h3>Users who favorited this also favorited</h3>
+                <div className="pools-grid">
+                  {recommendedPosts.map(p => (
+                    <div key={p.id} className="post-card" onClick={() => openPost(p.id)}>
+                      <img src={p.thumbnail_url ? `http://localhost:8000${p.thumbnail_url}` : `http://localhost:8000/uploads/${p.image_filename}`} alt={p.description || ''} />
+                    </div>
+                  ))}
+                </div>
+              </div>
+            )}
           </div>
         )}
 
@@ -691,6 +764,9 @@ function App() {
             <div className="pools-grid">
               {pools.slice(poolsPage * POOLS_PER_PAGE, (poolsPage + 1) * POOLS_PER_PAGE).map(pool => (
                 <div key={pool.id} className="pool-card" onClick={() => openPool(pool.id)}>
+                  {pool.cover_post && (
+                    <img className="pool-cover" src={`http://localhost:8000${pool.cover_post.thumbnail_url}`} alt="" />
+                  )}
                   <h3>{pool.name}</h3>
                   <p>{pool.description}</p>
                   <div className="pool-meta">
@@ -731,7 +807,7 @@ function App() {
             <div className="pools-grid" style={{ marginTop: 16 }}>
               {(selectedPool.posts || []).map((p, idx) => (
                 <div key={p.id || p.post_id || idx} className="post-card" onClick={() => openPost(p.id || p.post_id)}>
-                  <img src={`http://localhost:8000/uploads/${p.image_filename || p.filename}`} alt={p.description || ''} />
+                  <img src={p.thumbnail_url ? `http://localhost:8000${p.thumbnail_url}` : `http://localhost:8000/uploads/${p.image_filename || p.filename}`} alt={p.description || ''} />
                   <div className="post-info">
                     <p className="post-desc">{p.description || 'No description'}</p>
                     <div className="post-meta">
@@ -747,6 +823,11 @@ function App() {
                 </div>
               ))}
             </div>
+            {selectedPool.next_cursor && (
+              <div className="pagination">
+                <button className="page-btn" onClick={loadMorePoolPosts}>Load more</button>
+              </div>
+            )}
           </div>
         )}
 
@@ -764,7 +845,7 @@ function App() {
                   {favorites.slice(postsPage * POSTS_PER_PAGE, (postsPage + 1) * POSTS_PER_PAGE).map(post => (
                     <div key={post.id} className="post-card" onClick={() => onPostCardClick(post)}>
                       <img 
-                        src={`http://localhost:8000/uploads/${post.image_filename}`} 
+                        src={post.thumbnail_url ? `http://localhost:8000${post.thumbnail_url}` : `http://localhost:8000/uploads/${post.image_filename}`} 
                         alt={post.description || 'Post'}
                       />
                       <div className="post-info">
@@ -19,17 +19,25 @@ export const api = {
   getMe: () => 
     axios.get(`${API_BASE}/auth/me`),
   
+  // Current user, first page of posts, top tags, newest pools, users and favorites in one request
+  bootstrap: () => 
+    axios.get(`${API_BASE}/bootstrap`),
+  
   // Users
   getUsers: () => 
     axios.get(`${API_BASE}/users`),
   
   // Posts
-  getPosts: (tag = null, userId = null) => 
-    axios.get(`${API_BASE}/posts`, { params: { tag, user_id: userId } }),
+  // tags is a search query such as `sheep "sailor moon" -nsfw`
+  getPosts: (tag = null, userId = null, before = null, limit = null, tags = null) => 
+    axios.get(`${API_BASE}/posts`, { params: { tag, tags, user_id: userId, before, limit } }),
   
   getPost: (id) => 
     axios.get(`${API_BASE}/posts/${id}`),
   
+  getRecommendedPosts: (id) => 
+    axios.get(`${API_BASE}/posts/${id}/recommended`, { params: { fields: 'id,image_filename,thumbnail_url,description' } }),
+  
   createPost: (formData) => 
     axios.post(`${API_BASE}/posts`, formData, {
       headers: { 'Content-Type': 'multipart/form-data' }
@@ -49,8 +57,8 @@ export const api = {
   getPools: () => 
     axios.get(`${API_BASE}/pools`),
   
-  getPool: (id) => 
-    axios.get(`${API_BASE}/pools/${id}`),
+  getPool: (id, after = null) => 
+    axios.get(`${API_BASE}/pools/${id}`, { params: { after } }),
   
   createPool: (name, description) => 
     axios.post(`${API_BASE}/pools`, { name, description }),
@@ -66,5 +74,11 @@ export const api = {
   
   // Tags
   getTags: () => 
-    axios.get(`${API_BASE}/tags`)
+    axios.get(`${API_BASE}/tags`),
+  
+  autocompleteTags: (q) => 
+    axios.get(`${API_BASE}/tags/autocomplete`, { params: { q } }),
+  
+  getRelatedTags: (tagName, limit = 20) => 
+    axios.get(`${API_BASE}/tags/${encodeURIComponent(tagName)}/related`, { params: { limit } })
 };
\ No newline at end of file
@@ -0,0 +1,146 @@
+"""Keeps each process's in-memory indexes in step with the database.
+
+tag_index, tag_autocomplete and perceptual_index live in the memory of every
+API process. Triggers append the id of each post, post_tags row, tag and
+perceptual hash that changes to index_changes, whoever makes the change:
+another worker, bulk_import.py, phash.py backfill. Each process remembers the
+last seq it has applied and catches up by re-reading the current rows behind
+the ids logged since, so applying an entry twice (or one for a change the
+process already made itself) is harmless.
+
+Only the newest INDEX_CHANGES_KEPT entries are kept. A process that falls
+further behind (a bulk import while it runs, a long stall) rebuilds its
+indexes from scratch instead.
+"""
+import json
+import threading
+
+# How often each process applies the changes logged since its last catch-up
+INDEX_SYNC_INTERVAL = 5
+
+# Log entries kept for processes catching up; one further behind rebuilds its indexes
+INDEX_CHANGES_KEPT = 100_000
+
+def log_bounds(conn):
+    """(last seq ever logged, oldest seq still kept) of index_changes; oldest is last + 1 when nothing is kept"""
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'index_changes'").fetchone()
+    last = row[0] if row else 0
+    oldest = conn.execute("SELECT MIN(seq) FROM index_changes").fetchone()[0]
+    return last, oldest if oldest is not None else last + 1
+
+def prune_index_changes(conn):
+    """Delete entries beyond the newest INDEX_CHANGES_KEPT, at most INDEX_CHANGES_KEPT per call"""
+    last, oldest = log_bounds(conn)
+    if last - oldest < 2 * INDEX_CHANGES_KEPT:
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM index_changes WHERE seq < ?", (min(oldest + INDEX_CHANGES_KEPT, last - INDEX_CHANGES_KEPT),))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def id_list(ids) -> str:
+    """A set of ids as a JSON array, for `IN (SELECT value FROM json_each(?))`"""
+    return json.dumps(list(ids))
+
+class IndexSync:
+    """Builds the in-memory indexes from one snapshot and replays index_changes onto them"""
+
+    def __init__(self, tag_index, tag_autocomplete, perceptual_index):
+        self.lock = threading.Lock()  # one catch-up at a time, so re-read rows are applied in order
+        self.tag_index = tag_index
+        self.tag_autocomplete = tag_autocomplete
+        self.perceptual_index = perceptual_index
+        self.position = None  # last index_changes seq reflected in the indexes
+
+    def build(self, conn):
+        """Rebuild every index from a single read transaction
+
+        Changes applied by catch-ups while the indexes are being rebuilt may be
+        lost when the new ones are swapped in, but they were logged after the
+        snapshot, so the next catch-up replays them.
+        """
+        conn.execute("BEGIN")
+        try:
+            position, _ = log_bounds(conn)
+            self.tag_index.build(conn)
+            self.tag_autocomplete.build(conn)
+            self.perceptual_index.build(conn)
+        finally:
+            conn.rollback()
+        with self.lock:
+            self.position = position
+
+    def catch_up(self, conn) -> bool:
+        """Apply the entries logged since the last build or catch-up; False if too far behind (build() instead)"""
+        with self.lock:
+            if self.position is None:
+                return False
+            conn.execute("BEGIN")
+            try:
+                last, oldest = log_bounds(conn)
+                if oldest > self.position + 1 or last - self.position > INDEX_CHANGES_KEPT:
+                    return False
+                if last == self.position:
+                    return True
+                rows = conn.execute(
+                    "SELECT post_id, tag_id, file_hash FROM index_changes WHERE seq > ?", (self.position,)
+                ).fetchall()
+                self.apply(conn, rows)
+            finally:
+                conn.rollback()
+            self.position = last
+            return True
+
+    def refresh(self, conn):
+        """Catch up, or rebuild if this process has fallen too far behind"""
+        if not self.catch_up(conn):
+            self.build(conn)
+
+    def apply(self, conn, rows):
+        """Bring the indexes in line with the current rows behind some (post_id, tag_id, file_hash) entries"""
+        post_ids, tag_ids, digests = set(), set(), set()
+        logged_tags = {}  # post_id -> tag ids whose post_tags rows changed
+        for post_id, tag_id, digest in rows:
+            if post_id is not None:
+                post_ids.add(post_id)
+                if tag_id is not None:
+                    logged_tags.setdefault(post_id, set()).add(tag_id)
+            if tag_id is not None:
+                tag_ids.add(tag_id)
+            if digest is not None:
+                digests.add(digest)
+
+        live_posts = {row[0] for row in conn.execute(
+            "SELECT id FROM posts WHERE id IN (SELECT value FROM json_each(?))", (id_list(post_ids),)
+        )}
+        post_tags = {}
+        for post_id, tag_id in conn.execute(
+            "SELECT post_id, tag_id FROM post_tags WHERE post_id IN (SELECT value FROM json_each(?))", (id_list(live_posts),)
+        ):
+            post_tags.setdefault(post_id, set()).add(tag_id)
+            tag_ids.add(tag_id)
+        tags = conn.execute(
+            "SELECT id, tag_name, post_count FROM tags WHERE id IN (SELECT value FROM json_each(?))", (id_list(tag_ids),)
+        ).fetchall()
+        tag_names = {row[0]: row[1] for row in tags}
+
+        for post_id in post_ids:
+            if post_id in live_posts:
+                current = post_tags.get(post_id, set())
+                self.tag_index.add_post(post_id, {tag_names[tag_id]: tag_id for tag_id in current if tag_id in tag_names})
+                self.tag_index.remove_tags(post_id, logged_tags.get(post_id, set()) - current)
+            else:
+                self.tag_index.remove_post(post_id, logged_tags.get(post_id, ()))
+        self.tag_autocomplete.update_tags([tuple(row) for row in tags])
+
+        hashes = dict(conn.execute(
+            "SELECT hash, phash FROM files WHERE hash IN (SELECT value FROM json_each(?)) AND phash IS NOT NULL", (id_list(digests),)
+        ).fetchall())
+        for digest in digests:
+            if digest in hashes:
+                self.perceptual_index.add(digest, hashes[digest])
+            else:
+                self.perceptual_index.remove(digest)
@@ -1,12 +1,39 @@
 import sqlite3
+import os
+import datetime
+
+import pool_order
+import related_tags
+import storage
 
 DB_NAME = "sheepbooru.db"
+UPLOAD_DIR = "uploads"
 
-def init_db():
-    """Initialize the database with all required tables"""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+# Schema migrations as (version, description, function), applied in version order
+MIGRATIONS = []
+
+def migration(version: int, description: str):
+    """Register a migration function; it receives a cursor inside an open transaction
     
+    A migration may return a callable, which is run once its transaction has
+    committed (e.g. to delete files that the committed rows no longer use).
+    """
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        return fn
+    return register
+
+def add_column(cursor, table: str, column: str, definition: str):
+    """ALTER TABLE ... ADD COLUMN that is a no-op if the column already exists"""
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+# ============== MIGRATIONS ==============
+
+@migration(1, "base tables")
+def create_tables(cursor):
+    """Create all base tables"""
     # Users table
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS users (
@@ -85,11 +112,379 @@ def init_db():
             FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE
         )
     """)
+
+
+@migration(2, "indexes for listing queries")
+def add_listing_indexes(cursor):
+    """Index the columns main.py filters and sorts on"""
+    # Front page and keyset pagination: ORDER BY upload_date DESC, id DESC
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_posts_upload_date ON posts (upload_date, id)")
+    # Posts by uploader, newest first
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_posts_uploader ON posts (uploader_id, upload_date, id)")
+    # Posts for a tag (covering, so the tag index build never touches the table)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_post_tags_tag ON post_tags (tag_id, post_id)")
+    # A user's favorites, most recent first
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_favorites_user_time ON favorites (user_id, favorited_at, post_id)")
+    # Favorites of a post (cascade deletes)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_favorites_post ON favorites (post_id)")
+    # Posts of a pool in order
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pool_posts_order ON pool_posts (pool_id, order_index, post_id)")
+    # Pools containing a post (post detail page, cascade deletes)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pool_posts_post ON pool_posts (post_id)")
+    # Pools index page, newest first
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pools_created ON pools (created_at)")
+
+@migration(3, "content-addressed upload storage")
+def add_files_table(cursor):
+    """Add the refcounted files table and move existing uploads into the hashed layout"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS files (
+            hash TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            ref_count INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    add_column(cursor, "posts", "file_hash", "TEXT REFERENCES files(hash)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_posts_file_hash ON posts (file_hash)")
+    if os.path.isdir(UPLOAD_DIR):
+        return storage.rehash_uploads(cursor, UPLOAD_DIR)
+
+@migration(4, "derivative tracking")
+def add_derivative_flag(cursor):
+    """Track which blobs have thumbnail/sample images rendered"""
+    add_column(cursor, "files", "has_derivatives", "INTEGER NOT NULL DEFAULT 0")
+
+@migration(5, "denormalized tag post counts")
+def add_tag_post_count(cursor):
+    """Keep tags.post_count in step with post_tags via triggers (cascade deletes fire them too)"""
+    add_column(cursor, "tags", "post_count", "INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("""
+        UPDATE tags SET post_count = (SELECT COUNT(*) FROM post_tags pt WHERE pt.tag_id = tags.id)
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_post_tags_count_insert AFTER INSERT ON post_tags
+        BEGIN
+            UPDATE tags SET post_count = post_count + 1 WHERE id = NEW.tag_id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_post_tags_count_delete AFTER DELETE ON post_tags
+        BEGIN
+            UPDATE tags SET post_count = post_count - 1 WHERE id = OLD.tag_id;
+        END
+    """)
+    # Tag list ordering: most used first, then by name
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tags_post_count ON tags (post_count DESC, tag_name)")
+
+@migration(6, "persistent sessions")
+def add_sessions_table(cursor):
+    """Store login sessions in the database instead of process memory"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            token TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            user_json TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)")
+
+@migration(7, "ranked listing orders")
+def add_listing_orders(cursor):
+    """Indexes and tables behind the popular, trending and random post orders"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_posts_popular ON posts (favorite_count, id)")
+    
+    # A fixed random position per post; a random feed is a range read starting at a seed
+    add_column(cursor, "posts", "random_key", "REAL")
+    cursor.execute("UPDATE posts SET random_key = (random() / 18446744073709551616.0) + 0.5 WHERE random_key IS NULL")
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_posts_random_key AFTER INSERT ON posts
+        WHEN NEW.random_key IS NULL
+        BEGIN
+            UPDATE posts SET random_key = (random() / 18446744073709551616.0) + 0.5 WHERE id = NEW.id;
+        END
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_posts_random ON posts (random_key, id)")
+    
+    # Time-decayed favorite scores, rebuilt periodically from recent favorites
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS trending_posts (
+            post_id INTEGER PRIMARY KEY,
+            score REAL NOT NULL,
+            FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_trending_score ON trending_posts (score, post_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_favorites_time ON favorites (favorited_at)")
+
+@migration(8, "denormalized pool post counts and covers")
+def add_pool_summary(cursor):
+    """Keep pools.post_count and pools.cover_post_id (the first post by order) in step with pool_posts"""
+    add_column(cursor, "pools", "post_count", "INTEGER NOT NULL DEFAULT 0")
+    add_column(cursor, "pools", "cover_post_id", "INTEGER REFERENCES posts(id) ON DELETE SET NULL")
+    cover = "(SELECT post_id FROM pool_posts WHERE pool_id = {pool} ORDER BY order_index, post_id LIMIT 1)"
+    cursor.execute(f"""
+        UPDATE pools SET post_count = (SELECT COUNT(*) FROM pool_posts WHERE pool_id = pools.id),
+                         cover_post_id = {cover.format(pool="pools.id")}
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_pool_posts_insert AFTER INSERT ON pool_posts
+        BEGIN
+            UPDATE pools SET post_count = post_count + 1, cover_post_id = {cover.format(pool="NEW.pool_id")}
+            WHERE id = NEW.pool_id;
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_pool_posts_delete AFTER DELETE ON pool_posts
+        BEGIN
+            UPDATE pools SET post_count = post_count - 1, cover_post_id = {cover.format(pool="OLD.pool_id")}
+            WHERE id = OLD.pool_id;
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_pool_posts_reorder AFTER UPDATE OF order_index ON pool_posts
+        BEGIN
+            UPDATE pools SET cover_post_id = {cover.format(pool="NEW.pool_id")} WHERE id = NEW.pool_id;
+        END
+    """)
+
+@migration(9, "gapped pool order keys")
+def space_pool_order(cursor):
+    """Respace pool_posts.order_index so posts can be moved between neighbours without renumbering"""
+    pool_order.rebalance(cursor)
+
+@migration(10, "perceptual hashes")
+def add_perceptual_hash(cursor):
+    """Store a 64-bit dHash per blob for near-duplicate search (filled by `python phash.py backfill`)"""
+    add_column(cursor, "files", "phash", "INTEGER")
+
+@migration(11, "full-text search")
+def add_full_text_search(cursor):
+    """FTS5 indexes over post descriptions and pool names/descriptions, kept in sync by triggers"""
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+            description, content='posts', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS pools_fts USING fts5(
+            name, description, content='pools', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
+    
+    # External-content tables: the triggers pass old values so FTS5 can remove their terms
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_posts_fts_insert AFTER INSERT ON posts
+        BEGIN
+            INSERT INTO posts_fts (rowid, description) VALUES (NEW.id, NEW.description);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_posts_fts_delete AFTER DELETE ON posts
+        BEGIN
+            INSERT INTO posts_fts (posts_fts, rowid, description) VALUES ('delete', OLD.id, OLD.description);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_posts_fts_update AFTER UPDATE OF description ON posts
+        BEGIN
+            INSERT INTO posts_fts (posts_fts, rowid, description) VALUES ('delete', OLD.id, OLD.description);
+            INSERT INTO posts_fts (rowid, description) VALUES (NEW.id, NEW.description);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_pools_fts_insert AFTER INSERT ON pools
+        BEGIN
+            INSERT INTO pools_fts (rowid, name, description) VALUES (NEW.id, NEW.name, NEW.description);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_pools_fts_delete AFTER DELETE ON pools
+        BEGIN
+            INSERT INTO pools_fts (pools_fts, rowid, name, description) VALUES ('delete', OLD.id, OLD.name, OLD.description);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_pools_fts_update AFTER UPDATE OF name, description ON pools
+        BEGIN
+            INSERT INTO pools_fts (pools_fts, rowid, name, description) VALUES ('delete', OLD.id, OLD.name, OLD.description);
+            INSERT INTO pools_fts (rowid, name, description) VALUES (NEW.id, NEW.name, NEW.description);
+        END
+    """)
+    
+    # Index the rows that already exist
+    cursor.execute("INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')")
+    cursor.execute("INSERT INTO pools_fts (pools_fts) VALUES ('rebuild')")
+
+@migration(12, "tag co-occurrence")
+def add_tag_cooccurrence(cursor):
+    """Count the posts each pair of tags shares, for related-tag lookups (kept up to date by related_tags deltas)"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS tag_cooccurrence (
+            tag_id INTEGER NOT NULL,
+            related_tag_id INTEGER NOT NULL,
+            post_count INTEGER NOT NULL,
+            PRIMARY KEY (tag_id, related_tag_id)
+        ) WITHOUT ROWID
+    """)
+    related_tags.rebuild(cursor)
+    # Related tags of a tag, most shared posts first
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tag_cooccurrence_rank
+        ON tag_cooccurrence (tag_id, post_count DESC, related_tag_id)
+    """)
+
+@migration(13, "post recommendations")
+def add_post_similar(cursor):
+    """Tables behind "users who favorited this also favorited" (filled by the recommendations job)"""
+    # Each post's most similar posts by rank; deleted similar posts are skipped when reading
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS post_similar (
+            post_id INTEGER NOT NULL,
+            rank INTEGER NOT NULL,
+            similar_post_id INTEGER NOT NULL,
+            score REAL NOT NULL,
+            PRIMARY KEY (post_id, rank),
+            FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+    """)
+    # Progress of incremental background jobs, e.g. the newest favorite already processed
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS job_state (
+            job TEXT PRIMARY KEY,
+            watermark TEXT NOT NULL
+        )
+    """)
+
+@migration(14, "pending favorite count deltas")
+def add_favorite_count_deltas(cursor):
+    """favorite_count changes written with each favorites row and applied to posts in batches (see favorites.py)"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS favorite_count_deltas (
+            post_id INTEGER PRIMARY KEY,
+            delta INTEGER NOT NULL,
+            FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE
+        )
+    """)
+@migration(15, "sweep unreferenced legacy uploads")
+def sweep_legacy_uploads(cursor):
+    """Delete uploads/{timestamp}_{name} files that migration 3 left behind because no post used them"""
+    if os.path.isdir(UPLOAD_DIR):
+        return storage.sweep_legacy_uploads(cursor, UPLOAD_DIR)
+
+@migration(16, "in-memory index change log")
+def add_index_changes(cursor):
+    """Log every change the in-memory tag, autocomplete and perceptual indexes depend on (see index_sync.py)"""
+    # AUTOINCREMENT: seqs must never be reused, even after the log is emptied
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS index_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            post_id INTEGER,
+            tag_id INTEGER,
+            file_hash TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_posts_index_insert AFTER INSERT ON posts
+        BEGIN
+            INSERT INTO index_changes (post_id) VALUES (NEW.id);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_posts_index_delete AFTER DELETE ON posts
+        BEGIN
+            INSERT INTO index_changes (post_id) VALUES (OLD.id);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_post_tags_index_insert AFTER INSERT ON post_tags
+        BEGIN
+            INSERT INTO index_changes (post_id, tag_id) VALUES (NEW.post_id, NEW.tag_id);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_post_tags_index_delete AFTER DELETE ON post_tags
+        BEGIN
+            INSERT INTO index_changes (post_id, tag_id) VALUES (OLD.post_id, OLD.tag_id);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_tags_index_insert AFTER INSERT ON tags
+        BEGIN
+            INSERT INTO index_changes (tag_id) VALUES (NEW.id);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_files_index_insert AFTER INSERT ON files WHEN NEW.phash IS NOT NULL
+        BEGIN
+            INSERT INTO index_changes (file_hash) VALUES (NEW.hash);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_files_index_phash AFTER UPDATE OF phash ON files
+        BEGIN
+            INSERT INTO index_changes (file_hash) VALUES (NEW.hash);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_files_index_delete AFTER DELETE ON files WHEN OLD.phash IS NOT NULL
+        BEGIN
+            INSERT INTO index_changes (file_hash) VALUES (OLD.hash);
+        END
+    """)
+
+# ============== RUNNER ==============
+
+def migrate(db_name: str = DB_NAME) -> int:
+    """Apply pending migrations in order and return the resulting schema version
+    
+    Each migration runs in its own BEGIN IMMEDIATE transaction and re-checks the
+    version inside it, so several app processes can start at once against a live
+    database; WAL mode keeps readers going while a migration holds the write lock.
+    """
+    conn = sqlite3.connect(db_name, isolation_level=None)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA busy_timeout = 30000")
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at DATETIME NOT NULL
+        )
+    """)
+    
+    version = 0
+    for number, description, fn in sorted(MIGRATIONS, key=lambda m: m[0]):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+            after_commit = None
+            if number > version:
+                after_commit = fn(conn.cursor())
+                conn.execute(
+                    "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                    (number, description, datetime.datetime.now().isoformat())
+                )
+                version = number
+                print(f"Applied migration {number}: {description}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            conn.close()
+            raise
+        if after_commit:
+            after_commit()
     
-    conn.commit()
     conn.close()
-    print(f"Database '{DB_NAME}' initialized successfully with 7 tables!")
-    print("Tables: users, posts, tags, post_tags, favorites, pools, pool_posts")
+    return version
+
+def init_db():
+    """Initialize the database, or bring an existing one up to the latest schema"""
+    version = migrate(DB_NAME)
+    print(f"Database '{DB_NAME}' is at schema version {version}")
 
 if __name__ == "__main__":
-    init_db()
\ No newline at end of file
+    init_db()
@@ -1,32 +1,142 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends, Cookie
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends, Cookie, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
 from typing import List, Optional
+from contextlib import asynccontextmanager
+import asyncio
+import anyio.to_thread
 import sqlite3
 import datetime
-import hashlib
 import os
-import shutil
-import secrets
+import base64
+import json
+import logging
+import random
+
+from autocomplete import TagAutocomplete, MAX_SUGGESTIONS
+from cache import CachedBody, ImmutableStaticFiles, ResponseCache, cached_json_response
+from db import ConnectionPool, ConnectionScope
+from init_db import migrate
+from metrics import MetricsMiddleware, registry
+from index_sync import INDEX_SYNC_INTERVAL, IndexSync, prune_index_changes
+from favorites import FLUSH_INTERVAL, RECONCILE_INTERVAL, add_favorite_delta, current_favorite_count, flush_favorite_deltas, reconcile_favorite_counts
+from derivatives import DerivativePipeline, derivative_path, remove_derivatives
+from phash import DUPLICATE_DISTANCE, MAX_DISTANCE, PerceptualIndex, safe_dhash
+from pool_order import append_key, place_after
+from recommendations import TOP_K
+from related_tags import MAX_RELATED_TAGS, count_tag_pairs, uncount_tag_pairs, related_tags
+from responses import CompressionMiddleware, FastJSONResponse, dumps, parse_fields
+from passwords import DUMMY_HASH, hash_password_async, verify_password_async, needs_rehash
+from search import fts_query, highlight, snippet_sql
+from sessions import SessionStore, SQLiteSessionBackend, RedisSessionBackend
+from storage import UploadTooLarge, UnsupportedImageType, stage_upload, add_blob_ref, release_blob_ref, blob_path, place_blob, remove_blob
+from tag_index import TagIndex, parse_tag_query
+from tagging import split_tags, resolve_tags, insert_post_tags
+from trending import TRENDING_REFRESH_INTERVAL, refresh_trending
+
+# Errors from background tasks, which have no request to report them to
+logger = logging.getLogger("sheepbooru")
 
 # Database setup
 DB_NAME = "sheepbooru.db"
 UPLOAD_DIR = "uploads"
 
-# Session storage (in production, use Redis or similar)
-sessions = {}
+# Endpoints are plain (sync) functions, so FastAPI runs them on a worker thread
+# pool; this caps how many requests can hold a database connection at once
+DB_WORKER_THREADS = 16
+
+# Sessions live in the database by default; set this to share them through Redis instead
+REDIS_URL = os.environ.get("SHEEPBOORU_REDIS_URL")
+
+# Largest accepted image upload
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+
+# How often expired sessions are purged
+SESSION_SWEEP_INTERVAL = 600
+
+# Post listing page sizes
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Tag searches that can match at most this many posts are evaluated in memory and passed
+# to SQL as an id list; broader ones are checked against post_tags while walking the order
+TAG_ID_LIST_MAX = 2000
+
+# Orders listed highest first, as (sort key, tiebreak, tables read); "random" is handled separately
+RANKED_ORDERS = {
+    "new": ("p.upload_date", "p.id", "posts p"),
+    "popular": ("p.favorite_count", "p.id", "posts p"),
+    # CROSS JOIN pins the join order: walk idx_trending_score, whatever ANALYZE last saw in trending_posts
+    "trending": ("tp.score", "tp.post_id", "trending_posts tp CROSS JOIN posts p ON p.id = tp.post_id"),
+    "relevance": ("-posts_fts.rank", "p.id", "posts p"),  # BM25; needs a text search joined in
+}
+
+# Tags, users, pools and favorites included in GET /api/bootstrap (posts get a normal page)
+BOOTSTRAP_LIST_SIZE = 100
+
+# Fields a post listing's `fields=` can select; snippet, order_index and score only appear where the listing has them
+POST_FIELDS = (
+    "id", "image_filename", "uploader_id", "uploader_username", "upload_date", "description",
+    "favorite_count", "thumbnail_url", "sample_url", "tags", "snippet", "order_index", "score",
+)
+
+# Recommendations returned by default (at most TOP_K are stored per post)
+RECOMMENDED_PAGE_SIZE = 20
+
+# Columns post queries select for building the response but don't return
+INTERNAL_POST_COLUMNS = ("has_derivatives", "sort_key")
+
+# Likely duplicates listed in an upload response
+UPLOAD_DUPLICATES_LIMIT = 10
+
+# Max bound parameters per IN (...) query, well under SQLite's variable limit
+IN_BATCH_SIZE = 500
+
+# Inverted tag index used for tag searches
+tag_index = TagIndex()
+
+# Prefix index over tag names for search-as-you-type
+tag_autocomplete = TagAutocomplete()
+
+# Perceptual hashes of all blobs, for near-duplicate search
+perceptual_index = PerceptualIndex()
+
+# Built at startup, then kept current with changes made by any process (other workers, bulk_import.py)
+index_sync = IndexSync(tag_index, tag_autocomplete, perceptual_index)
+
+# Serialized GET /api/tags response; cleared whenever tag counts change
+tag_list_cache = ResponseCache()
+
+# Serialized anonymous GET /api/posts/{id} responses, keyed by post id
+post_cache = ResponseCache()
+
+# Serialized GET /api/pools ("pools") and GET /api/pools/{id} (pool id) responses
+pool_cache = ResponseCache()
+
+# Background thumbnail/sample rendering for new uploads
+derivative_pipeline = DerivativePipeline(UPLOAD_DIR)
 
 # Ensure upload directory exists
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+# Reused WAL-mode connections shared by all request threads
+db_pool = ConnectionPool(DB_NAME, max_idle=DB_WORKER_THREADS)
+
 def get_db():
-    """Get database connection"""
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON")
-    return conn
+    """Get a pooled database connection (close() returns it to the pool)"""
+    return db_pool.acquire()
+
+def make_session_backend():
+    """Redis-backed sessions if REDIS_URL is set, otherwise the sessions table"""
+    if REDIS_URL:
+        import redis  # optional dependency, only needed for the Redis backend
+        return RedisSessionBackend(redis.Redis.from_url(REDIS_URL))
+    return SQLiteSessionBackend(get_db)
+
+# Persistent sessions with an in-process cache in front
+session_store = SessionStore(make_session_backend())
 
 # Pydantic Models
 class UserCreate(BaseModel):
@@ -50,10 +160,141 @@ class PoolCreate(BaseModel):
 class PoolAddPost(BaseModel):
     post_id: int
 
+class PoolMovePost(BaseModel):
+    after_post_id: Optional[int] = None
+
+async def sweep_sessions():
+    """Periodically purge expired sessions"""
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            await anyio.to_thread.run_sync(session_store.sweep)
+        except Exception:
+            logger.exception("Session sweep failed")
+
+def refresh_trending_feed():
+    """Rebuild trending_posts on a pooled connection"""
+    conn = get_db()
+    refresh_trending(conn)
+    conn.close()
+
+async def refresh_trending_periodically():
+    """Rebuild the trending ranking at startup and then every TRENDING_REFRESH_INTERVAL seconds"""
+    while True:
+        try:
+            await anyio.to_thread.run_sync(refresh_trending_feed)
+        except Exception:
+            logger.exception("Trending refresh failed")
+        await asyncio.sleep(TRENDING_REFRESH_INTERVAL)
+
+def sync_indexes():
+    """Apply index changes logged by any process, rebuilding if too far behind, and trim the log"""
+    conn = get_db()
+    index_sync.refresh(conn)
+    prune_index_changes(conn)
+    conn.close()
+
+async def sync_indexes_periodically():
+    """Keep the in-memory indexes current every INDEX_SYNC_INTERVAL seconds"""
+    while True:
+        await asyncio.sleep(INDEX_SYNC_INTERVAL)
+        try:
+            await anyio.to_thread.run_sync(sync_indexes)
+        except Exception:
+            logger.exception("Index sync failed")
+
+def apply_favorite_counts(update):
+    """Run flush_favorite_deltas or reconcile_favorite_counts and drop cached responses showing the changed counts"""
+    conn = get_db()
+    post_ids = update(conn)
+    pool_ids = pools_containing(conn.cursor(), post_ids) if post_ids else []
+    conn.close()
+    if post_ids:
+        post_cache.invalidate(post_ids)
+    if pool_ids:
+        pool_cache.invalidate(pool_ids)
+
+async def flush_favorite_counts():
+    """Write buffered favorite count deltas every FLUSH_INTERVAL seconds, and reconcile every RECONCILE_INTERVAL"""
+    loop = asyncio.get_running_loop()
+    last_reconcile = loop.time()
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        try:
+            if loop.time() - last_reconcile >= RECONCILE_INTERVAL:
+                await anyio.to_thread.run_sync(apply_favorite_counts, reconcile_favorite_counts)
+                last_reconcile = loop.time()
+            else:
+                await anyio.to_thread.run_sync(apply_favorite_counts, flush_favorite_deltas)
+        except Exception:
+            # The deltas stay in favorite_count_deltas for the next flush
+            logger.exception("Favorite count flush failed")
+
+@asynccontextmanager
+async def lifespan(app):
+    """Bring the schema up to date and load in-memory indexes before serving requests"""
+    anyio.to_thread.current_default_thread_limiter().total_tokens = DB_WORKER_THREADS
+    migrate(DB_NAME)
+    conn = get_db()
+    index_sync.build(conn)
+    conn.close()
+    sweeper = asyncio.create_task(sweep_sessions())
+    index_syncer = asyncio.create_task(sync_indexes_periodically())
+    trending_refresher = asyncio.create_task(refresh_trending_periodically())
+    favorite_flusher = asyncio.create_task(flush_favorite_counts())
+    yield
+    sweeper.cancel()
+    index_syncer.cancel()
+    trending_refresher.cancel()
+    favorite_flusher.cancel()
+    apply_favorite_counts(flush_favorite_deltas)
+    derivative_pipeline.shutdown()
+    db_pool.close_all()
+
 # Initialize FastAPI
-app = FastAPI(title="SheepBooru API")
+app = FastAPI(title="SheepBooru API", lifespan=lifespan, default_response_class=FastJSONResponse)
+
+class UploadSizeLimit:
+    """ASGI middleware that cuts off oversized upload bodies while they stream in
+    
+    Without it the whole multipart body would be spooled to disk before the
+    endpoint could look at its size.
+    """
+    
+    def __init__(self, app, max_bytes: int, paths):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.paths = set(paths)
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        
+        too_large = HTTPException(status_code=413, detail=f"Upload is larger than {self.max_bytes // (1024 * 1024)} MB")
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = JSONResponse(status_code=413, content={"detail": too_large.detail})
+            await response(scope, receive, send)
+            return
+        
+        received = 0
+        
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise too_large
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+# Multipart overhead on top of the image itself
+app.add_middleware(UploadSizeLimit, max_bytes=MAX_UPLOAD_BYTES + 1024 * 1024, paths=["/api/posts"])
 
-# CORS for frontend
+# CORS for frontend; registered after UploadSizeLimit so it wraps it and its 413s carry CORS headers
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:5173"],
@@ -62,33 +303,158 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Serve uploaded images
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+# gzip (or brotli) for JSON responses of 1 KiB and more
+app.add_middleware(CompressionMiddleware)
+
+# Returns connections a request left checked out, e.g. when its handler raised before close()
+app.add_middleware(ConnectionScope)
+
+# Outermost, so rejected uploads and CORS preflights are counted too
+app.add_middleware(MetricsMiddleware)
+
+# Serve uploaded images; blobs and their derivatives are named by content hash, so they can be cached forever
+app.mount("/uploads", ImmutableStaticFiles(directory=UPLOAD_DIR), name="uploads")
 
 # ============== UTILITY FUNCTIONS ==============
 
-def hash_password(password: str) -> str:
-    """Simple password hashing"""
-    return hashlib.sha256(password.encode()).hexdigest()
+def find_user_by_name(username: str):
+    """Fetch a user row, including its password hash"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT id, username, is_admin, created_at, password_hash FROM users WHERE username = ?",
+        (username,)
+    )
+    user = cursor.fetchone()
+    conn.close()
+    return user
 
-def get_or_create_tag(conn, tag_name: str) -> int:
-    """Get existing tag ID or create new tag"""
+def create_user(username: str, password_hash: str) -> Optional[int]:
+    """Insert a user; returns None if the username was taken in the meantime"""
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute("SELECT id FROM tags WHERE tag_name = ?", (tag_name.lower(),))
-    result = cursor.fetchone()
-    
-    if result:
-        return result["id"]
+    created_at = datetime.datetime.now().isoformat()
+    try:
+        cursor.execute(
+            "INSERT INTO users (username, password_hash, is_admin, created_at) VALUES (?, ?, 0, ?)",
+            (username, password_hash, created_at)
+        )
+        conn.commit()
+    except sqlite3.IntegrityError:
+        conn.close()
+        return None
+    user_id = cursor.lastrowid
+    conn.close()
+    return user_id
+
+def update_password_hash(user_id: int, password_hash: str):
+    """Replace a user's stored password hash (used to upgrade old hashes)"""
+    conn = get_db()
+    conn.execute("UPDATE users SET password_hash = ? WHERE id = ?", (password_hash, user_id))
+    conn.commit()
+    conn.close()
+
+def get_tags_for_posts(cursor, post_ids) -> dict:
+    """Fetch tag names for many posts at once, keyed by post id"""
+    tags_by_post = {post_id: [] for post_id in post_ids}
+    ids = list(tags_by_post)
+    for i in range(0, len(ids), IN_BATCH_SIZE):
+        batch = ids[i:i + IN_BATCH_SIZE]
+        placeholders = ",".join("?" * len(batch))
+        cursor.execute(f"""
+            SELECT pt.post_id, t.tag_name
+            FROM post_tags pt
+            JOIN tags t ON t.id = pt.tag_id
+            WHERE pt.post_id IN ({placeholders})
+        """, batch)
+        for row in cursor.fetchall():
+            tags_by_post[row["post_id"]].append(row["tag_name"])
+    return tags_by_post
+
+def image_urls(image_filename: str, has_derivatives) -> dict:
+    """URLs for a post's thumbnail and sample images, falling back to the original until rendered"""
+    original = f"/uploads/{image_filename}"
+    if not has_derivatives:
+        return {"thumbnail_url": original, "sample_url": original}
+    return {
+        "thumbnail_url": f"/uploads/{derivative_path(image_filename, 'thumbnail')}",
+        "sample_url": f"/uploads/{derivative_path(image_filename, 'sample')}",
+    }
+
+def build_posts(cursor, posts, fields=None) -> list:
+    """Turn post rows into response dicts, with tags from a single batched query
+    
+    `fields` (from parse_fields) limits each dict to those fields; tags are only
+    queried when asked for. Dicts are built straight from the row tuples.
+    """
+    if not posts:
+        return []
+    names = posts[0].keys()
+    columns = [
+        (name, i) for i, name in enumerate(names)
+        if name not in INTERNAL_POST_COLUMNS and (fields is None or name in fields)
+    ]
+    id_index = names.index("id")
+    filename_index, derivatives_index = names.index("image_filename"), names.index("has_derivatives")
+    url_fields = [name for name in ("thumbnail_url", "sample_url") if fields is None or name in fields]
+    with_tags = fields is None or "tags" in fields
+    tags_by_post = get_tags_for_posts(cursor, [post[id_index] for post in posts]) if with_tags else None
     
-    cursor.execute("INSERT INTO tags (tag_name) VALUES (?)", (tag_name.lower(),))
+    result = []
+    for post in posts:
+        data = {name: post[i] for name, i in columns}
+        if url_fields:
+            urls = image_urls(post[filename_index], post[derivatives_index])
+            for name in url_fields:
+                data[name] = urls[name]
+        if with_tags:
+            data["tags"] = tags_by_post[post[id_index]]
+        result.append(data)
+    return result
+
+def mark_derivatives_ready(digest: str):
+    """Record that a blob's thumbnail and sample have been rendered"""
+    conn = get_db()
+    conn.execute("UPDATE files SET has_derivatives = 1 WHERE hash = ?", (digest,))
     conn.commit()
-    return cursor.lastrowid
+    post_ids = [row["id"] for row in conn.execute("SELECT id FROM posts WHERE file_hash = ?", (digest,))]
+    pool_ids = pools_containing(conn.cursor(), post_ids)
+    conn.close()
+    
+    # Cached responses (including pool covers) still point at the original image
+    post_cache.invalidate(post_ids)
+    if pool_ids:
+        pool_cache.invalidate(["pools", *pool_ids])
+
+def pools_containing(cursor, post_ids) -> list:
+    """Ids of the pools that contain any of these posts"""
+    cursor.execute(
+        "SELECT DISTINCT pool_id FROM pool_posts WHERE post_id IN (SELECT value FROM json_each(?))",
+        (json.dumps(list(post_ids)),)
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+def encode_cursor(*values) -> str:
+    """Build an opaque pagination cursor from the sort key of the last post of a page"""
+    raw = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor_value: str, size: int) -> list:
+    """Parse a pagination cursor back into its `size` sort key values"""
+    try:
+        padded = cursor_value + "=" * (-len(cursor_value) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list) or len(values) != size or not all(isinstance(v, (str, int, float)) for v in values):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
 
 def get_current_user(session_token: Optional[str] = Cookie(None)):
     """Dependency to get current user from session"""
-    if not session_token or session_token not in sessions:
+    if not session_token:
         return None
-    return sessions[session_token]
+    return session_store.get(session_token)
 
 def require_auth(session_token: Optional[str] = Cookie(None)):
     """Dependency that requires authentication"""
@@ -102,50 +468,40 @@ def require_auth(session_token: Optional[str] = Cookie(None)):
 @app.post("/api/auth/register", status_code=201)
 async def register(user: UserCreate):
     """Register a new user"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT id FROM users WHERE username = ?", (user.username,))
-    if cursor.fetchone():
-        conn.close()
+    # Database calls go to the request thread pool and hashing to its own pool,
+    # so a burst of registrations/logins never blocks the event loop
+    if await run_in_threadpool(find_user_by_name, user.username):
         raise HTTPException(status_code=409, detail="Username already exists")
     
-    password_hash = hash_password(user.password)
-    created_at = datetime.datetime.now().isoformat()
-    
-    cursor.execute(
-        "INSERT INTO users (username, password_hash, is_admin, created_at) VALUES (?, ?, 0, ?)",
-        (user.username, password_hash, created_at)
-    )
-    conn.commit()
-    user_id = cursor.lastrowid
-    conn.close()
+    password_hash = await hash_password_async(user.password)
+    user_id = await run_in_threadpool(create_user, user.username, password_hash)
+    if user_id is None:
+        raise HTTPException(status_code=409, detail="Username already exists")
     
     return {"id": user_id, "username": user.username, "message": "User created successfully"}
 
 @app.post("/api/auth/login")
 async def login(credentials: UserLogin):
     """Login and create session"""
-    conn = get_db()
-    cursor = conn.cursor()
+    row = await run_in_threadpool(find_user_by_name, credentials.username)
     
-    password_hash = hash_password(credentials.password)
-    cursor.execute(
-        "SELECT id, username, is_admin, created_at FROM users WHERE username = ? AND password_hash = ?",
-        (credentials.username, password_hash)
-    )
-    user = cursor.fetchone()
-    conn.close()
-    
-    if not user:
+    # Unknown usernames are checked against a dummy hash so they take as long as real ones
+    stored_hash = row["password_hash"] if row else DUMMY_HASH
+    valid = await verify_password_async(credentials.password, stored_hash)
+    if not row or not valid:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
+    # Upgrade legacy SHA-256 (or outdated scrypt cost) hashes now that we have the password
+    if needs_rehash(stored_hash):
+        new_hash = await hash_password_async(credentials.password)
+        await run_in_threadpool(update_password_hash, row["id"], new_hash)
+    
     # Create session
-    session_token = secrets.token_hex(32)
-    sessions[session_token] = dict(user)
+    user = {key: row[key] for key in ("id", "username", "is_admin", "created_at")}
+    session_token = await run_in_threadpool(session_store.create, user)
     
     response = JSONResponse(content={
-        "user": dict(user),
+        "user": user,
         "message": "Login successful"
     })
     response.set_cookie(
@@ -157,17 +513,17 @@ async def login(credentials: UserLogin):
     return response
 
 @app.post("/api/auth/logout")
-async def logout(session_token: Optional[str] = Cookie(None)):
+def logout(session_token: Optional[str] = Cookie(None)):
     """Logout and destroy session"""
-    if session_token in sessions:
-        del sessions[session_token]
+    if session_token:
+        session_store.delete(session_token)
     
     response = JSONResponse(content={"message": "Logged out"})
     response.delete_cookie("session_token")
     return response
 
 @app.get("/api/auth/me")
-async def get_me(user = Depends(get_current_user)):
+def get_me(user = Depends(get_current_user)):
     """Get current user info"""
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
@@ -175,125 +531,330 @@ async def get_me(user = Depends(get_current_user)):
 
 # ============== USER ENDPOINTS ==============
 
+def select_users(cursor, limit: int = -1) -> list:
+    """Users in id order (limit -1 means all)"""
+    cursor.execute("SELECT id, username, is_admin, created_at FROM users ORDER BY id LIMIT ?", (limit,))
+    return [dict(u) for u in cursor.fetchall()]
+
 @app.get("/api/users")
-async def list_users():
+def list_users():
     """List all users"""
     conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, username, is_admin, created_at FROM users")
-    users = cursor.fetchall()
+    users = select_users(conn.cursor())
     conn.close()
-    return [dict(u) for u in users]
+    return users
 
 # ============== POST ENDPOINTS ==============
 
+def perceptual_hash(path: str):
+    """dHash of an upload, computed in the image worker processes; None if the image can't be hashed"""
+    try:
+        return derivative_pipeline.run(safe_dhash, path)
+    except Exception:
+        # e.g. its worker process died decoding it; the post is still accepted, just not checked for duplicates
+        logger.warning("Perceptual hashing failed for %s", path, exc_info=True)
+        return None
+
 @app.post("/api/posts", status_code=201)
-async def create_post(
+def create_post(
     image: UploadFile = File(...),
     description: Optional[str] = Form(None),
     tags: str = Form(...),
     user = Depends(require_auth)
 ):
-    """Upload a new post with image and tags"""
-    conn = get_db()
-    cursor = conn.cursor()
+    """Upload a new post with image and tags; thumbnails are rendered in the background
+    
+    The response lists existing posts whose image looks like a near duplicate.
+    """
+    # Stream the image to a temp file, hashing it on the way
+    try:
+        staged = stage_upload(image.file, UPLOAD_DIR, MAX_UPLOAD_BYTES)
+    except UploadTooLarge:
+        raise HTTPException(status_code=413, detail=f"Image is larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+    except UnsupportedImageType:
+        raise HTTPException(status_code=415, detail="Unsupported image type")
+    
+    conn = None
+    try:
+        phash = perceptual_hash(staged.temp_path)
+        conn = get_db()
+        cursor = conn.cursor()
+        
+        # Identical bytes share one blob; this just bumps its reference count
+        filename = add_blob_ref(cursor, staged.digest, blob_path(staged.digest, staged.ext), staged.size)
+        if phash is not None:
+            cursor.execute("UPDATE files SET phash = ? WHERE hash = ? AND phash IS NULL", (phash, staged.digest))
+        
+        # Create post
+        upload_date = datetime.datetime.now().isoformat()
+        cursor.execute(
+            "INSERT INTO posts (image_filename, file_hash, uploader_id, upload_date, description, favorite_count) VALUES (?, ?, ?, ?, ?, 0)",
+            (filename, staged.digest, user["id"], upload_date, description)
+        )
+        post_id = cursor.lastrowid
+        
+        # Add tags: resolved in bulk, all in the same transaction as the post
+        tag_list = split_tags(tags)
+        post_tags = resolve_tags(cursor, tag_list)
+        insert_post_tags(cursor, post_id, post_tags.values())
+        count_tag_pairs(cursor, [post_tags.values()])
+        
+        conn.commit()
+    except Exception:
+        if conn is not None:
+            conn.close()
+        staged.discard()
+        raise
+    
+    duplicates = []
+    if phash is not None:
+        duplicates = find_similar_posts(cursor, phash, DUPLICATE_DISTANCE, post_id, UPLOAD_DUPLICATES_LIMIT)
+    index_sync.catch_up(conn)
+    conn.close()
     
-    # Save image file
-    filename = f"{datetime.datetime.now().timestamp()}_{image.filename}"
-    filepath = os.path.join(UPLOAD_DIR, filename)
+    # Only now move the file to its content address (or drop it if already stored)
+    if place_blob(UPLOAD_DIR, staged, filename):
+        derivative_pipeline.submit(staged.digest, filename, mark_derivatives_ready)
+    tag_list_cache.invalidate()
     
-    with open(filepath, "wb") as f:
-        shutil.copyfileobj(image.file, f)
+    return {"id": post_id, "message": "Post created successfully", "tags": tag_list, "duplicates": duplicates}
+
+def find_similar_posts(cursor, phash: int, max_distance: int, exclude_post_id: int, limit: int) -> list:
+    """Posts whose image is within max_distance bits of phash, closest first, each with its `distance`"""
+    distances = dict(perceptual_index.search(phash, max_distance))
+    if not distances:
+        return []
     
-    # Create post
-    upload_date = datetime.datetime.now().isoformat()
-    cursor.execute(
-        "INSERT INTO posts (image_filename, uploader_id, upload_date, description, favorite_count) VALUES (?, ?, ?, ?, 0)",
-        (filename, user["id"], upload_date, description)
+    cursor.execute("""
+        SELECT p.id, p.image_filename, p.uploader_id, u.username as uploader_username,
+               p.upload_date, p.description, p.favorite_count, p.file_hash,
+               COALESCE(fl.has_derivatives, 0) as has_derivatives
+        FROM posts p
+        JOIN users u ON p.uploader_id = u.id
+        LEFT JOIN files fl ON fl.hash = p.file_hash
+        WHERE p.file_hash IN (SELECT value FROM json_each(?)) AND p.id != ?
+    """, (json.dumps(list(distances)), exclude_post_id))
+    
+    posts = sorted(cursor.fetchall(), key=lambda post: (distances[post["file_hash"]], -post["id"]))[:limit]
+    result = build_posts(cursor, posts)
+    for post in result:
+        post["distance"] = distances[post.pop("file_hash")]
+    return result
+
+def tag_filter(required, excluded, optional):
+    """Conditions and params restricting a post listing to a tag query, or None if no post can match
+    
+    A narrow query is evaluated on tag_index and becomes an id list. A broad one
+    becomes EXISTS probes of post_tags' primary key, so the listing walks its
+    order's index and stops after one page instead of encoding every match.
+    """
+    bound = tag_index.match_bound(required, optional)
+    if bound is not None and bound <= TAG_ID_LIST_MAX:
+        post_ids = tag_index.search(required, excluded, optional)
+        if not post_ids:
+            return None
+        return ["p.id IN (SELECT value FROM json_each(?))"], [json.dumps(post_ids)]
+    
+    conditions = []
+    params = []
+    for tag_name in set(required):
+        conditions.append("EXISTS (SELECT 1 FROM post_tags pt WHERE pt.post_id = p.id AND pt.tag_id = ?)")
+        params.append(tag_index.tag_id(tag_name))
+    for negate, names in (("", optional), ("NOT ", excluded)):
+        tag_ids = [tag_id for tag_id in map(tag_index.tag_id, set(names)) if tag_id is not None]
+        if tag_ids:
+            placeholders = ", ".join("?" * len(tag_ids))
+            conditions.append(f"{negate}EXISTS (SELECT 1 FROM post_tags pt WHERE pt.post_id = p.id AND pt.tag_id IN ({placeholders}))")
+            params.extend(tag_ids)
+    return conditions, params
+
+def select_posts(cursor, joins: str, conditions: list, params: list, sort_key: str, order_by: str, limit: int, columns: str = "", tables: str = "posts p") -> list:
+    """One page of the post listing query; each row also carries its sort_key and any extra columns"""
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    cursor.execute(f"""
+        SELECT p.id, p.image_filename, p.uploader_id, u.username as uploader_username,
+               p.upload_date, p.description, p.favorite_count,
+               COALESCE(fl.has_derivatives, 0) as has_derivatives, {sort_key} as sort_key{columns}
+        FROM {tables}
+        {joins}
+        JOIN users u ON p.uploader_id = u.id
+        LEFT JOIN files fl ON fl.hash = p.file_hash
+        {where}
+        ORDER BY {order_by}
+        LIMIT ?
+    """, (*params, limit))
+    return cursor.fetchall()
+
+def select_random_posts(cursor, joins: str, conditions: list, params: list, seed: float, after, limit: int, columns: str = "") -> list:
+    """A page of the shuffle fixed by seed: posts by random_key from seed up to 1, then from 0 up to seed
+    
+    Both halves are range reads on idx_posts_random; `after` is the (random_key, id)
+    of the previous page's last post.
+    """
+    if after is not None and after[0] < seed:
+        halves = ["p.random_key < ?"]  # the previous page already wrapped around
+    else:
+        halves = ["p.random_key >= ?", "p.random_key < ?"]
+    
+    posts = []
+    for i, half in enumerate(halves):
+        half_conditions = [*conditions, half]
+        half_params = [*params, seed]
+        if after is not None and i == 0:
+            half_conditions.append("(p.random_key, p.id) > (?, ?)")
+            half_params.extend(after)
+        posts.extend(select_posts(cursor, joins, half_conditions, half_params, "p.random_key", "p.random_key, p.id", limit - len(posts), columns))
+        if len(posts) >= limit:
+            break
+    return posts
+
+def post_page(cursor, posts, limit: int, cursor_prefix=(), fields=None) -> dict:
+    """Response for a page of post rows fetched with one extra row (which, if present, means there is a next page)"""
+    next_cursor = None
+    if len(posts) > limit:
+        posts = posts[:limit]
+        next_cursor = encode_cursor(*cursor_prefix, posts[-1]["sort_key"], posts[-1]["id"])
+    return {"posts": build_posts(cursor, posts, fields), "next_cursor": next_cursor}
+
+def parse_post_ids(ids: str) -> list:
+    """Parse a comma-separated list of post ids, keeping the first occurrence of each"""
+    try:
+        post_ids = list(dict.fromkeys(int(part) for part in ids.split(",") if part.strip()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be comma-separated integers")
+    if len(post_ids) > MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_PAGE_SIZE} ids per request")
+    return post_ids
+
+def posts_by_ids(cursor, post_ids: list, fields=None) -> list:
+    """Posts with these ids in the order given; ids of missing posts are skipped"""
+    rows = select_posts(
+        cursor, "", ["p.id IN (SELECT value FROM json_each(?))"], [json.dumps(post_ids)],
+        "p.id", "p.id", len(post_ids)
     )
-    post_id = cursor.lastrowid
-    
-    # Add tags
-    tag_list = [t.strip() for t in tags.split(",") if t.strip()]
-    for tag_name in tag_list:
-        tag_id = get_or_create_tag(conn, tag_name)
-        cursor.execute("INSERT INTO post_tags (post_id, tag_id) VALUES (?, ?)", (post_id, tag_id))
-    
-    conn.commit()
-    conn.close()
-    
-    return {"id": post_id, "message": "Post created successfully", "tags": tag_list}
+    position = {post_id: i for i, post_id in enumerate(post_ids)}
+    rows.sort(key=lambda row: position[row["id"]])
+    return build_posts(cursor, rows, fields)
 
 @app.get("/api/posts")
-async def list_posts(tag: Optional[str] = None, user_id: Optional[int] = None):
-    """List all posts, optionally filtered by tag or user"""
+def list_posts(
+    ids: Optional[str] = None,
+    tag: Optional[str] = None,
+    tags: Optional[str] = None,
+    user_id: Optional[int] = None,
+    q: Optional[str] = None,
+    order: Optional[str] = Query(None, pattern="^(new|popular|trending|random|relevance)$"),
+    seed: Optional[float] = Query(None, ge=0, lt=1),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    before: Optional[str] = None,
+    fields: Optional[str] = None
+):
+    """List posts one page at a time, optionally filtered by tag, user or description text
+    
+    `ids` (e.g. `ids=3,1,2`) instead fetches up to MAX_PAGE_SIZE posts by id, in
+    that order, skipping ones that don't exist; other parameters are ignored.
+    
+    `tag` matches one exact tag name. `tags` is a search query such as
+    `sheep wool -nsfw ~meme ~"sailor moon"`: plain terms are ANDed, `-` excludes
+    a tag and at least one `~` term must match. `q` searches descriptions for
+    all of its words (the last one as a prefix) and adds a highlighted `snippet`.
+    
+    `order` is `new` (the default without `q`), `relevance` (BM25, the default
+    with `q`), `popular` (most favorited), `trending` (favorites over the last
+    week with time decay, refreshed every few minutes) or `random` (a shuffle
+    that stays the same for a given `seed`).
+    
+    `fields` (e.g. `id,image_filename,favorite_count`) returns only those fields
+    of each post.
+    """
+    fields = parse_fields(fields, POST_FIELDS)
+    if ids is not None:
+        post_ids = parse_post_ids(ids)
+        if not post_ids:
+            return {"posts": [], "next_cursor": None}
+        conn = get_db()
+        posts = posts_by_ids(conn.cursor(), post_ids, fields)
+        conn.close()
+        return FastJSONResponse({"posts": posts, "next_cursor": None})
+    
+    conditions = []
+    params = []
+    text_join = columns = ""
+    match = fts_query(q)
+    if match:
+        text_join = "JOIN posts_fts ON posts_fts.rowid = p.id"
+        columns = f", {snippet_sql('posts_fts', 0)} as snippet"
+        conditions.append("posts_fts MATCH ?")
+        params.append(match)
+    order = order or ("relevance" if match else "new")
+    if order == "relevance" and not match:
+        raise HTTPException(status_code=400, detail="order=relevance needs a q search")
+
+    required, excluded, optional = parse_tag_query(tags)
+    if tag:
+        required.append(tag.strip().lower())
+    if required or excluded or optional:
+        tag_conditions = tag_filter(required, excluded, optional)
+        if tag_conditions is None:
+            return {"posts": [], "next_cursor": None}
+        conditions.extend(tag_conditions[0])
+        params.extend(tag_conditions[1])
+    if user_id:
+        conditions.append("p.uploader_id = ?")
+        params.append(user_id)
+    
+    # Cursors are decoded (and rejected) before a connection is taken
+    if order == "random":
+        after = None
+        if before:
+            seed, *after = decode_cursor(before, 3)
+        elif seed is None:
+            seed = random.random()
+    else:
+        sort_key, tiebreak, tables = RANKED_ORDERS[order]
+        if before:
+            # Keyset pagination: continue strictly after the last post of the previous page
+            conditions.append(f"({sort_key}, {tiebreak}) < (?, ?)")
+            params.extend(decode_cursor(before, 2))
+    
     conn = get_db()
     cursor = conn.cursor()
     
-    if tag:
-        query = """
-            SELECT DISTINCT p.id, p.image_filename, p.uploader_id, u.username as uploader_username,
-                   p.upload_date, p.description, p.favorite_count
-            FROM posts p
-            JOIN users u ON p.uploader_id = u.id
-            JOIN post_tags pt ON p.id = pt.post_id
-            JOIN tags t ON pt.tag_id = t.id
-            WHERE t.tag_name = ?
-            ORDER BY p.upload_date DESC
-        """
-        cursor.execute(query, (tag.lower(),))
-    elif user_id:
-        query = """
-            SELECT p.id, p.image_filename, p.uploader_id, u.username as uploader_username,
-                   p.upload_date, p.description, p.favorite_count
-            FROM posts p
-            JOIN users u ON p.uploader_id = u.id
-            WHERE p.uploader_id = ?
-            ORDER BY p.upload_date DESC
-        """
-        cursor.execute(query, (user_id,))
+    # Fetch one extra row to know whether another page exists
+    if order == "random":
+        posts = select_random_posts(cursor, text_join, conditions, params, seed, after, limit + 1, columns)
+        cursor_prefix = [seed]
     else:
-        query = """
-            SELECT p.id, p.image_filename, p.uploader_id, u.username as uploader_username,
-                   p.upload_date, p.description, p.favorite_count
-            FROM posts p
-            JOIN users u ON p.uploader_id = u.id
-            ORDER BY p.upload_date DESC
-        """
-        cursor.execute(query)
+        posts = select_posts(cursor, text_join, conditions, params, sort_key, f"{sort_key} DESC, {tiebreak} DESC", limit + 1, columns, tables)
+        cursor_prefix = []
     
-    posts = cursor.fetchall()
-    
-    # Get tags for each post
-    result = []
-    for post in posts:
-        cursor.execute("""
-            SELECT t.tag_name
-            FROM tags t
-            JOIN post_tags pt ON t.id = pt.tag_id
-            WHERE pt.post_id = ?
-        """, (post["id"],))
-        tags = [row["tag_name"] for row in cursor.fetchall()]
-        
-        result.append({
-            **dict(post),
-            "tags": tags
-        })
+    page = post_page(cursor, posts, limit, cursor_prefix, fields)
+    if match and (fields is None or "snippet" in fields):
+        for post in page["posts"]:
+            post["snippet"] = highlight(post["snippet"])
     
     conn.close()
-    return result
+    return FastJSONResponse(page)
 
 @app.get("/api/posts/{post_id}")
-async def get_post(post_id: int, current_user = Depends(get_current_user)):
-    """Get a specific post with all details"""
+def get_post(post_id: int, request: Request, current_user = Depends(get_current_user)):
+    """Get a specific post with all details (cached for anonymous users, supports conditional GETs)"""
+    if current_user is None:
+        entry = post_cache.get(post_id)
+        if entry is not None:
+            return cached_json_response(request, entry)
+    
+    generation = post_cache.generation
     conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute("""
         SELECT p.id, p.image_filename, p.uploader_id, u.username as uploader_username,
-               p.upload_date, p.description, p.favorite_count
+               p.upload_date, p.description, p.favorite_count,
+               COALESCE(fl.has_derivatives, 0) as has_derivatives
         FROM posts p
         JOIN users u ON p.uploader_id = u.id
+        LEFT JOIN files fl ON fl.hash = p.file_hash
         WHERE p.id = ?
     """, (post_id,))
     
@@ -302,15 +863,6 @@ async def get_post(post_id: int, current_user = Depends(get_current_user)):
         conn.close()
         raise HTTPException(status_code=404, detail="Post not found")
     
-    # Get tags
-    cursor.execute("""
-        SELECT t.tag_name
-        FROM tags t
-        JOIN post_tags pt ON t.id = pt.tag_id
-        WHERE pt.post_id = ?
-    """, (post_id,))
-    tags = [row["tag_name"] for row in cursor.fetchall()]
-    
     # Get pools this post belongs to
     cursor.execute("""
         SELECT p.id, p.name
@@ -329,22 +881,94 @@ async def get_post(post_id: int, current_user = Depends(get_current_user)):
         )
         is_favorited = cursor.fetchone() is not None
     
+    result = build_posts(cursor, [post])[0]
+    result["pools"] = pools
+    result["is_favorited"] = is_favorited
     conn.close()
     
-    return {
-        **dict(post),
-        "tags": tags,
-        "pools": pools,
-        "is_favorited": is_favorited
-    }
+    body = dumps(result)
+    
+    # is_favorited depends on the viewer, so only anonymous responses are shared
+    if current_user is None:
+        return cached_json_response(request, post_cache.put(post_id, body, generation))
+    return cached_json_response(request, CachedBody(body))
+
+@app.get("/api/posts/{post_id}/similar")
+def get_similar_posts(
+    post_id: int,
+    max_distance: int = Query(DUPLICATE_DISTANCE, ge=0, le=MAX_DISTANCE),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)
+):
+    """Posts whose image looks like this post's (perceptual hash within max_distance bits), closest first"""
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    cursor.execute("""
+        SELECT fl.phash FROM posts p
+        LEFT JOIN files fl ON fl.hash = p.file_hash
+        WHERE p.id = ?
+    """, (post_id,))
+    post = cursor.fetchone()
+    if not post:
+        conn.close()
+        raise HTTPException(status_code=404, detail="Post not found")
+    
+    result = []
+    if post["phash"] is not None:
+        result = find_similar_posts(cursor, post["phash"], max_distance, post_id, limit)
+    
+    conn.close()
+    return result
+
+@app.get("/api/posts/{post_id}/recommended")
+def get_recommended_posts(
+    post_id: int,
+    limit: int = Query(RECOMMENDED_PAGE_SIZE, ge=1, le=TOP_K),
+    fields: Optional[str] = None
+):
+    """Posts favorited by the users who favorited this one, most similar first, each with its `score`
+    
+    Read from post_similar, which a scheduled job keeps up to date (see
+    recommendations.py); posts without enough favorites have none.
+    """
+    fields = parse_fields(fields, POST_FIELDS)
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    cursor.execute("""
+        SELECT p.id, p.image_filename, p.uploader_id, u.username as uploader_username,
+               p.upload_date, p.description, p.favorite_count,
+               COALESCE(fl.has_derivatives, 0) as has_derivatives, s.score
+        FROM post_similar s
+        JOIN posts p ON p.id = s.similar_post_id
+        JOIN users u ON p.uploader_id = u.id
+        LEFT JOIN files fl ON fl.hash = p.file_hash
+        WHERE s.post_id = ?
+        ORDER BY s.rank
+        LIMIT ?
+    """, (post_id, limit))
+    posts = cursor.fetchall()
+    
+    # An empty list is either a post without recommendations or no such post
+    if not posts:
+        cursor.execute("SELECT 1 FROM posts WHERE id = ?", (post_id,))
+        exists = cursor.fetchone()
+        conn.close()
+        if not exists:
+            raise HTTPException(status_code=404, detail="Post not found")
+        return []
+    
+    result = build_posts(cursor, posts, fields)
+    conn.close()
+    return FastJSONResponse(result)
 
 @app.delete("/api/posts/{post_id}")
-async def delete_post(post_id: int, user = Depends(require_auth)):
+def delete_post(post_id: int, user = Depends(require_auth)):
     """Delete a post and its image file"""
     conn = get_db()
     cursor = conn.cursor()
     
-    cursor.execute("SELECT image_filename, uploader_id FROM posts WHERE id = ?", (post_id,))
+    cursor.execute("SELECT image_filename, file_hash, uploader_id FROM posts WHERE id = ?", (post_id,))
     post = cursor.fetchone()
     
     if not post:
@@ -356,25 +980,48 @@ async def delete_post(post_id: int, user = Depends(require_auth)):
         conn.close()
         raise HTTPException(status_code=403, detail="Not authorized to delete this post")
     
-    # Delete image file
-    filepath = os.path.join(UPLOAD_DIR, post["image_filename"])
-    if os.path.exists(filepath):
-        os.remove(filepath)
+    cursor.execute("SELECT tag_id FROM post_tags WHERE post_id = ?", (post_id,))
+    tag_ids = [row["tag_id"] for row in cursor.fetchall()]
+    pool_ids = pools_containing(cursor, [post_id])
     
     # Delete post (CASCADE will handle favorites, post_tags, pool_posts)
     cursor.execute("DELETE FROM posts WHERE id = ?", (post_id,))
+    uncount_tag_pairs(cursor, [tag_ids])
+    last_ref = post["file_hash"] is not None and release_blob_ref(cursor, post["file_hash"])
     conn.commit()
+    
+    # Delete the image file once no other post shares it
+    if last_ref and remove_blob(conn, UPLOAD_DIR, post["file_hash"], post["image_filename"]):
+        remove_derivatives(UPLOAD_DIR, post["image_filename"])
+    elif post["file_hash"] is None:
+        filepath = os.path.join(UPLOAD_DIR, post["image_filename"])
+        if os.path.exists(filepath):
+            os.remove(filepath)
+    index_sync.catch_up(conn)
     conn.close()
     
+    tag_list_cache.invalidate()
+    post_cache.invalidate([post_id])
+    if pool_ids:
+        pool_cache.invalidate(["pools", *pool_ids])
+    
     return {"message": "Post deleted successfully"}
 
 # ============== FAVORITE ENDPOINTS ==============
 
 @app.post("/api/posts/{post_id}/favorite")
-async def toggle_favorite(post_id: int, user = Depends(require_auth)):
-    """Toggle favorite status for a post"""
+def toggle_favorite(post_id: int, user = Depends(require_auth)):
+    """Toggle favorite status for a post
+    
+    The transaction starts with BEGIN IMMEDIATE, so it holds SQLite's write lock
+    from the start: concurrent clicks are applied one after the other, and the
+    post can't be deleted between the check below and the insert. The post's
+    favorite_count delta is committed with the favorites row and applied in a
+    later batch (see favorites.py).
+    """
     conn = get_db()
     cursor = conn.cursor()
+    conn.execute("BEGIN IMMEDIATE")
     
     # Check if post exists
     cursor.execute("SELECT id FROM posts WHERE id = ?", (post_id,))
@@ -382,94 +1029,61 @@ async def toggle_favorite(post_id: int, user = Depends(require_auth)):
         conn.close()
         raise HTTPException(status_code=404, detail="Post not found")
     
-    # Check if already favorited
+    # Unfavorite if it was favorited, otherwise favorite
     cursor.execute(
-        "SELECT 1 FROM favorites WHERE user_id = ? AND post_id = ?",
+        "DELETE FROM favorites WHERE user_id = ? AND post_id = ? RETURNING post_id",
         (user["id"], post_id)
     )
-    is_favorited = cursor.fetchone() is not None
-    
-    if is_favorited:
-        # Unfavorite
-        cursor.execute(
-            "DELETE FROM favorites WHERE user_id = ? AND post_id = ?",
-            (user["id"], post_id)
-        )
-        cursor.execute(
-            "UPDATE posts SET favorite_count = favorite_count - 1 WHERE id = ?",
-            (post_id,)
-        )
-        message = "Unfavorited"
-        new_status = False
-    else:
-        # Favorite
+    new_status = not cursor.fetchall()
+    if new_status:
         favorited_at = datetime.datetime.now().isoformat()
         cursor.execute(
             "INSERT INTO favorites (user_id, post_id, favorited_at) VALUES (?, ?, ?)",
             (user["id"], post_id, favorited_at)
         )
-        cursor.execute(
-            "UPDATE posts SET favorite_count = favorite_count + 1 WHERE id = ?",
-            (post_id,)
-        )
-        message = "Favorited"
-        new_status = True
-    
+    add_favorite_delta(cursor, post_id, 1 if new_status else -1)
     conn.commit()
     
-    # Get updated count
-    cursor.execute("SELECT favorite_count FROM posts WHERE id = ?", (post_id,))
-    favorite_count = cursor.fetchone()["favorite_count"]
-    
+    favorite_count = current_favorite_count(cursor, post_id)
     conn.close()
     
+    # Everything the UI shows for the button, so it doesn't need to refetch the post
     return {
-        "message": message,
+        "message": "Favorited" if new_status else "Unfavorited",
+        "post_id": post_id,
         "is_favorited": new_status,
         "favorite_count": favorite_count
     }
 
-@app.get("/api/users/{user_id}/favorites")
-async def get_user_favorites(user_id: int):
-    """Get all posts favorited by a user"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
+def select_favorite_posts(cursor, user_id: int, limit: int = -1, fields=None) -> list:
+    """Posts a user favorited, most recent first (limit -1 means all)"""
     cursor.execute("""
         SELECT p.id, p.image_filename, p.uploader_id, u.username as uploader_username,
-               p.upload_date, p.description, p.favorite_count
+               p.upload_date, p.description, p.favorite_count,
+               COALESCE(fl.has_derivatives, 0) as has_derivatives
         FROM posts p
         JOIN users u ON p.uploader_id = u.id
+        LEFT JOIN files fl ON fl.hash = p.file_hash
         JOIN favorites f ON p.id = f.post_id
         WHERE f.user_id = ?
         ORDER BY f.favorited_at DESC
-    """, (user_id,))
-    
-    posts = cursor.fetchall()
-    
-    # Get tags for each post
-    result = []
-    for post in posts:
-        cursor.execute("""
-            SELECT t.tag_name
-            FROM tags t
-            JOIN post_tags pt ON t.id = pt.tag_id
-            WHERE pt.post_id = ?
-        """, (post["id"],))
-        tags = [row["tag_name"] for row in cursor.fetchall()]
-        
-        result.append({
-            **dict(post),
-            "tags": tags
-        })
-    
+        LIMIT ?
+    """, (user_id, limit))
+    return build_posts(cursor, cursor.fetchall(), fields)
+
+@app.get("/api/users/{user_id}/favorites")
+def get_user_favorites(user_id: int, fields: Optional[str] = None):
+    """Get all posts favorited by a user (`fields` selects post fields as in GET /api/posts)"""
+    fields = parse_fields(fields, POST_FIELDS)
+    conn = get_db()
+    result = select_favorite_posts(conn.cursor(), user_id, fields=fields)
     conn.close()
-    return result
+    return FastJSONResponse(result)
 
 # ============== POOL ENDPOINTS ==============
 
 @app.post("/api/pools", status_code=201)
-async def create_pool(pool: PoolCreate, user = Depends(require_auth)):
+def create_pool(pool: PoolCreate, user = Depends(require_auth)):
     """Create a new pool"""
     conn = get_db()
     cursor = conn.cursor()
@@ -483,43 +1097,124 @@ async def create_pool(pool: PoolCreate, user = Depends(require_auth)):
     conn.commit()
     conn.close()
     
+    pool_cache.invalidate(["pools"])
+    
     return {"id": pool_id, "name": pool.name, "message": "Pool created successfully"}
 
+def pool_summary(row) -> dict:
+    """A pool listing row as returned by the API, with its cover image URLs"""
+    pool = dict(row)
+    cover_id = pool.pop("cover_post_id")
+    cover_filename = pool.pop("cover_filename")
+    has_derivatives = pool.pop("cover_has_derivatives")
+    pool["cover_post"] = None
+    if cover_id is not None:
+        pool["cover_post"] = {"id": cover_id, **image_urls(cover_filename, has_derivatives)}
+    return pool
+
 @app.get("/api/pools")
-async def list_pools():
-    """List all pools"""
+def list_pools(
+    request: Request,
+    q: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)
+):
+    """List all pools with their post counts and cover images (cached, supports conditional GETs)
+    
+    With `q`, returns up to `limit` pools whose name or description contains all
+    of its words, best match (BM25) first, each with a highlighted `snippet`.
+    """
+    match = fts_query(q)
+    if match:
+        return search_pools(match, limit)
+    
+    entry = pool_cache.get("pools")
+    if entry is not None:
+        return cached_json_response(request, entry)
+    
+    generation = pool_cache.generation
     conn = get_db()
-    cursor = conn.cursor()
+    result = select_pools(conn.cursor())
+    conn.close()
+    return cached_json_response(request, pool_cache.put("pools", dumps(result), generation))
+
+def select_pools(cursor, limit: int = -1) -> list:
+    """Pools with their post counts and covers, newest first (limit -1 means all)"""
+    # post_count and cover_post_id are maintained by triggers on pool_posts
     cursor.execute("""
         SELECT p.id, p.name, p.description, p.creator_id, u.username as creator_username,
-               p.created_at
+               p.created_at, p.post_count, p.cover_post_id, cp.image_filename as cover_filename,
+               COALESCE(fl.has_derivatives, 0) as cover_has_derivatives
         FROM pools p
         JOIN users u ON p.creator_id = u.id
+        LEFT JOIN posts cp ON cp.id = p.cover_post_id
+        LEFT JOIN files fl ON fl.hash = cp.file_hash
         ORDER BY p.created_at DESC
-    """)
+        LIMIT ?
+    """, (limit,))
+    return [pool_summary(row) for row in cursor.fetchall()]
 
-    pools = cursor.fetchall()
+def search_pools(match: str, limit: int) -> list:
+    """Pools matching an FTS5 query, best first"""
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    cursor.execute(f"""
+        SELECT p.id, p.name, p.description, p.creator_id, u.username as creator_username,
+               p.created_at, p.post_count, p.cover_post_id, cp.image_filename as cover_filename,
+               COALESCE(fl.has_derivatives, 0) as cover_has_derivatives,
+               {snippet_sql('pools_fts', -1)} as snippet
+        FROM pools_fts
+        JOIN pools p ON p.id = pools_fts.rowid
+        JOIN users u ON p.creator_id = u.id
+        LEFT JOIN posts cp ON cp.id = p.cover_post_id
+        LEFT JOIN files fl ON fl.hash = cp.file_hash
+        WHERE pools_fts MATCH ?
+        ORDER BY pools_fts.rank
+        LIMIT ?
+    """, (match, limit))
+    
     result = []
-    for p in pools:
-        pool = dict(p)
-        # compute post count explicitly to avoid any GROUP BY surprising behavior
-        cursor.execute("SELECT COUNT(*) as cnt FROM pool_posts WHERE pool_id = ?", (pool['id'],))
-        cnt = cursor.fetchone()["cnt"]
-        pool['post_count'] = int(cnt)
+    for row in cursor.fetchall():
+        pool = pool_summary(row)
+        pool["snippet"] = highlight(pool["snippet"])
         result.append(pool)
-
+    
     conn.close()
     return result
 
 @app.get("/api/pools/{pool_id}")
-async def get_pool(pool_id: int):
-    """Get a specific pool with its posts in order"""
+def get_pool(
+    pool_id: int,
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    fields: Optional[str] = None
+):
+    """Get a pool and one page of its posts in order (first pages are cached, supports conditional GETs)
+    
+    `fields` selects post fields as in GET /api/posts.
+    """
+    fields = parse_fields(fields, POST_FIELDS)
+    cacheable = after is None and limit == DEFAULT_PAGE_SIZE and fields is None
+    if cacheable:
+        entry = pool_cache.get(pool_id)
+        if entry is not None:
+            return cached_json_response(request, entry)
+    
+    # Keyset pagination over idx_pool_posts_order
+    conditions = ["pp.pool_id = ?"]
+    params = [pool_id]
+    if after:
+        conditions.append("(pp.order_index, pp.post_id) > (?, ?)")
+        params.extend(decode_cursor(after, 2))
+    
+    generation = pool_cache.generation
     conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute("""
         SELECT p.id, p.name, p.description, p.creator_id, u.username as creator_username,
-               p.created_at
+               p.created_at, p.post_count
         FROM pools p
         JOIN users u ON p.creator_id = u.id
         WHERE p.id = ?
@@ -530,45 +1225,40 @@ async def get_pool(pool_id: int):
         conn.close()
         raise HTTPException(status_code=404, detail="Pool not found")
     
-    # Get posts in order
-    cursor.execute("""
+    cursor.execute(f"""
         SELECT p.id, p.image_filename, p.uploader_id, u.username as uploader_username,
-               p.upload_date, p.description, p.favorite_count, pp.order_index
-        FROM posts p
+               p.upload_date, p.description, p.favorite_count, pp.order_index,
+               COALESCE(fl.has_derivatives, 0) as has_derivatives
+        FROM pool_posts pp
+        JOIN posts p ON p.id = pp.post_id
         JOIN users u ON p.uploader_id = u.id
-        JOIN pool_posts pp ON p.id = pp.post_id
-        WHERE pp.pool_id = ?
-        ORDER BY pp.order_index
-    """, (pool_id,))
+        LEFT JOIN files fl ON fl.hash = p.file_hash
+        WHERE {' AND '.join(conditions)}
+        ORDER BY pp.order_index, pp.post_id
+        LIMIT ?
+    """, (*params, limit + 1))
     
     posts = cursor.fetchall()
     
-    # Get tags for each post
-    result_posts = []
-    for post in posts:
-        cursor.execute("""
-            SELECT t.tag_name
-            FROM tags t
-            JOIN post_tags pt ON t.id = pt.tag_id
-            WHERE pt.post_id = ?
-        """, (post["id"],))
-        tags = [row["tag_name"] for row in cursor.fetchall()]
-        
-        result_posts.append({
-            **dict(post),
-            "tags": tags
-        })
+    # Fetch one extra row to know whether another page exists
+    next_cursor = None
+    if len(posts) > limit:
+        posts = posts[:limit]
+        next_cursor = encode_cursor(posts[-1]["order_index"], posts[-1]["id"])
+    
+    result = dict(pool)
+    result["posts"] = build_posts(cursor, posts, fields)
+    result["next_cursor"] = next_cursor
     
     conn.close()
     
-    return {
-        **dict(pool),
-        "posts": result_posts,
-        "post_count": len(result_posts)
-    }
+    body = dumps(result)
+    if cacheable:
+        return cached_json_response(request, pool_cache.put(pool_id, body, generation))
+    return cached_json_response(request, CachedBody(body))
 
 @app.post("/api/pools/{pool_id}/posts")
-async def add_post_to_pool(pool_id: int, data: PoolAddPost, user = Depends(require_auth)):
+def add_post_to_pool(pool_id: int, data: PoolAddPost, user = Depends(require_auth)):
     """Add a post to a pool"""
     conn = get_db()
     cursor = conn.cursor()
@@ -600,11 +1290,7 @@ async def add_post_to_pool(pool_id: int, data: PoolAddPost, user = Depends(requi
         raise HTTPException(status_code=409, detail="Post already in pool")
     
     # Get next order index
-    cursor.execute(
-        "SELECT COALESCE(MAX(order_index), -1) + 1 as next_index FROM pool_posts WHERE pool_id = ?",
-        (pool_id,)
-    )
-    next_index = cursor.fetchone()["next_index"]
+    next_index = append_key(cursor, pool_id)
     
     # Add to pool
     cursor.execute(
@@ -614,10 +1300,66 @@ async def add_post_to_pool(pool_id: int, data: PoolAddPost, user = Depends(requi
     conn.commit()
     conn.close()
     
+    pool_cache.invalidate(["pools", pool_id])
+    post_cache.invalidate([data.post_id])
+    
     return {"message": "Post added to pool", "order_index": next_index}
 
+@app.patch("/api/pools/{pool_id}/posts/{post_id}")
+def move_post_in_pool(pool_id: int, post_id: int, data: PoolMovePost, user = Depends(require_auth)):
+    """Move a post (or insert it) so it directly follows after_post_id, or comes first if that is null
+    
+    Only the moved post's row is written; the pool is respaced only when its gaps run out.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    # Check if pool exists and user is creator
+    cursor.execute("SELECT creator_id FROM pools WHERE id = ?", (pool_id,))
+    pool = cursor.fetchone()
+    if not pool:
+        conn.close()
+        raise HTTPException(status_code=404, detail="Pool not found")
+    
+    if pool["creator_id"] != user["id"] and not user.get("is_admin"):
+        conn.close()
+        raise HTTPException(status_code=403, detail="Only pool creator can reorder posts")
+    
+    # Check if post exists
+    cursor.execute("SELECT id FROM posts WHERE id = ?", (post_id,))
+    if not cursor.fetchone():
+        conn.close()
+        raise HTTPException(status_code=404, detail="Post not found")
+    
+    if data.after_post_id == post_id:
+        conn.close()
+        raise HTTPException(status_code=400, detail="Cannot place a post after itself")
+    
+    if data.after_post_id is not None:
+        cursor.execute(
+            "SELECT 1 FROM pool_posts WHERE pool_id = ? AND post_id = ?",
+            (pool_id, data.after_post_id)
+        )
+        if not cursor.fetchone():
+            conn.close()
+            raise HTTPException(status_code=404, detail="after_post_id is not in this pool")
+    
+    order_index = place_after(cursor, pool_id, post_id, data.after_post_id)
+    cursor.execute(
+        """INSERT INTO pool_posts (pool_id, post_id, order_index) VALUES (?, ?, ?)
+           ON CONFLICT (pool_id, post_id) DO UPDATE SET order_index = excluded.order_index""",
+        (pool_id, post_id, order_index)
+    )
+    conn.commit()
+    conn.close()
+    
+    pool_cache.invalidate(["pools", pool_id])
+    post_cache.invalidate([post_id])
+    
+    return {"message": "Post moved", "order_index": order_index}
+
 @app.delete("/api/pools/{pool_id}/posts/{post_id}")
-async def remove_post_from_pool(pool_id: int, post_id: int, user = Depends(require_auth)):
+def remove_post_from_pool(pool_id: int, post_id: int, user = Depends(require_auth)):
     """Remove a post from a pool"""
     conn = get_db()
     cursor = conn.cursor()
@@ -646,10 +1388,13 @@ async def remove_post_from_pool(pool_id: int, post_id: int, user = Depends(requi
     conn.commit()
     conn.close()
     
+    pool_cache.invalidate(["pools", pool_id])
+    post_cache.invalidate([post_id])
+    
     return {"message": "Post removed from pool"}
 
 @app.delete("/api/pools/{pool_id}")
-async def delete_pool(pool_id: int, user = Depends(require_auth)):
+def delete_pool(pool_id: int, user = Depends(require_auth)):
     """Delete a pool"""
     conn = get_db()
     cursor = conn.cursor()
@@ -665,37 +1410,115 @@ async def delete_pool(pool_id: int, user = Depends(require_auth)):
         conn.close()
         raise HTTPException(status_code=403, detail="Only pool creator can delete pool")
     
+    cursor.execute("SELECT post_id FROM pool_posts WHERE pool_id = ?", (pool_id,))
+    post_ids = [row["post_id"] for row in cursor.fetchall()]
+    
     cursor.execute("DELETE FROM pools WHERE id = ?", (pool_id,))
     conn.commit()
     conn.close()
     
+    pool_cache.invalidate(["pools", pool_id])
+    post_cache.invalidate(post_ids)
+    
     return {"message": "Pool deleted successfully"}
 
 # ============== TAG ENDPOINTS ==============
 
+def select_tags(cursor, limit: int = -1) -> list:
+    """Tags with post counts, most used first (limit -1 means all)"""
+    # post_count is maintained by triggers on post_tags, so this is an index scan
+    cursor.execute("""
+        SELECT id, tag_name, post_count
+        FROM tags
+        ORDER BY post_count DESC, tag_name
+        LIMIT ?
+    """, (limit,))
+    return [dict(t) for t in cursor.fetchall()]
+
 @app.get("/api/tags")
-async def list_tags():
-    """List all tags with post counts"""
+def list_tags(request: Request):
+    """List all tags with post counts (cached, supports If-None-Match)"""
+    entry = tag_list_cache.get("tags")
+    if entry is None:
+        generation = tag_list_cache.generation
+        conn = get_db()
+        tags = select_tags(conn.cursor())
+        conn.close()
+        
+        body = dumps(tags)
+        entry = tag_list_cache.put("tags", body, generation)
+    
+    return cached_json_response(request, entry)
+
+@app.get("/api/tags/autocomplete")
+def autocomplete_tags(q: str, limit: int = Query(10, ge=1, le=MAX_SUGGESTIONS)):
+    """Suggest tags starting with a prefix, most used first"""
+    return tag_autocomplete.suggest(q, limit)
+
+@app.get("/api/tags/{tag_name:path}/related")
+def get_related_tags(
+    tag_name: str,
+    limit: int = Query(20, ge=1, le=MAX_RELATED_TAGS),
+    order: str = Query("count", pattern="^(count|pmi)$")
+):
+    """Tags that appear on the same posts as a tag
+    
+    `order` is `count` (most shared posts first) or `pmi` (pointwise mutual
+    information, favouring tags that rarely appear without this one; ranked
+    among its most frequent companions). Either way each tag has its
+    post_count, the number of posts it shares (`cooccurrences`) and its `pmi`.
+    """
     conn = get_db()
     cursor = conn.cursor()
+    cursor.execute("SELECT id, post_count FROM tags WHERE tag_name = ?", (tag_name.strip().lower(),))
+    tag = cursor.fetchone()
+    if not tag:
+        conn.close()
+        raise HTTPException(status_code=404, detail="Tag not found")
     
-    cursor.execute("""
-        SELECT t.id, t.tag_name, COUNT(pt.post_id) as post_count
-        FROM tags t
-        LEFT JOIN post_tags pt ON t.id = pt.tag_id
-        GROUP BY t.id, t.tag_name
-        ORDER BY post_count DESC, t.tag_name
-    """)
-    
-    tags = cursor.fetchall()
+    # The tag index already holds every post id, so the total needs no COUNT(*)
+    result = related_tags(cursor, tag["id"], tag["post_count"], len(tag_index.all_posts), limit, order)
     conn.close()
+    return result
+
+# ============== BOOTSTRAP ==============
+
+@app.get("/api/bootstrap")
+def bootstrap(current_user = Depends(get_current_user)):
+    """Everything the frontend shows on load, in one response on one connection
+    
+    The first page of posts, the most used tags, the newest pools, the first
+    users, and for a signed-in viewer their profile and latest favorites. Each
+    list is what its own endpoint returns, cut to a page.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
     
-    return [dict(t) for t in tags]
+    sort_key, tiebreak, _ = RANKED_ORDERS["new"]
+    posts = select_posts(cursor, "", [], [], sort_key, f"{sort_key} DESC, {tiebreak} DESC", DEFAULT_PAGE_SIZE + 1)
+    result = {
+        "user": current_user,
+        "posts": post_page(cursor, posts, DEFAULT_PAGE_SIZE),
+        "tags": select_tags(cursor, BOOTSTRAP_LIST_SIZE),
+        "pools": select_pools(cursor, BOOTSTRAP_LIST_SIZE),
+        "users": select_users(cursor, BOOTSTRAP_LIST_SIZE),
+        "favorites": select_favorite_posts(cursor, current_user["id"], BOOTSTRAP_LIST_SIZE) if current_user else [],
+    }
+    
+    conn.close()
+    return FastJSONResponse(result)
+
+# ============== METRICS ==============
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Request, latency and query metrics in Prometheus text format"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 # ============== ROOT ==============
 
 @app.get("/")
-async def root():
+def root():
     return {
         "name": "SheepBooru API 🐏",
         "version": "2.0",
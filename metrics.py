@@ -0,0 +1,296 @@
+"""Request and query instrumentation, exported in Prometheus text format.
+
+MetricsMiddleware times every request under its route template (so /api/posts/1
+and /api/posts/2 share a series) and counts the SQL statements it ran. Queries
+are counted and timed by InstrumentedConnection, the connection class every
+pooled connection uses. A request's queries are attributed to it through a
+context variable that follows the request into the worker thread. Statements
+slower than SLOW_QUERY_SECONDS are logged with their EXPLAIN QUERY PLAN.
+
+A queries-per-request histogram that creeps up on a listing route is the
+signature of an N+1 loop.
+"""
+import bisect
+import contextvars
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger("sheepbooru.sql")
+
+# Statements that take longer than this (execute plus fetching) are logged with their query plan
+SLOW_QUERY_SECONDS = 0.1
+
+# Upper bounds of the request latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds of the queries-per-request histogram buckets
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+
+# Upper bounds of the per-statement latency histogram buckets, in seconds
+QUERY_LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values)) + "}"
+
+def format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """A named metric family with one series per combination of label values"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        with self.lock:
+            series = sorted(self.series.items())
+        return self.header() + [f"{self.name}{format_labels(self.labels, key)} {format_value(value)}" for key, value in series]
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.series.get(label_values)
+            if entry is None:
+                entry = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> list:
+        with self.lock:
+            series = sorted((key, ([*counts], total, count)) for key, (counts, total, count) in self.series.items())
+        lines = self.header()
+        for key, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float("inf")), counts):
+                cumulative += bucket_count
+                labels = format_labels((*self.labels, "le"), (*key, format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    "sheepbooru_http_requests_total", "HTTP responses by route and status", ("method", "route", "status")))
+http_request_duration = registry.register(Histogram(
+    "sheepbooru_http_request_duration_seconds", "Time from request start to the end of the response body", ("method", "route")))
+http_in_flight = registry.register(Gauge(
+    "sheepbooru_http_requests_in_flight", "Requests currently being handled"))
+http_request_queries = registry.register(Histogram(
+    "sheepbooru_http_request_queries", "SQL statements executed per request", ("method", "route"), QUERY_COUNT_BUCKETS))
+db_query_duration = registry.register(Histogram(
+    "sheepbooru_db_query_duration_seconds", "Time spent executing and fetching each SQL statement", (), QUERY_LATENCY_BUCKETS))
+db_slow_queries = registry.register(Counter(
+    "sheepbooru_db_slow_queries_total", "Statements slower than the slow query threshold", ("route",)))
+
+# ============== PER-REQUEST QUERY TRACKING ==============
+
+class RequestStats:
+    """Queries run on behalf of one request; shared with the worker thread that handles it"""
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.queries = 0
+
+    @property
+    def route(self) -> str:
+        return route_name(self.scope)
+
+current_request = contextvars.ContextVar("current_request", default=None)
+
+def explain(conn, sql: str, params) -> str:
+    """EXPLAIN QUERY PLAN of a statement, one detail line per step"""
+    try:
+        # Straight to sqlite3 so the EXPLAIN itself isn't counted or timed
+        rows = sqlite3.Connection.execute(conn, f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    except sqlite3.Error as e:
+        return f"(no plan: {e})"
+    return "\n".join(f"    {row[3]}" for row in rows)
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that counts its statements and times each one from execute through its last fetch
+
+    A statement is finished (timed and, if slow, logged) once its rows are
+    exhausted, or when the cursor moves on to another statement or is closed.
+    """
+
+    statement = None
+    elapsed = 0.0
+
+    def execute(self, sql, parameters=()):
+        self.start_statement(sql, parameters)
+        cursor = self.timed(super().execute, sql, parameters)
+        if self.description is None:  # no result rows to fetch
+            self.finish_statement()
+        return cursor
+
+    def executemany(self, sql, seq_of_parameters):
+        self.start_statement(sql, None)
+        cursor = self.timed(super().executemany, sql, seq_of_parameters)
+        self.finish_statement()
+        return cursor
+
+    def fetchone(self):
+        row = self.timed(super().fetchone)
+        if row is None:
+            self.finish_statement()
+        return row
+
+    def fetchmany(self, size=None):
+        return self.timed(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        rows = self.timed(super().fetchall)
+        self.finish_statement()
+        return rows
+
+    def __next__(self):
+        try:
+            return self.timed(super().__next__)
+        except StopIteration:
+            self.finish_statement()
+            raise
+
+    def close(self):
+        self.finish_statement()
+        super().close()
+
+    def __del__(self):
+        self.finish_statement()
+
+    def timed(self, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+    def start_statement(self, sql, parameters):
+        self.finish_statement()
+        self.statement = (sql, parameters)
+        self.elapsed = 0.0
+        stats = current_request.get()
+        if stats is not None:
+            stats.queries += 1
+
+    def finish_statement(self):
+        if self.statement is None:
+            return
+        sql, parameters = self.statement
+        self.statement = None
+        db_query_duration.observe(self.elapsed)
+        if self.elapsed >= SLOW_QUERY_SECONDS:
+            stats = current_request.get()
+            route = stats.route if stats is not None else "background"
+            db_slow_queries.inc(route)
+            plan = explain(self.connection, sql, parameters) if parameters is not None else "    (executemany)"
+            logger.warning("Slow query (%.1f ms, %s): %s\n%s", self.elapsed * 1000, route, " ".join(sql.split()), plan)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """sqlite3 connection whose cursors (including conn.execute's) are InstrumentedCursors"""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+# ============== MIDDLEWARE ==============
+
+def route_name(scope) -> str:
+    """Route template a request was dispatched to (the mount path for static files)"""
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    if scope.get("endpoint") is not None:  # dispatched to a mounted app, which sets no route
+        return scope.get("root_path") or "unmatched"
+    return "unmatched"
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency, status, in-flight count and query count per route"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(scope)
+        token = current_request.set(stats)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            http_in_flight.dec()
+            current_request.reset(token)
+            method, route = scope["method"], route_name(scope)
+            http_requests.inc(method, route, str(status))
+            http_request_duration.observe(elapsed, method, route)
+            http_request_queries.observe(stats.queries, method, route)
@@ -0,0 +1,59 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# scrypt cost parameters for new hashes (N=2**14, r=8 uses 16 MiB per hash)
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+# Threads doing password hashing; hashlib releases the GIL, so this bounds the CPU logins can take
+HASH_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+
+hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="pwhash")
+
+def b64(data: bytes) -> str:
+    return base64.b64encode(data).decode().rstrip("=")
+
+def unb64(text: str) -> bytes:
+    return base64.b64decode(text + "=" * (-len(text) % 4))
+
+def hash_password(password: str, n: int = SCRYPT_N, r: int = SCRYPT_R, p: int = SCRYPT_P) -> str:
+    """Salted scrypt hash, stored as scrypt$n$r$p$salt$key"""
+    salt = os.urandom(SALT_BYTES)
+    key = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, dklen=KEY_BYTES, maxmem=256 * n * r + 1024 * 1024)
+    return f"scrypt${n}${r}${p}${b64(salt)}${b64(key)}"
+
+def verify_password(password: str, stored: str) -> bool:
+    """Check a password against a scrypt hash or a legacy unsalted SHA-256 hex digest"""
+    if stored.startswith("scrypt$"):
+        try:
+            _, n, r, p, salt, key = stored.split("$")
+            n, r, p = int(n), int(r), int(p)
+        except ValueError:
+            return False
+        expected = unb64(key)
+        actual = hashlib.scrypt(password.encode(), salt=unb64(salt), n=n, r=r, p=p, dklen=len(expected), maxmem=256 * n * r + 1024 * 1024)
+        return hmac.compare_digest(actual, expected)
+    legacy = hashlib.sha256(password.encode()).hexdigest()
+    return hmac.compare_digest(legacy, stored)
+
+def needs_rehash(stored: str) -> bool:
+    """Whether a stored hash is legacy or uses different cost parameters than the current ones"""
+    return not stored.startswith(f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$")
+
+# A real hash to check against when the username doesn't exist, so both cases take as long
+DUMMY_HASH = hash_password(b64(os.urandom(12)))
+
+async def hash_password_async(password: str) -> str:
+    """hash_password on the hashing pool, without blocking the event loop or a request thread"""
+    return await asyncio.get_running_loop().run_in_executor(hash_pool, hash_password, password)
+
+async def verify_password_async(password: str, stored: str) -> bool:
+    """verify_password on the hashing pool"""
+    return await asyncio.get_running_loop().run_in_executor(hash_pool, verify_password, password, stored)
@@ -0,0 +1,189 @@
+"""Perceptual hashes for near-duplicate detection.
+
+Each blob gets a 64-bit difference hash (dHash): the image is shrunk to 9x8
+grayscale and every bit records whether a pixel is brighter than its right-hand
+neighbour. Re-encodes, resizes and small edits of an image land within a few
+bits of each other.
+
+Lookups use multi-index hashing: the hash is split into CHUNKS 16-bit parts,
+each with its own hash table. Two hashes within distance d must agree to within
+d // CHUNKS bits on at least one part, so a search only probes the chunk values
+that close to the query's, then checks the full distance of those candidates.
+
+    python phash.py backfill    hash stored blobs that don't have one yet
+    python phash.py bench       time searches against a million random hashes
+"""
+import functools
+import itertools
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; without it no duplicates are detected
+    Image = None
+
+# Hashes this many bits apart or closer are reported as likely duplicates
+DUPLICATE_DISTANCE = 10
+
+# Largest distance a similarity search accepts
+MAX_DISTANCE = 12
+
+CHUNKS = 4
+CHUNK_BITS = 64 // CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+HASH_MASK = (1 << 64) - 1
+
+def dhash(path: str) -> int:
+    """64-bit difference hash of an image's first frame, as a signed integer (SQLite's INTEGER range)"""
+    with Image.open(path) as im:
+        im.draft("L", (64, 64))  # lets JPEG decoding skip most of the full-size image
+        im.seek(0)
+        pixels = list(im.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def safe_dhash(path: str):
+    """dhash() that returns None for unreadable images or when Pillow is missing; runs in a worker process"""
+    if Image is None:
+        return None
+    try:
+        return dhash(path)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+def distance(a: int, b: int) -> int:
+    """Number of differing bits between two hashes"""
+    return ((a ^ b) & HASH_MASK).bit_count()
+
+@functools.lru_cache(maxsize=None)
+def flip_masks(radius: int) -> tuple:
+    """XOR masks turning a chunk into every value within `radius` bits of it"""
+    return tuple(
+        sum(1 << bit for bit in bits)
+        for r in range(radius + 1)
+        for bits in itertools.combinations(range(CHUNK_BITS), r)
+    )
+
+class PerceptualIndex:
+    """In-memory multi-index hash over the perceptual hashes of all blobs"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.hashes = {}  # blob digest -> phash as an unsigned 64-bit value
+        self.tables = [{} for _ in range(CHUNKS)]  # chunk value -> list of digests
+
+    @staticmethod
+    def chunks(unsigned: int):
+        return [(unsigned >> (i * CHUNK_BITS)) & CHUNK_MASK for i in range(CHUNKS)]
+
+    def build(self, conn):
+        """Load every blob that has a perceptual hash"""
+        with self.lock:
+            self.hashes = {}
+            self.tables = [{} for _ in range(CHUNKS)]
+            for digest, phash in conn.execute("SELECT hash, phash FROM files WHERE phash IS NOT NULL"):
+                self.add(digest, phash)
+
+    def add(self, digest: str, phash: int):
+        with self.lock:
+            if digest in self.hashes:
+                return
+            unsigned = phash & HASH_MASK
+            self.hashes[digest] = unsigned
+            for table, chunk in zip(self.tables, self.chunks(unsigned)):
+                table.setdefault(chunk, []).append(digest)
+
+    def remove(self, digest: str):
+        with self.lock:
+            phash = self.hashes.pop(digest, None)
+            if phash is None:
+                return
+            for table, chunk in zip(self.tables, self.chunks(phash)):
+                bucket = table.get(chunk, [])
+                if digest in bucket:
+                    bucket.remove(digest)
+                if not bucket:
+                    table.pop(chunk, None)
+
+    def search(self, phash: int, max_distance: int = DUPLICATE_DISTANCE) -> list:
+        """(digest, distance) of every blob within max_distance bits, closest first"""
+        query = phash & HASH_MASK
+        masks = flip_masks(max_distance // CHUNKS)
+        candidates = set()
+        with self.lock:
+            hashes = self.hashes
+            for table, chunk in zip(self.tables, self.chunks(query)):
+                for mask in masks:
+                    bucket = table.get(chunk ^ mask)
+                    if bucket:
+                        candidates.update(bucket)
+            matches = [(digest, (query ^ hashes[digest]).bit_count()) for digest in candidates]
+        return sorted([match for match in matches if match[1] <= max_distance], key=lambda match: match[1])
+
+# ============== BACKFILL ==============
+
+def backfill(db_name: str, upload_dir: str, batch_size: int = 500):
+    """Compute perceptual hashes for every stored blob that does not have one"""
+    if Image is None:
+        sys.exit("Pillow is not installed; cannot compute perceptual hashes")
+    conn = sqlite3.connect(db_name)
+    pending = conn.execute("SELECT hash, path FROM files WHERE phash IS NULL").fetchall()
+    done = failed = 0
+    with ProcessPoolExecutor() as executor:
+        paths = [os.path.join(upload_dir, path) for _, path in pending]
+        ready = []
+        for (digest, _), phash in zip(pending, executor.map(safe_dhash, paths, chunksize=16)):
+            if phash is None:
+                failed += 1
+                continue
+            ready.append((phash, digest))
+            if len(ready) >= batch_size:
+                conn.executemany("UPDATE files SET phash = ? WHERE hash = ?", ready)
+                conn.commit()
+                done += len(ready)
+                ready = []
+        conn.executemany("UPDATE files SET phash = ? WHERE hash = ?", ready)
+        conn.commit()
+        done += len(ready)
+    conn.close()
+    print(f"Hashed {done} files ({failed} failed)")
+
+def bench(size: int = 1_000_000, queries: int = 1000):
+    """Search a synthetic corpus of random hashes, each query having a few near copies planted"""
+    rng = random.Random(0)
+    index = PerceptualIndex()
+    start = time.perf_counter()
+    for i in range(size):
+        index.add(str(i), rng.getrandbits(64) - (1 << 63))
+    print(f"Indexed {size} hashes in {time.perf_counter() - start:.1f}s")
+    for max_distance in (DUPLICATE_DISTANCE, MAX_DISTANCE):
+        timings = []
+        for q in range(queries):
+            query = rng.getrandbits(64) - (1 << 63)
+            near = f"near{max_distance}-{q}"
+            index.add(near, query ^ (1 << rng.randrange(64)) ^ (1 << rng.randrange(64)))
+            start = time.perf_counter()
+            results = index.search(query, max_distance)
+            timings.append((time.perf_counter() - start) * 1000)
+            assert any(digest == near for digest, _ in results)
+        timings.sort()
+        print(f"max_distance={max_distance}: p50 {timings[len(timings) // 2]:.2f} ms, p99 {timings[int(len(timings) * 0.99)]:.2f} ms")
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["backfill"]:
+        from init_db import DB_NAME, UPLOAD_DIR, migrate
+        migrate(DB_NAME)
+        backfill(DB_NAME, UPLOAD_DIR)
+    elif sys.argv[1:] == ["bench"]:
+        bench()
+    else:
+        sys.exit(__doc__)
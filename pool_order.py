@@ -0,0 +1,184 @@
+"""Gapped order keys for posts in a pool.
+
+Neighbouring posts' order_index values start ORDER_GAP apart, so a post can be
+moved or inserted by giving it the midpoint between its new neighbours: one
+row changes, however long the pool is. When two neighbours end up with
+adjacent keys, only the rows around them are respaced, in a window that widens
+until it has room (so repeated inserts at one spot cost amortized O(log^2 n)
+rows, not a renumbering of the pool).
+
+    python pool_order.py stress
+
+times random moves in pools of growing size to check that cost stays flat.
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Spacing between neighbouring order_index values after a full rebalance
+ORDER_GAP = 1 << 16
+
+# Rows on each side of a crowded spot in the first respacing window
+RESPACE_WINDOW = 8
+
+def append_key(cursor, pool_id: int) -> int:
+    """order_index for a post added at the end of a pool"""
+    cursor.execute("SELECT MAX(order_index) FROM pool_posts WHERE pool_id = ?", (pool_id,))
+    last = cursor.fetchone()[0]
+    return 0 if last is None else last + ORDER_GAP
+
+def neighbours(cursor, pool_id: int, post_id: int, after_post_id):
+    """order_index of the posts that post_id will sit between (None past either end)"""
+    conditions = ["pool_id = ?", "post_id != ?"]
+    params = [pool_id, post_id]
+    prev = None
+    if after_post_id is not None:
+        cursor.execute("SELECT order_index FROM pool_posts WHERE pool_id = ? AND post_id = ?", (pool_id, after_post_id))
+        prev = cursor.fetchone()[0]
+        conditions.append("(order_index, post_id) > (?, ?)")
+        params.extend([prev, after_post_id])
+    cursor.execute(f"""
+        SELECT order_index FROM pool_posts
+        WHERE {' AND '.join(conditions)}
+        ORDER BY order_index, post_id
+        LIMIT 1
+    """, params)
+    row = cursor.fetchone()
+    return prev, (row[0] if row else None)
+
+def key_between(prev, next_key):
+    """An order_index strictly between two neighbours, or None if there is no room"""
+    if prev is None and next_key is None:
+        return 0
+    if prev is None:
+        return next_key - ORDER_GAP
+    if next_key is None:
+        return prev + ORDER_GAP
+    if next_key - prev > 1:
+        return (prev + next_key) // 2
+    return None
+
+def place_after(cursor, pool_id: int, post_id: int, after_post_id) -> int:
+    """order_index that puts post_id right after after_post_id (first if None); does not commit
+
+    after_post_id must be in the pool. Respaces nearby rows if its neighbours have no gap left.
+    """
+    prev, next_key = neighbours(cursor, pool_id, post_id, after_post_id)
+    key = key_between(prev, next_key)
+    if key is None:
+        # Only possible between two existing posts, so after_post_id is set
+        respace_around(cursor, pool_id, prev, after_post_id)
+        key = key_between(*neighbours(cursor, pool_id, post_id, after_post_id))
+    return key
+
+def respace_around(cursor, pool_id: int, order_index: int, post_id: int):
+    """Spread out the keys on either side of (order_index, post_id), widening the window until it is sparse enough
+
+    The window's keys are spaced evenly between the keys of the rows just
+    outside it. Wider windows accept tighter spacing, so a crowded region is
+    spread over a larger and larger neighbourhood instead of the whole pool.
+    """
+    width = RESPACE_WINDOW
+    while True:
+        cursor.execute("""
+            SELECT order_index, post_id FROM pool_posts
+            WHERE pool_id = ? AND (order_index, post_id) <= (?, ?)
+            ORDER BY order_index DESC, post_id DESC LIMIT ?
+        """, (pool_id, order_index, post_id, width + 1))
+        below = cursor.fetchall()
+        cursor.execute("""
+            SELECT order_index, post_id FROM pool_posts
+            WHERE pool_id = ? AND (order_index, post_id) > (?, ?)
+            ORDER BY order_index, post_id LIMIT ?
+        """, (pool_id, order_index, post_id, width + 1))
+        above = cursor.fetchall()
+        if len(below) <= width and len(above) <= width:
+            rebalance(cursor, pool_id)
+            return
+        
+        window = [row[1] for row in reversed(below[:width])] + [row[1] for row in above[:width]]
+        # Past either end of the pool the keys are free to grow outwards
+        low = below[width][0] if len(below) > width else below[-1][0] - ORDER_GAP * len(window)
+        high = above[width][0] if len(above) > width else above[-1][0] + ORDER_GAP * len(window)
+        spacing = (high - low) // (len(window) + 1)
+        if spacing >= max(2, ORDER_GAP // width):
+            cursor.executemany(
+                "UPDATE pool_posts SET order_index = ? WHERE pool_id = ? AND post_id = ?",
+                [(low + spacing * (i + 1), pool_id, window_post) for i, window_post in enumerate(window)]
+            )
+            return
+        width *= 2
+
+def rebalance(cursor, pool_id=None):
+    """Respace a pool's order_index values (every pool's if pool_id is None) to multiples of ORDER_GAP"""
+    where = "WHERE pool_id = ?" if pool_id is not None else ""
+    params = [pool_id] if pool_id is not None else []
+    cursor.execute(f"""
+        WITH ranked AS (
+            SELECT pool_id, post_id,
+                   ROW_NUMBER() OVER (PARTITION BY pool_id ORDER BY order_index, post_id) - 1 AS position
+            FROM pool_posts {where}
+        )
+        UPDATE pool_posts SET order_index = ranked.position * ?
+        FROM ranked
+        WHERE pool_posts.pool_id = ranked.pool_id AND pool_posts.post_id = ranked.post_id
+    """, (*params, ORDER_GAP))
+
+# ============== STRESS TEST ==============
+
+def stress(sizes=(100, 1000, 10000, 100000), moves: int = 2000):
+    """Time random moves in pools of increasing size on a scratch database"""
+    from db import ConnectionPool
+    from init_db import migrate
+
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory(prefix="sheeppool_") as workdir:
+        db_name = os.path.join(workdir, "stress.db")
+        migrate(db_name)
+        conn = ConnectionPool(db_name).connect()
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO users (username, password_hash, is_admin, created_at) VALUES ('stress', '', 0, '2025-01-01')")
+        cursor.executemany(
+            "INSERT INTO posts (image_filename, uploader_id, upload_date, favorite_count) VALUES ('stress.png', 1, '2025-01-01', 0)",
+            [()] * max(sizes)
+        )
+        conn.commit()
+
+        print(f"{'pool size':>10}{'us/move':>10}{'rows/move':>11}{'respaces':>10}")
+        for size in sizes:
+            cursor.execute("INSERT INTO pools (name, creator_id, created_at) VALUES (?, 1, '2025-01-01')", (f"pool {size}",))
+            pool_id = cursor.lastrowid
+            cursor.executemany(
+                "INSERT INTO pool_posts (pool_id, post_id, order_index) VALUES (?, ?, ?)",
+                [(pool_id, post_id, (post_id - 1) * ORDER_GAP) for post_id in range(1, size + 1)]
+            )
+            conn.commit()
+
+            respaces = 0
+            changes = conn.total_changes
+            start = time.perf_counter()
+            for _ in range(moves):
+                post_id = rng.randint(1, size)
+                # Half the moves go to the same spot, the worst case for running out of gap
+                after_post_id = 1 if rng.random() < 0.5 else rng.choice([None, rng.randint(1, size)])
+                if after_post_id == post_id:
+                    after_post_id = None
+                before = conn.total_changes
+                key = place_after(cursor, pool_id, post_id, after_post_id)
+                cursor.execute("UPDATE pool_posts SET order_index = ? WHERE pool_id = ? AND post_id = ?", (key, pool_id, post_id))
+                conn.commit()
+                # A move writes its row plus the pools row (cover trigger); anything more was a respace
+                if conn.total_changes - before > 2:
+                    respaces += 1
+            elapsed = time.perf_counter() - start
+            rows = (conn.total_changes - changes) / moves
+            print(f"{size:>10}{elapsed / moves * 1e6:>10.0f}{rows:>11.2f}{respaces:>10}")
+        conn.close()
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["stress"]:
+        stress()
+    else:
+        sys.exit("usage: python pool_order.py stress")
@@ -0,0 +1,163 @@
+"""Item-item recommendations: users who favorited this also favorited...
+
+Each post's favoriters are a sparse column of the user x post matrix, and two
+posts are as similar as the cosine of their columns: favoriters in common over
+the geometric mean of their favoriter counts. Only the MAX_USER_FAVORITES most
+recent favorites of each user count. A few accounts favorite nearly everything;
+uncapped, their n^2 pairs would dominate both the running time and the results.
+
+The job computes the product one range of post ids at a time, as a GROUP BY
+self-join of the capped favorites held in temp tables, so memory stays
+bounded by the chunk. It keeps the TOP_K most similar posts of each post
+(sharing at least MIN_COMMON_FAVORITERS favoriters) in post_similar, ranked, so
+serving them is a single primary key range read. Each chunk commits on its
+own, after its lists were computed into a temp table, so the write lock is
+held only for a delete and a copy; readers see a post's old list or its new
+one, never a mix.
+
+refresh_recommendations() redoes only the posts favorited since the last run.
+Removed favorites, and the pairs a new favorite adds to other posts' lists,
+are picked up by the next rebuild_recommendations(). Both start by loading every
+user's capped favorites, a full pass over the favorites table, so they run from
+cron rather than inside the API processes, e.g. a refresh every 10 minutes and
+a rebuild every night:
+
+    */10 * * * *  python recommendations.py refresh
+    30 4 * * *    python recommendations.py rebuild
+
+The first refresh (no watermark yet) is a full rebuild.
+"""
+import json
+import math
+import sqlite3
+import sys
+import time
+
+# Similar posts kept per post
+TOP_K = 50
+
+# Posts need this many favoriters in common to be listed as similar
+MIN_COMMON_FAVORITERS = 2
+
+# Each user's most recent favorites that count towards similarity
+MAX_USER_FAVORITES = 100
+
+# Posts whose similar lists are computed per statement and transaction
+POST_CHUNK_SIZE = 5000
+
+# Job name in job_state
+JOB_NAME = "recommendations"
+
+# Top-K similar posts of the posts matching {condition} (on a.post_id)
+SIMILAR_POSTS_SQL = """
+    INSERT INTO rec_similar (post_id, rank, similar_post_id, score)
+    SELECT post_id, rank, similar_post_id, score FROM (
+        SELECT post_id, similar_post_id, score,
+               ROW_NUMBER() OVER (PARTITION BY post_id ORDER BY score DESC, similar_post_id DESC) AS rank
+        FROM (
+            SELECT a.post_id, b.post_id AS similar_post_id,
+                   COUNT(*) / sqrt(ca.favoriters * cb.favoriters) AS score
+            FROM rec_favorites a
+            JOIN rec_favorites b ON b.user_id = a.user_id AND b.post_id != a.post_id
+            JOIN rec_counts ca ON ca.post_id = a.post_id
+            JOIN rec_counts cb ON cb.post_id = b.post_id
+            WHERE {condition}
+            GROUP BY a.post_id, b.post_id
+            HAVING COUNT(*) >= ?
+        )
+    )
+    WHERE rank <= ?
+"""
+
+def prepare(conn):
+    """Load the capped favorites and each post's favoriter count into temp tables"""
+    try:
+        conn.execute("SELECT sqrt(1)").fetchone()
+    except sqlite3.OperationalError:  # SQLite built without its math functions
+        conn.create_function("sqrt", 1, math.sqrt, deterministic=True)
+    cleanup(conn)
+    conn.execute("CREATE TEMP TABLE rec_favorites (user_id INTEGER NOT NULL, post_id INTEGER NOT NULL)")
+    conn.execute("""
+        INSERT INTO rec_favorites (user_id, post_id)
+        SELECT user_id, post_id FROM (
+            SELECT user_id, post_id, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY favorited_at DESC) AS recency
+            FROM favorites
+        )
+        WHERE recency <= ?
+    """, (MAX_USER_FAVORITES,))
+    conn.execute("CREATE INDEX temp.idx_rec_favorites_post ON rec_favorites (post_id, user_id)")
+    conn.execute("CREATE INDEX temp.idx_rec_favorites_user ON rec_favorites (user_id, post_id)")
+    conn.execute("CREATE TEMP TABLE rec_counts (post_id INTEGER PRIMARY KEY, favoriters INTEGER NOT NULL)")
+    conn.execute("INSERT INTO rec_counts SELECT post_id, COUNT(*) FROM rec_favorites GROUP BY post_id")
+    conn.execute("CREATE TEMP TABLE rec_similar AS SELECT * FROM post_similar WHERE 0")
+    conn.commit()
+
+def cleanup(conn):
+    for table in ("rec_favorites", "rec_counts", "rec_similar"):
+        conn.execute(f"DROP TABLE IF EXISTS temp.{table}")
+    conn.commit()
+
+def recompute(conn, condition: str, params: tuple):
+    """Replace the similar lists of the posts matching a condition on post_id (e.g. "post_id BETWEEN ? AND ?")"""
+    conn.execute("DELETE FROM rec_similar")
+    conn.execute(SIMILAR_POSTS_SQL.format(condition=f"a.{condition}"), (*params, MIN_COMMON_FAVORITERS, TOP_K))
+    conn.commit()
+    conn.execute(f"DELETE FROM post_similar WHERE {condition}", params)
+    conn.execute("INSERT INTO post_similar SELECT * FROM rec_similar")
+    conn.commit()
+
+def save_watermark(conn, watermark):
+    """Remember the newest favorite the recommendations have seen"""
+    conn.execute("""
+        INSERT INTO job_state (job, watermark) VALUES (?, ?)
+        ON CONFLICT (job) DO UPDATE SET watermark = excluded.watermark
+    """, (JOB_NAME, watermark or ""))  # "" sorts before every timestamp
+    conn.commit()
+
+def rebuild_recommendations(conn) -> int:
+    """Recompute every post's similar posts, POST_CHUNK_SIZE posts at a time; returns the number of pairs stored"""
+    watermark = conn.execute("SELECT MAX(favorited_at) FROM favorites").fetchone()[0]
+    max_post_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM posts").fetchone()[0]
+    prepare(conn)
+    try:
+        for low in range(1, max_post_id + 1, POST_CHUNK_SIZE):
+            recompute(conn, "post_id BETWEEN ? AND ?", (low, low + POST_CHUNK_SIZE - 1))
+    finally:
+        cleanup(conn)
+    save_watermark(conn, watermark)
+    return conn.execute("SELECT COUNT(*) FROM post_similar").fetchone()[0]
+
+def refresh_recommendations(conn) -> int:
+    """Recompute the similar posts of posts favorited since the last run (all of them the first time); returns how many"""
+    row = conn.execute("SELECT watermark FROM job_state WHERE job = ?", (JOB_NAME,)).fetchone()
+    if row is None:
+        rebuild_recommendations(conn)
+        return conn.execute("SELECT COUNT(DISTINCT post_id) FROM post_similar").fetchone()[0]
+    watermark = conn.execute("SELECT MAX(favorited_at) FROM favorites").fetchone()[0]
+    # >= rather than >: favorites sharing the old watermark's timestamp may have committed after it was read
+    # Deduplicated here: with DISTINCT, SQLite walks the post_id index instead of the time range
+    rows = conn.execute("SELECT post_id FROM favorites WHERE favorited_at >= ?", (row[0],))
+    post_ids = list(dict.fromkeys(r[0] for r in rows))
+    if post_ids:
+        prepare(conn)
+        try:
+            for i in range(0, len(post_ids), POST_CHUNK_SIZE):
+                recompute(conn, "post_id IN (SELECT value FROM json_each(?))", (json.dumps(post_ids[i:i + POST_CHUNK_SIZE]),))
+        finally:
+            cleanup(conn)
+    save_watermark(conn, watermark)
+    return len(post_ids)
+
+if __name__ == "__main__":
+    if sys.argv[1:] not in (["rebuild"], ["refresh"]):
+        sys.exit(__doc__)
+    from db import ConnectionPool
+    from init_db import DB_NAME, migrate
+    migrate(DB_NAME)
+    conn = ConnectionPool(DB_NAME).connect()
+    start = time.perf_counter()
+    if sys.argv[1] == "rebuild":
+        print(f"Stored {rebuild_recommendations(conn)} similar pairs in {time.perf_counter() - start:.1f}s")
+    else:
+        print(f"Refreshed {refresh_recommendations(conn)} posts in {time.perf_counter() - start:.1f}s")
+    conn.close()
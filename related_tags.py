@@ -0,0 +1,117 @@
+"""Related tags from a co-occurrence table.
+
+tag_cooccurrence holds, for every pair of tags that share a post, how many
+posts have both. Each pair is stored in both directions, so a tag's related
+tags are a single range of the (tag_id, post_count DESC) index and a lookup
+reads `limit` rows however popular the tag is.
+
+The table changes by deltas: create_post, delete_post and bulk_import add or
+subtract the tag pairs of the posts they touch, in the same transaction as
+their post_tags rows. rebuild() recomputes it from post_tags with one
+GROUP BY per range of tag ids, for migrations and bulk loads.
+
+    python related_tags.py rebuild
+"""
+import itertools
+import math
+import sqlite3
+import sys
+import time
+from collections import Counter
+
+# Most related tags a single request may ask for
+MAX_RELATED_TAGS = 100
+
+# Most-co-occurring tags that PMI ranking picks from, so it reads a bounded number of rows
+PMI_CANDIDATES = 500
+
+# Pairs sharing fewer posts than this rank after the rest by PMI: one shared post is a coincidence, not an association
+PMI_MIN_COOCCURRENCES = 3
+
+# Tag ids per rebuild statement; keeps each GROUP BY's sort small enough for memory
+REBUILD_TAG_RANGE = 2000
+
+def tag_pairs(post_tag_ids) -> Counter:
+    """Ordered (tag_id, related_tag_id) pairs over some posts, given each post's tag ids, with their counts"""
+    return Counter(pair for tag_ids in post_tag_ids for pair in itertools.permutations(set(tag_ids), 2))
+
+def apply_delta(cursor, post_tag_ids, sign: int):
+    """Add (sign=1) or subtract (sign=-1) the tag pairs of some posts; does not commit"""
+    pairs = tag_pairs(post_tag_ids)
+    if not pairs:
+        return
+    cursor.executemany("""
+        INSERT INTO tag_cooccurrence (tag_id, related_tag_id, post_count) VALUES (?, ?, ?)
+        ON CONFLICT (tag_id, related_tag_id) DO UPDATE SET post_count = post_count + excluded.post_count
+    """, [(tag_id, related_tag_id, sign * count) for (tag_id, related_tag_id), count in pairs.items()])
+    if sign < 0:
+        # Keep the table sparse: pairs no post has any more are dropped
+        cursor.executemany(
+            "DELETE FROM tag_cooccurrence WHERE tag_id = ? AND related_tag_id = ? AND post_count <= 0",
+            list(pairs)
+        )
+
+def count_tag_pairs(cursor, post_tag_ids):
+    """Count the tag pairs of new posts, given each post's tag ids"""
+    apply_delta(cursor, post_tag_ids, 1)
+
+def uncount_tag_pairs(cursor, post_tag_ids):
+    """Uncount the tag pairs of deleted posts, given the tag ids each one had"""
+    apply_delta(cursor, post_tag_ids, -1)
+
+def rebuild(cursor) -> int:
+    """Recompute the whole table from post_tags; returns the number of stored pairs; does not commit"""
+    cursor.execute("DELETE FROM tag_cooccurrence")
+    cursor.execute("SELECT COALESCE(MAX(id), 0) FROM tags")
+    max_tag_id = cursor.fetchone()[0]
+    for low in range(1, max_tag_id + 1, REBUILD_TAG_RANGE):
+        cursor.execute("""
+            INSERT INTO tag_cooccurrence (tag_id, related_tag_id, post_count)
+            SELECT a.tag_id, b.tag_id, COUNT(*)
+            FROM post_tags a
+            JOIN post_tags b ON b.post_id = a.post_id AND b.tag_id != a.tag_id
+            WHERE a.tag_id BETWEEN ? AND ?
+            GROUP BY a.tag_id, b.tag_id
+        """, (low, low + REBUILD_TAG_RANGE - 1))
+    cursor.execute("SELECT COUNT(*) FROM tag_cooccurrence")
+    return cursor.fetchone()[0]
+
+def pmi(cooccurrences: int, tag_posts: int, related_posts: int, total_posts: int) -> float:
+    """Pointwise mutual information: log of how much more often two tags meet than chance predicts"""
+    if not (tag_posts and related_posts and total_posts):
+        return 0.0
+    return math.log(cooccurrences * total_posts / (tag_posts * related_posts))
+
+def related_tags(cursor, tag_id: int, tag_posts: int, total_posts: int, limit: int, order: str = "count") -> list:
+    """Tags that share posts with a tag, by co-occurrence count or by PMI among the PMI_CANDIDATES most frequent
+
+    Each has its post_count, the number of posts it shares with the tag
+    (`cooccurrences`) and the pair's `pmi`.
+    """
+    cursor.execute("""
+        SELECT t.tag_name, t.post_count, c.post_count AS cooccurrences
+        FROM tag_cooccurrence c
+        JOIN tags t ON t.id = c.related_tag_id
+        WHERE c.tag_id = ?
+        ORDER BY c.post_count DESC, c.related_tag_id
+        LIMIT ?
+    """, (tag_id, limit if order == "count" else PMI_CANDIDATES))
+    tags = [
+        {**dict(row), "pmi": pmi(row["cooccurrences"], tag_posts, row["post_count"], total_posts)}
+        for row in cursor.fetchall()
+    ]
+    if order == "pmi":
+        tags.sort(key=lambda tag: (tag["cooccurrences"] < PMI_MIN_COOCCURRENCES, -tag["pmi"]))
+    return tags[:limit]
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        sys.exit(__doc__)
+    from init_db import DB_NAME, migrate
+    migrate(DB_NAME)
+    conn = sqlite3.connect(DB_NAME)
+    start = time.perf_counter()
+    pairs = rebuild(conn.cursor())
+    conn.commit()
+    conn.close()
+    print(f"Counted {pairs} tag pairs in {time.perf_counter() - start:.1f}s")
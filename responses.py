@@ -0,0 +1,246 @@
+"""JSON serialization, field projection and response compression.
+
+FastJSONResponse renders with orjson when it is installed. Handlers on hot
+paths return it directly, which also skips FastAPI's jsonable_encoder pass.
+
+CompressionMiddleware gzips (or, with the brotli package, brotli-compresses)
+text responses of at least MIN_COMPRESS_BYTES for clients that accept it.
+Cached bodies keep their compressed variants (see cache.CachedBody), so a hit
+is not recompressed.
+
+    python responses.py bench
+
+shows payload sizes and serialization/compression time for a 1000-post page.
+"""
+import gzip
+import hashlib
+import json
+import sys
+import time
+import zlib
+
+import anyio.to_thread
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import orjson
+except ImportError:  # optional; the stdlib encoder is used without it
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # optional; only gzip is offered without it
+    brotli = None
+
+# Bodies smaller than this are sent uncompressed (the framing costs more than it saves)
+MIN_COMPRESS_BYTES = 1024
+
+# Bodies larger than this are compressed on a worker thread instead of the event loop
+OFFLOAD_COMPRESS_BYTES = 64 * 1024
+
+# Fast settings suited to compressing on every request
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+# Content types worth compressing; images and other binaries already are
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript", "image/svg+xml")
+
+def dumps(content) -> bytes:
+    """Serialize to compact UTF-8 JSON"""
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson when available"""
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+# ============== FIELD PROJECTION ==============
+
+def parse_fields(fields, allowed) -> frozenset:
+    """The set of fields named in a comma-separated `fields=` parameter, or None for all of them"""
+    if fields is None:
+        return None
+    names = frozenset(name.strip() for name in fields.split(",") if name.strip())
+    unknown = sorted(names - set(allowed))
+    if unknown or not names:
+        raise HTTPException(status_code=400, detail=f"Unknown fields {unknown}; choose from {', '.join(allowed)}")
+    return names
+
+# ============== COMPRESSION ==============
+
+def accepted_encoding(accept_encoding: str):
+    """The best encoding we support from an Accept-Encoding header: br, then gzip, else None"""
+    weights = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name.strip()] = q
+    for encoding in ("br", "gzip"):
+        if encoding == "br" and brotli is None:
+            continue
+        if weights.get(encoding, weights.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+class StreamCompressor:
+    """Incremental compressor for responses sent in several chunks"""
+
+    def __init__(self, encoding: str):
+        if encoding == "br":
+            compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+            self.compress, self.finish = compressor.process, compressor.finish
+        else:
+            compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip framing
+            self.compress, self.finish = compressor.compress, compressor.flush
+
+def compressible(headers) -> bool:
+    content_type = headers.get("content-type", "")
+    return "content-encoding" not in headers and content_type.startswith(COMPRESSIBLE_TYPES)
+
+def weak_etag(etag: str) -> str:
+    """A compressed body is a different representation, so a strong ETag no longer fits it"""
+    return etag if etag.startswith("W/") else "W/" + etag
+
+class CompressionMiddleware:
+    """ASGI middleware compressing text responses for clients that accept br or gzip"""
+
+    def __init__(self, app, minimum_size: int = MIN_COMPRESS_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = accepted_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        stream = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, stream, passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                start = message  # held back until the first body chunk shows how big the body is
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start is not None:
+                headers = MutableHeaders(raw=start["headers"])
+                if not compressible(headers) or (not more_body and len(body) < self.minimum_size):
+                    passthrough = True
+                    await send(start)
+                    await send(message)
+                    return
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                if "etag" in headers:
+                    headers["ETag"] = weak_etag(headers["etag"])
+                if more_body:
+                    del headers["Content-Length"]
+                    stream = StreamCompressor(encoding)
+                else:
+                    if len(body) > OFFLOAD_COMPRESS_BYTES:
+                        body = await anyio.to_thread.run_sync(compress, body, encoding)
+                    else:
+                        body = compress(body, encoding)
+                    headers["Content-Length"] = str(len(body))
+                    await send(start)
+                    await send({"type": "http.response.body", "body": body})
+                    return
+                await send(start)
+                start = None
+
+            chunk = stream.compress(body)
+            if not more_body:
+                chunk += stream.finish()
+            await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+# ============== BENCHMARK ==============
+
+def sample_page(size: int = 1000) -> list:
+    """A page of posts shaped like GET /api/posts output"""
+    digests = [hashlib.sha256(str(i).encode()).hexdigest() for i in range(size)]
+    return [
+        {
+            "id": 1000000 - i,
+            "image_filename": f"{digests[i]}.png",
+            "uploader_id": i % 977,
+            "uploader_username": f"seeduser{i % 977}",
+            "upload_date": f"2025-06-{i % 28 + 1:02d}T12:{i % 60:02d}:00.123456",
+            "description": "fluffy sheep grazing on a sunny meadow" if i % 3 else None,
+            "favorite_count": (i * 7919) % 500,
+            "thumbnail_url": f"/uploads/thumbnails/{digests[i]}.webp",
+            "sample_url": f"/uploads/samples/{digests[i]}.webp",
+            "tags": ["sheep", "wool", f"tag_{i % 50}", f"artist_{i % 200}", "outdoors"],
+        }
+        for i in range(size)
+    ]
+
+def timed(fn, repeat: int = 20) -> float:
+    """Best-of-repeat wall time of fn() in milliseconds"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+def bench(size: int = 1000):
+    from fastapi.encoders import jsonable_encoder
+
+    page = {"posts": sample_page(size), "next_cursor": "WzE3NTAwMDAwMDAsOTk5MDAwXQ"}
+    grid_fields = ("id", "image_filename", "favorite_count")
+    grid = {"posts": [{name: post[name] for name in grid_fields} for post in page["posts"]], "next_cursor": page["next_cursor"]}
+
+    print(f"Serializing a {size}-post page:")
+    print(f"  jsonable_encoder + json.dumps (FastAPI default): {timed(lambda: json.dumps(jsonable_encoder(page)).encode()):7.2f} ms")
+    print(f"  json.dumps:                                      {timed(lambda: json.dumps(page).encode()):7.2f} ms")
+    if orjson is not None:
+        print(f"  orjson.dumps:                                    {timed(lambda: orjson.dumps(page)):7.2f} ms")
+
+    print("Payload sizes:")
+    for label, content in (("all fields", page), ("fields=" + ",".join(grid_fields), grid)):
+        body = dumps(content)
+        encodings = ["gzip"] + (["br"] if brotli is not None else [])
+        parts = [f"{len(body) / 1024:7.1f} KiB"]
+        for encoding in encodings:
+            compressed = compress(body, encoding)
+            parts.append(f"{encoding} {len(compressed) / 1024:6.1f} KiB in {timed(lambda: compress(body, encoding)):5.2f} ms")
+        print(f"  {label:<40}" + "   ".join(parts))
+    if brotli is None:
+        print("  (brotli is not installed; only gzip is offered)")
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["bench"]:
+        bench()
+    else:
+        sys.exit("usage: python responses.py bench")
@@ -0,0 +1,33 @@
+import html
+import re
+
+# Private-use characters that snippet() wraps around matches; replaced with <mark> after escaping
+MATCH_START = "\ue000"
+MATCH_END = "\ue001"
+
+# Words of context around the matches in a snippet
+SNIPPET_TOKENS = 16
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+def fts_query(text: str):
+    """Turn free text into an FTS5 query that ANDs its words, the last one as a prefix; None if it has no words
+
+    Only word characters are kept, so user input can't inject FTS5 syntax.
+    """
+    words = WORD_RE.findall(text or "")
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+def snippet_sql(table: str, column: int) -> str:
+    """SQL for a snippet of the best-matching part of a column (-1 picks the best column)"""
+    return f"snippet({table}, {column}, '{MATCH_START}', '{MATCH_END}', '…', {SNIPPET_TOKENS})"
+
+def highlight(snippet) -> str:
+    """HTML-escape a snippet and mark its matches with <mark>"""
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(MATCH_START, "<mark>").replace(MATCH_END, "</mark>")
@@ -0,0 +1,216 @@
+"""Fill a database with a large, skewed synthetic dataset for benchmarking.
+
+    python seed_db.py [--posts 1000000] [--users 100000] [--tags 50000]
+                      [--pools 5000] [--favorites 5000000] [--db sheepbooru.db]
+
+Like a real booru, the data is dominated by a few of everything:
+
+- Tag usage follows a Zipf law, so the top tags are on a large share of posts
+  and most tags are on a handful.
+- A few uploaders post most of the images.
+- Favorites come from a few heavy favoriters and land mostly on a small set of
+  popular posts. Recent posts collect more of them, so there is a trending
+  signal.
+- Pool sizes are heavy-tailed: mostly short series plus a few very large pools.
+
+Only columns that every schema version has are written. Counters kept by
+triggers (tags.post_count, pools.post_count, ...) fill themselves in, and the
+tag co-occurrence table is rebuilt in bulk where the schema has one, so
+benchmark.py can seed any revision's schema with this module.
+
+Posts point at image files that don't exist. The JSON endpoints don't read
+images, but /uploads requests for seeded posts will 404.
+"""
+import argparse
+import datetime
+import itertools
+import random
+import sqlite3
+import sys
+import time
+
+try:
+    import related_tags
+except ImportError:  # revisions before tag co-occurrence (benchmark.py seeds those too)
+    related_tags = None
+try:
+    import trending
+except ImportError:  # revisions before the trending order
+    trending = None
+
+# Spacing between order_index values of consecutive pool posts (pool_order.ORDER_GAP)
+POOL_ORDER_GAP = 1 << 16
+
+# Zipf exponents: larger means more skewed
+TAG_SKEW = 1.05
+UPLOADER_SKEW = 1.2
+FAVORITER_SKEW = 1.1
+POPULARITY_SKEW = 0.9
+WORD_SKEW = 1.0
+
+# Posts span this many days, ending now
+HISTORY_DAYS = 3 * 365
+
+# Rows per executemany batch
+BATCH_SIZE = 20000
+
+WORDS = (
+    "sheep lamb wool fluffy field meadow grass cloud sky sunset farm fence barn "
+    "shepherd dog flock hill valley snow winter spring summer autumn rain river "
+    "sketch painting comic doodle photo render pixel portrait landscape chibi "
+    "cute sleepy angry happy tiny giant golden black white spotted curly soft "
+    "running jumping grazing sleeping dancing eating playing watching waiting"
+).split()
+
+def zipf_cum_weights(n: int, skew: float) -> list:
+    """Cumulative Zipf weights over ranks 1..n, for random.choices(cum_weights=...)"""
+    return list(itertools.accumulate(1.0 / rank ** skew for rank in range(1, n + 1)))
+
+def batched(rows, size: int = BATCH_SIZE):
+    iterator = iter(rows)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+def insert_rows(conn, sql: str, rows, label: str):
+    """executemany in batches, each committed so the WAL can be checkpointed, reporting progress"""
+    total = 0
+    start = time.perf_counter()
+    for batch in batched(rows):
+        conn.executemany(sql, batch)
+        conn.commit()
+        total += len(batch)
+        print(f"\r  {label}: {total}", end="", file=sys.stderr, flush=True)
+    print(f" ({time.perf_counter() - start:.1f}s)", file=sys.stderr)
+    return total
+
+def seed(db_name: str, posts: int, users: int, tags: int, pools: int, favorites: int, rng: random.Random):
+    """Fill an empty (but migrated) database with skewed synthetic data"""
+    conn = sqlite3.connect(db_name)
+    if conn.execute("SELECT EXISTS (SELECT 1 FROM posts)").fetchone()[0]:
+        conn.close()
+        raise SystemExit(f"{db_name} already has posts; seed an empty database")
+    # A throwaway bulk load: skip fsyncs and keep the hot index pages in memory
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA cache_size = -524288")
+    start = time.perf_counter()
+
+    now = datetime.datetime.now()
+    first = now - datetime.timedelta(days=HISTORY_DAYS)
+    step = HISTORY_DAYS * 86400 / max(posts, 1)
+
+    def uploaded_at(post_id: int) -> datetime.datetime:
+        # Post ids follow upload order, evenly spread over the history
+        return first + datetime.timedelta(seconds=(post_id - 1) * step)
+
+    insert_rows(conn, "INSERT INTO users (username, password_hash, is_admin, created_at) VALUES (?, '', 0, ?)", (
+        (f"seeduser{i}", (first - datetime.timedelta(days=rng.randint(0, 365))).isoformat())
+        for i in range(1, users + 1)
+    ), "users")
+
+    # Tag ranks are shuffled against ids so popularity doesn't follow insertion order
+    tag_ids = list(range(1, tags + 1))
+    rng.shuffle(tag_ids)
+    insert_rows(conn, "INSERT INTO tags (tag_name) VALUES (?)", (
+        (f"{rng.choice(WORDS)}_{i}",) for i in range(1, tags + 1)
+    ), "tags")
+
+    uploader_weights = zipf_cum_weights(users, UPLOADER_SKEW)
+    word_weights = zipf_cum_weights(len(WORDS), WORD_SKEW)
+
+    def post_rows():
+        uploaders = iter(())
+        for post_id in range(1, posts + 1):
+            if post_id % BATCH_SIZE == 1:
+                uploaders = iter(rng.choices(range(1, users + 1), cum_weights=uploader_weights, k=BATCH_SIZE))
+            description = None
+            if rng.random() < 0.6:
+                description = " ".join(rng.choices(WORDS, cum_weights=word_weights, k=rng.randint(2, 12)))
+            yield (f"seed_{post_id}.png", next(uploaders), uploaded_at(post_id).isoformat(), description)
+
+    insert_rows(conn, "INSERT INTO posts (image_filename, uploader_id, upload_date, description, favorite_count) VALUES (?, ?, ?, ?, 0)",
+                post_rows(), "posts")
+
+    tag_weights = zipf_cum_weights(tags, TAG_SKEW)
+
+    def post_tag_rows():
+        for post_id in range(1, posts + 1):
+            count = min(3 + int(rng.paretovariate(1.5) * 3), 40)
+            for rank in set(rng.choices(range(tags), cum_weights=tag_weights, k=count)):
+                yield post_id, tag_ids[rank]
+
+    insert_rows(conn, "INSERT INTO post_tags (post_id, tag_id) VALUES (?, ?)", post_tag_rows(), "post tags")
+
+    # Favorites: heavy favoriters (Zipf over users) on popular posts (Zipf over a
+    # popularity order that favours recent posts), favorited after upload
+    favoriter_weights = zipf_cum_weights(users, FAVORITER_SKEW)
+    popularity_weights = zipf_cum_weights(posts, POPULARITY_SKEW)
+    popularity = sorted(range(1, posts + 1), key=lambda post_id: rng.random() * (posts + 1 - post_id) ** 0.5)
+
+    def favorite_rows():
+        for batch in batched(range(favorites)):
+            favoriters = rng.choices(range(1, users + 1), cum_weights=favoriter_weights, k=len(batch))
+            ranks = rng.choices(range(posts), cum_weights=popularity_weights, k=len(batch))
+            for user_id, rank in zip(favoriters, ranks):
+                post_id = popularity[rank]
+                upload = uploaded_at(post_id)
+                yield user_id, post_id, (upload + (now - upload) * rng.random() ** 3).isoformat()
+
+    insert_rows(conn, "INSERT OR IGNORE INTO favorites (user_id, post_id, favorited_at) VALUES (?, ?, ?)",
+                favorite_rows(), "favorites")
+    conn.execute("""
+        UPDATE posts SET favorite_count = counts.n
+        FROM (SELECT post_id, COUNT(*) AS n FROM favorites GROUP BY post_id) AS counts
+        WHERE posts.id = counts.post_id
+    """)
+
+    # Pools are runs of consecutive posts (a comic, a photo set); a few are huge
+    def pool_rows():
+        for i in range(1, pools + 1):
+            yield f"{rng.choice(WORDS).title()} {rng.choice(WORDS)} collection {i}", None, rng.randint(1, users), now.isoformat()
+
+    def pool_post_rows():
+        for pool_id in range(1, pools + 1):
+            size = min(int(5 * rng.paretovariate(1.1)), posts, 20000)
+            first_post = rng.randint(1, posts - size + 1)
+            for position in range(size):
+                yield pool_id, first_post + position, position * POOL_ORDER_GAP
+
+    insert_rows(conn, "INSERT INTO pools (name, description, creator_id, created_at) VALUES (?, ?, ?, ?)", pool_rows(), "pools")
+    insert_rows(conn, "INSERT INTO pool_posts (pool_id, post_id, order_index) VALUES (?, ?, ?)", pool_post_rows(), "pool posts")
+
+    if related_tags is not None:
+        pair_start = time.perf_counter()
+        pairs = related_tags.rebuild(conn.cursor())
+        print(f"  tag pairs: {pairs} ({time.perf_counter() - pair_start:.1f}s)", file=sys.stderr)
+    conn.commit()
+    if trending is not None:
+        # Before ANALYZE, so its statistics don't describe an empty trending_posts
+        trending_start = time.perf_counter()
+        ranked = trending.refresh_trending(conn)
+        print(f"  trending posts: {ranked} ({time.perf_counter() - trending_start:.1f}s)", file=sys.stderr)
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'index_changes'").fetchone():
+        # Servers started later build their indexes from scratch; the load's change log is dead weight
+        conn.execute("DELETE FROM index_changes")
+        conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    print(f"Seeded {db_name} in {time.perf_counter() - start:.0f}s", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=None, help="database to fill (default: the app's sheepbooru.db)")
+    parser.add_argument("--posts", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--tags", type=int, default=50_000)
+    parser.add_argument("--pools", type=int, default=5_000)
+    parser.add_argument("--favorites", type=int, default=5_000_000, help="favorites to draw (duplicates are dropped)")
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
+    args = parser.parse_args()
+
+    from init_db import DB_NAME, migrate
+    db_name = args.db or DB_NAME
+    migrate(db_name)
+    seed(db_name, args.posts, args.users, args.tags, args.pools, args.favorites, random.Random(args.seed))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+import abc
+import json
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+# Sessions expire after this long without use (sliding expiration)
+SESSION_TTL = 7 * 24 * 3600
+
+# Extend a session's expiry in the backend at most this often, so active users don't cause a write per request
+TOUCH_INTERVAL = 3600
+
+# In-process cache: entries per worker, and how long one may be served without re-checking the backend
+CACHE_SIZE = 10000
+CACHE_TTL = 30
+
+# ============== BACKENDS ==============
+
+class SessionBackend(abc.ABC):
+    """Where sessions are persisted; shared by every worker process"""
+
+    @abc.abstractmethod
+    def load(self, token: str):
+        """Return (user dict, expires_at) or None if missing or expired"""
+
+    @abc.abstractmethod
+    def save(self, token: str, user: dict, expires_at: float):
+        """Store a session, replacing any with the same token"""
+
+    @abc.abstractmethod
+    def touch(self, token: str, expires_at: float):
+        """Push back a session's expiry; never recreates a deleted session"""
+
+    @abc.abstractmethod
+    def delete(self, token: str):
+        """End a session"""
+
+    def sweep(self, now: float) -> int:
+        """Delete expired sessions; returns how many were removed"""
+        return 0
+
+class SQLiteSessionBackend(SessionBackend):
+    """Sessions in the `sessions` table of the app database"""
+
+    def __init__(self, connect):
+        self.connect = connect
+
+    def load(self, token):
+        conn = self.connect()
+        row = conn.execute(
+            "SELECT user_json, expires_at FROM sessions WHERE token = ? AND expires_at > ?",
+            (token, time.time())
+        ).fetchone()
+        conn.close()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def save(self, token, user, expires_at):
+        conn = self.connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO sessions (token, user_id, user_json, expires_at) VALUES (?, ?, ?, ?)",
+            (token, user["id"], json.dumps(user), expires_at)
+        )
+        conn.commit()
+        conn.close()
+
+    def touch(self, token, expires_at):
+        conn = self.connect()
+        conn.execute("UPDATE sessions SET expires_at = ? WHERE token = ?", (expires_at, token))
+        conn.commit()
+        conn.close()
+
+    def delete(self, token):
+        conn = self.connect()
+        conn.execute("DELETE FROM sessions WHERE token = ?", (token,))
+        conn.commit()
+        conn.close()
+
+    def sweep(self, now):
+        conn = self.connect()
+        removed = conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,)).rowcount
+        conn.commit()
+        conn.close()
+        return removed
+
+class RedisSessionBackend(SessionBackend):
+    """Sessions as Redis keys with native expiry; takes any client with get/set/expire/ttl/delete (e.g. redis-py)
+
+    The key's TTL is the session's expiry, so touch() is a single EXPIRE, which
+    does nothing to a key a concurrent logout has already deleted.
+    """
+
+    def __init__(self, client, prefix: str = "sheepbooru:session:"):
+        self.client = client
+        self.prefix = prefix
+
+    def load(self, token):
+        raw = self.client.get(self.prefix + token)
+        ttl = self.client.ttl(self.prefix + token) if raw is not None else -2
+        if ttl < 0:  # -2: gone (expired or deleted since the GET)
+            return None
+        return json.loads(raw)["user"], time.time() + ttl
+
+    def save(self, token, user, expires_at):
+        payload = json.dumps({"user": user})
+        self.client.set(self.prefix + token, payload, ex=max(1, int(expires_at - time.time())))
+
+    def touch(self, token, expires_at):
+        self.client.expire(self.prefix + token, max(1, int(expires_at - time.time())))
+
+    def delete(self, token):
+        self.client.delete(self.prefix + token)
+
+class FakeRedis:
+    """In-memory stand-in for the subset of the Redis client API used above (local runs without a server)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}
+
+    def live(self, key):
+        """(value, expires_at) of an unexpired key, dropping it if it has expired; call with the lock held"""
+        item = self.data.get(key)
+        if item is not None and item[1] is not None and item[1] <= time.time():
+            del self.data[key]
+            return None
+        return item
+
+    def get(self, key):
+        with self.lock:
+            item = self.live(key)
+            return None if item is None else item[0]
+
+    def set(self, key, value, ex=None):
+        with self.lock:
+            self.data[key] = (value, time.time() + ex if ex else None)
+        return True
+
+    def expire(self, key, seconds):
+        with self.lock:
+            if self.live(key) is None:
+                return False
+            self.data[key] = (self.data[key][0], time.time() + seconds)
+            return True
+
+    def ttl(self, key):
+        """Seconds left, -1 without an expiry, -2 if missing (like Redis)"""
+        with self.lock:
+            item = self.live(key)
+            if item is None:
+                return -2
+            return -1 if item[1] is None else max(0, int(item[1] - time.time()))
+
+    def delete(self, *keys):
+        with self.lock:
+            return sum(self.data.pop(key, None) is not None for key in keys)
+
+# ============== STORE ==============
+
+class SessionStore:
+    """Session API used by the app: a bounded TTL/LRU cache in front of a backend
+
+    Most lookups are answered from the cache without I/O. A cached entry is
+    re-checked against the backend after CACHE_TTL seconds, so a logout in
+    another worker takes effect within that window.
+    """
+
+    def __init__(self, backend: SessionBackend, ttl: int = SESSION_TTL,
+                 cache_size: int = CACHE_SIZE, cache_ttl: int = CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()  # token -> [user, expires_at, cached_at]
+
+    def remember(self, token: str, user: dict, expires_at: float):
+        with self.lock:
+            self.cache[token] = [user, expires_at, time.time()]
+            self.cache.move_to_end(token)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def create(self, user: dict) -> str:
+        """Start a session for a user and return its token"""
+        token = secrets.token_hex(32)
+        expires_at = time.time() + self.ttl
+        self.backend.save(token, user, expires_at)
+        self.remember(token, user, expires_at)
+        return token
+
+    def get(self, token: str):
+        """The session's user, or None; extends the session's expiry"""
+        now = time.time()
+        with self.lock:
+            entry = self.cache.get(token)
+            if entry is not None:
+                self.cache.move_to_end(token)
+        if entry is not None and entry[1] > now and now - entry[2] < self.cache_ttl:
+            user, expires_at, _ = entry
+        else:
+            loaded = self.backend.load(token)
+            if loaded is None:
+                with self.lock:
+                    self.cache.pop(token, None)
+                return None
+            user, expires_at = loaded
+            self.remember(token, user, expires_at)
+
+        # Sliding expiration, written back at most once per TOUCH_INTERVAL
+        if expires_at - now < self.ttl - TOUCH_INTERVAL:
+            expires_at = now + self.ttl
+            self.backend.touch(token, expires_at)
+            with self.lock:
+                if token in self.cache:
+                    self.cache[token][1] = expires_at
+        return user
+
+    def delete(self, token: str):
+        """End a session"""
+        with self.lock:
+            self.cache.pop(token, None)
+        self.backend.delete(token)
+
+    def sweep(self) -> int:
+        """Remove expired sessions from the backend and the cache"""
+        now = time.time()
+        with self.lock:
+            for token in [t for t, entry in self.cache.items() if entry[1] <= now]:
+                del self.cache[token]
+        return self.backend.sweep(now)
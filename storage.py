@@ -0,0 +1,210 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+
+# Uploads are read and hashed in chunks of this size
+CHUNK_SIZE = 1024 * 1024
+
+# Serializes "is this blob still referenced?" checks with file placement/removal
+blob_lock = threading.Lock()
+
+def blob_path(digest: str, ext: str) -> str:
+    """Sharded path of a blob relative to the upload dir, e.g. ab/cd/abcdef....png"""
+    return f"{digest[:2]}/{digest[2:4]}/{digest}{ext}"
+
+def clean_extension(filename: str) -> str:
+    """Lowercased file extension with anything unsafe stripped ('' if none)"""
+    ext = os.path.splitext(filename or "")[1].lower()
+    ext = re.sub(r"[^a-z0-9.]", "", ext)
+    return ext if len(ext) > 1 else ""
+
+# (magic bytes test, extension) for the image types accepted as uploads
+IMAGE_SIGNATURES = (
+    (lambda head: head.startswith(b"\x89PNG\r\n\x1a\n"), ".png"),
+    (lambda head: head.startswith(b"\xff\xd8\xff"), ".jpg"),
+    (lambda head: head[:6] in (b"GIF87a", b"GIF89a"), ".gif"),
+    (lambda head: head[:4] == b"RIFF" and head[8:12] == b"WEBP", ".webp"),
+    (lambda head: head[4:8] == b"ftyp" and head[8:12] in (b"avif", b"avis"), ".avif"),
+    (lambda head: head.startswith(b"BM"), ".bmp"),
+)
+
+class UploadTooLarge(Exception):
+    """The upload exceeded the configured maximum size"""
+
+class UnsupportedImageType(Exception):
+    """The upload's leading bytes don't match any accepted image format"""
+
+def sniff_image_type(head: bytes) -> str:
+    """Extension for an image identified from its first bytes, or '' if unrecognized"""
+    for matches, ext in IMAGE_SIGNATURES:
+        if matches(head):
+            return ext
+    return ""
+
+class StagedUpload:
+    """An upload written to a temp file next to its final location, with its content hash"""
+
+    def __init__(self, temp_path: str, digest: str, size: int, ext: str):
+        self.temp_path = temp_path
+        self.digest = digest
+        self.size = size
+        self.ext = ext
+
+    def discard(self):
+        """Delete the temp file (safe to call more than once)"""
+        if self.temp_path and os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+        self.temp_path = None
+
+def stage_upload(fileobj, upload_dir: str, max_bytes: int) -> StagedUpload:
+    """Stream an upload into a temp file in fixed-size chunks, hashing it on the way
+
+    The file type is sniffed from the first chunk (the client's filename and
+    Content-Type are ignored), and the stream is cut off once it passes max_bytes.
+    """
+    head = fileobj.read(CHUNK_SIZE)
+    ext = sniff_image_type(head)
+    if not ext:
+        raise UnsupportedImageType()
+    hasher = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(dir=upload_dir, prefix=".upload-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            chunk = head
+            while chunk:
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge()
+                hasher.update(chunk)
+                f.write(chunk)
+                chunk = fileobj.read(CHUNK_SIZE)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return StagedUpload(temp_path, hasher.hexdigest(), size, ext)
+
+def hash_file(path: str) -> str:
+    """SHA-256 of a file on disk"""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+# ============== REFERENCE COUNTING ==============
+
+def add_blob_ref(cursor, digest: str, path: str, size: int) -> str:
+    """Count one more post using a blob; returns the blob's stored path"""
+    cursor.execute("""
+        INSERT INTO files (hash, path, size, ref_count) VALUES (?, ?, ?, 1)
+        ON CONFLICT (hash) DO UPDATE SET ref_count = ref_count + 1
+    """, (digest, path, size))
+    cursor.execute("SELECT path FROM files WHERE hash = ?", (digest,))
+    return cursor.fetchone()[0]
+
+def release_blob_ref(cursor, digest: str) -> bool:
+    """Drop one reference to a blob; returns True if that was the last one"""
+    cursor.execute("UPDATE files SET ref_count = ref_count - 1 WHERE hash = ?", (digest,))
+    cursor.execute("DELETE FROM files WHERE hash = ? AND ref_count <= 0", (digest,))
+    return cursor.rowcount > 0
+
+# ============== FILE PLACEMENT ==============
+
+def place_blob(upload_dir: str, staged: StagedUpload, path: str) -> bool:
+    """Move a committed upload to its content address; returns False if that blob already existed"""
+    target = os.path.join(upload_dir, path)
+    with blob_lock:
+        if os.path.exists(target):
+            staged.discard()
+            return False
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(staged.temp_path, target)
+        staged.temp_path = None
+        return True
+
+def remove_blob(conn, upload_dir: str, digest: str, path: str) -> bool:
+    """Delete a blob file after its last reference was committed away, unless it was re-added since"""
+    with blob_lock:
+        if conn.execute("SELECT 1 FROM files WHERE hash = ?", (digest,)).fetchone():
+            return False
+        target = os.path.join(upload_dir, path)
+        if os.path.exists(target):
+            os.remove(target)
+        return True
+
+def link_or_copy(source: str, target: str):
+    """Put a file at target as a hard link to source (or a copy across filesystems) unless it exists"""
+    if os.path.exists(target):
+        return
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(source, target)
+    except OSError:
+        temp = f"{target}.tmp"
+        with open(source, "rb") as src, open(temp, "wb") as dst:
+            while chunk := src.read(CHUNK_SIZE):
+                dst.write(chunk)
+        os.replace(temp, target)
+
+# ============== LEGACY LAYOUT MIGRATION ==============
+
+def rehash_uploads(cursor, upload_dir: str):
+    """Move posts stored as uploads/{timestamp}_{name} to content-addressed blobs
+
+    New blobs are hard links (or copies) of the originals, so the files on disk
+    stay valid if the surrounding transaction rolls back. Returns a function that
+    deletes the originals, to be called once the transaction has committed.
+    """
+    cursor.execute("SELECT id, image_filename FROM posts WHERE file_hash IS NULL")
+    originals = []
+    for post_id, filename in cursor.fetchall():
+        source = os.path.join(upload_dir, filename)
+        if not os.path.isfile(source):
+            continue
+        digest = hash_file(source)
+        path = add_blob_ref(cursor, digest, blob_path(digest, clean_extension(filename)), os.path.getsize(source))
+        link_or_copy(source, os.path.join(upload_dir, path))
+        cursor.execute(
+            "UPDATE posts SET image_filename = ?, file_hash = ? WHERE id = ?",
+            (path, digest, post_id)
+        )
+        originals.append(source)
+
+    def remove_originals():
+        for source in originals:
+            if os.path.exists(source):
+                os.remove(source)
+    return remove_originals
+
+# Names of uploads saved by the legacy layout: uploads/{timestamp}_{name}
+LEGACY_NAME_RE = re.compile(r"^\d+(\.\d+)?_.")
+
+def sweep_legacy_uploads(cursor, upload_dir: str):
+    """Find legacy-layout files no post references (leftovers of deleted posts)
+
+    Returns a function that deletes them and prints each name, to be called
+    once the transaction has committed. A database without posts is left alone:
+    the files in upload_dir can't be its leftovers (e.g. a fresh test or seed
+    database created next to a real uploads directory).
+    """
+    orphans = []
+    cursor.execute("SELECT 1 FROM posts LIMIT 1")
+    if cursor.fetchone() is None:
+        return lambda: None
+    for name in sorted(os.listdir(upload_dir)):
+        if not LEGACY_NAME_RE.match(name) or not os.path.isfile(os.path.join(upload_dir, name)):
+            continue
+        cursor.execute("SELECT 1 FROM posts WHERE image_filename = ?", (name,))
+        if cursor.fetchone() is None:
+            orphans.append(name)
+
+    def remove_orphans():
+        for name in orphans:
+            path = os.path.join(upload_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+                print(f"  removed unreferenced legacy upload: {name}")
+    return remove_orphans
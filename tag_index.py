@@ -0,0 +1,150 @@
+import re
+import threading
+from array import array
+from bisect import bisect_left
+from heapq import merge
+
+# A term is an optional operator (- for NOT, ~ for OR) followed by a bare
+# word or a double-quoted tag name (tags may contain spaces)
+TERM_RE = re.compile(r'([-~]?)(?:"([^"]*)"|(\S+))')
+
+def parse_tag_query(query: str):
+    """Split a tag query like 'sheep wool -nsfw ~meme' into (required, excluded, optional) tag names"""
+    required, excluded, optional = [], [], []
+    for op, quoted, bare in TERM_RE.findall(query or ""):
+        name = (quoted if quoted else bare).strip().lower()
+        if not name:
+            continue
+        if op == "-":
+            excluded.append(name)
+        elif op == "~":
+            optional.append(name)
+        else:
+            required.append(name)
+    return required, excluded, optional
+
+def intersect(candidates, postings) -> list:
+    """Keep the sorted candidates that also appear in a (larger) sorted posting list"""
+    result = []
+    lo, n = 0, len(postings)
+    for post_id in candidates:
+        lo = bisect_left(postings, post_id, lo, n)
+        if lo == n:
+            break
+        if postings[lo] == post_id:
+            result.append(post_id)
+    return result
+
+def contains(postings, post_id: int) -> bool:
+    """Binary-search membership test on a sorted posting list"""
+    i = bisect_left(postings, post_id)
+    return i < len(postings) and postings[i] == post_id
+
+def insert(postings, post_id: int):
+    """Add a post id to a sorted posting list unless it is already there"""
+    i = bisect_left(postings, post_id)
+    if i == len(postings) or postings[i] != post_id:
+        postings.insert(i, post_id)
+
+def discard(postings, post_id: int):
+    """Remove a post id from a sorted posting list if it is there"""
+    i = bisect_left(postings, post_id)
+    if i < len(postings) and postings[i] == post_id:
+        del postings[i]
+
+class TagIndex:
+    """In-memory inverted index mapping tag_id to a sorted array of post ids"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.tag_ids = {}      # tag_name -> tag_id
+        self.postings = {}     # tag_id -> array('q') of post ids, ascending
+        self.all_posts = array("q")
+
+    def build(self, conn):
+        """(Re)build the whole index from the tags, posts and post_tags tables"""
+        tag_ids = {row[1]: row[0] for row in conn.execute("SELECT id, tag_name FROM tags")}
+        postings = {}
+        for tag_id, post_id in conn.execute("SELECT tag_id, post_id FROM post_tags ORDER BY tag_id, post_id"):
+            postings.setdefault(tag_id, array("q")).append(post_id)
+        all_posts = array("q", (row[0] for row in conn.execute("SELECT id FROM posts ORDER BY id")))
+        with self.lock:
+            self.tag_ids = tag_ids
+            self.postings = postings
+            self.all_posts = all_posts
+
+    def add_post(self, post_id: int, tags: dict):
+        """Index a post given its {tag_name: tag_id} mapping; entries already present are left alone"""
+        with self.lock:
+            insert(self.all_posts, post_id)
+            for tag_name, tag_id in tags.items():
+                self.tag_ids[tag_name] = tag_id
+                insert(self.postings.setdefault(tag_id, array("q")), post_id)
+
+    def remove_tags(self, post_id: int, tag_ids):
+        """Drop a post from some tags' posting lists"""
+        with self.lock:
+            for tag_id in tag_ids:
+                postings = self.postings.get(tag_id)
+                if postings is not None:
+                    discard(postings, post_id)
+
+    def remove_post(self, post_id: int, tag_ids):
+        """Drop a deleted post from the universe and from each of its tags' posting lists"""
+        with self.lock:
+            discard(self.all_posts, post_id)
+            self.remove_tags(post_id, tag_ids)
+
+    def lookup(self, tag_name: str):
+        """Posting list for a tag name (empty if the tag is unknown)"""
+        tag_id = self.tag_ids.get(tag_name)
+        return self.postings.get(tag_id, ()) if tag_id is not None else ()
+
+    def tag_id(self, tag_name: str):
+        """Id of a tag name, or None if no post has ever used it"""
+        return self.tag_ids.get(tag_name)
+
+    def match_bound(self, required, optional=()):
+        """Most posts an AND / OR query can match without evaluating it (None if it has no positive terms)
+
+        That is the length of its rarest required posting list, or of the ~
+        terms' lists added up if those are fewer.
+        """
+        with self.lock:
+            bounds = [len(self.lookup(t)) for t in set(required)]
+            if optional:
+                bounds.append(sum(len(self.lookup(t)) for t in set(optional)))
+            return min(bounds) if bounds else None
+
+    def search(self, required, excluded=(), optional=()) -> list:
+        """Evaluate an AND / NOT / OR query and return matching post ids, ascending"""
+        with self.lock:
+            required_lists = sorted((self.lookup(t) for t in set(required)), key=len)
+            if required_lists and not required_lists[0]:
+                return []
+
+            if optional:
+                # OR group: union of the ~ tags, which then behaves like one more AND term
+                union = []
+                for pid in merge(*(self.lookup(t) for t in set(optional))):
+                    if not union or union[-1] != pid:
+                        union.append(pid)
+                if not union:
+                    return []
+                required_lists = sorted([*required_lists, union], key=len)
+
+            # Start from the rarest term and probe the larger lists by binary search
+            if required_lists:
+                result = list(required_lists[0])
+                for postings in required_lists[1:]:
+                    result = intersect(result, postings)
+                    if not result:
+                        return []
+            else:
+                result = list(self.all_posts)
+
+            for tag_name in set(excluded):
+                postings = self.lookup(tag_name)
+                if postings:
+                    result = [pid for pid in result if not contains(postings, pid)]
+            return result
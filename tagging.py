@@ -0,0 +1,37 @@
+# Max bound parameters per statement, well under SQLite's variable limit
+BATCH_SIZE = 500
+
+def split_tags(text: str) -> list:
+    """Parse a comma-separated tag string into unique, lowercased tag names (first occurrence wins)"""
+    names = {}
+    for part in (text or "").split(","):
+        name = part.strip().lower()
+        if name:
+            names[name] = None
+    return list(names)
+
+def resolve_tags(cursor, tag_names) -> dict:
+    """Map tag names to ids, creating missing tags; does not commit
+
+    One multi-row INSERT OR IGNORE plus one SELECT ... IN per batch of names,
+    instead of a SELECT and an INSERT per tag.
+    """
+    names = list(dict.fromkeys(tag_names))
+    tag_ids = {}
+    for i in range(0, len(names), BATCH_SIZE):
+        batch = names[i:i + BATCH_SIZE]
+        placeholders = ",".join("?" * len(batch))
+        cursor.execute(
+            f"INSERT OR IGNORE INTO tags (tag_name) VALUES {','.join(['(?)'] * len(batch))}",
+            batch
+        )
+        cursor.execute(f"SELECT id, tag_name FROM tags WHERE tag_name IN ({placeholders})", batch)
+        tag_ids.update({row[1]: row[0] for row in cursor.fetchall()})
+    return tag_ids
+
+def insert_post_tags(cursor, post_id: int, tag_ids):
+    """Link a post to its tags in one executemany"""
+    cursor.executemany(
+        "INSERT OR IGNORE INTO post_tags (post_id, tag_id) VALUES (?, ?)",
+        [(post_id, tag_id) for tag_id in tag_ids]
+    )
@@ -0,0 +1,38 @@
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+from db import ConnectionPool, ConnectionScope
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = ConnectionPool(str(tmp_path / "test.db"))
+    conn = pool.connect()
+    conn.execute("CREATE TABLE t (x INTEGER)")
+    conn.commit()
+    conn.close()
+    yield pool
+    pool.close_all()
+
+def test_connection_scope_returns_connections_left_by_raising_handlers(pool):
+    app = FastAPI()
+    app.add_middleware(ConnectionScope)
+    acquired = []  # keeps the connections referenced, so __del__ can't be what returns them
+
+    @app.get("/fail/{status}")
+    def fail(status: int):
+        conn = pool.acquire()
+        acquired.append(conn)
+        conn.execute("INSERT INTO t VALUES (1)")  # opens a write transaction
+        if status == 500:
+            raise RuntimeError("unexpected")
+        raise HTTPException(status_code=status)
+
+    client = TestClient(app, raise_server_exceptions=False)
+    assert client.get("/fail/400").status_code == 400
+    assert client.get("/fail/500").status_code == 500
+    assert all(conn._conn is None for conn in acquired)
+    assert pool.idle.qsize() == 1  # the second request reused the first one's connection
+    conn = pool.connect()
+    assert conn.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 0
+    conn.close()
@@ -0,0 +1,85 @@
+import pytest
+
+import index_sync
+from autocomplete import TagAutocomplete
+from db import ConnectionPool
+from index_sync import IndexSync, prune_index_changes
+from init_db import migrate
+from phash import PerceptualIndex
+from tag_index import TagIndex
+from tagging import insert_post_tags, resolve_tags
+
+@pytest.fixture
+def pool(tmp_path):
+    db_name = str(tmp_path / "sheepbooru.db")
+    migrate(db_name)
+    pool = ConnectionPool(db_name)
+    with pool.acquire() as conn:
+        conn.execute("INSERT INTO users (id, username, password_hash, created_at) VALUES (1, 'shepherd', '', datetime('now'))")
+    yield pool
+    pool.close_all()
+
+def worker(pool):
+    """The indexes of one API process, built at its startup"""
+    sync = IndexSync(TagIndex(), TagAutocomplete(), PerceptualIndex())
+    with pool.acquire() as conn:
+        sync.build(conn)
+    return sync
+
+def create_post(pool, tag_names, digest=None, phash=None) -> int:
+    """What another process (a worker, bulk_import.py) writes for a new post"""
+    with pool.acquire() as conn:
+        cursor = conn.cursor()
+        if digest is not None:
+            cursor.execute("INSERT INTO files (hash, path, size, ref_count, phash) VALUES (?, ?, 1, 1, ?)", (digest, digest, phash))
+        cursor.execute(
+            "INSERT INTO posts (image_filename, file_hash, uploader_id, upload_date) VALUES ('x.png', ?, 1, datetime('now'))", (digest,)
+        )
+        post_id = cursor.lastrowid
+        insert_post_tags(cursor, post_id, resolve_tags(cursor, tag_names).values())
+        return post_id
+
+def catch_up(pool, sync) -> bool:
+    with pool.acquire() as conn:
+        return sync.catch_up(conn)
+
+def test_catch_up_applies_changes_made_by_other_processes(pool):
+    sync = worker(pool)
+    post_id = create_post(pool, ["sheep", "wool"], digest="ab" * 32, phash=-5)
+    assert catch_up(pool, sync)
+    assert sync.tag_index.search(["sheep", "wool"]) == [post_id]
+    assert sync.tag_autocomplete.suggest("she") == [{"tag_name": "sheep", "post_count": 1}]
+    assert sync.perceptual_index.search(-5, 0) == [("ab" * 32, 0)]
+
+    with pool.acquire() as conn:
+        conn.execute("DELETE FROM posts WHERE id = ?", (post_id,))
+        conn.execute("DELETE FROM files")
+    assert catch_up(pool, sync)
+    assert sync.tag_index.search(["sheep"]) == []
+    assert list(sync.tag_index.all_posts) == []
+    assert sync.tag_autocomplete.suggest("she") == [{"tag_name": "sheep", "post_count": 0}]
+    assert sync.perceptual_index.search(-5, 0) == []
+
+def test_replaying_changes_is_harmless(pool):
+    sync = worker(pool)
+    post_id = create_post(pool, ["sheep"])
+    assert catch_up(pool, sync)
+    sync.position = 0
+    assert catch_up(pool, sync)
+    assert list(sync.tag_index.all_posts) == [post_id]
+    assert sync.tag_index.search(["sheep"]) == [post_id]
+    assert sync.tag_autocomplete.suggest("sheep") == [{"tag_name": "sheep", "post_count": 1}]
+
+def test_falling_behind_the_pruned_log_rebuilds(pool, monkeypatch):
+    monkeypatch.setattr(index_sync, "INDEX_CHANGES_KEPT", 3)
+    sync = worker(pool)
+    post_ids = [create_post(pool, ["sheep"]) for _ in range(3)]
+    with pool.acquire() as conn:
+        prune_index_changes(conn)
+    assert not catch_up(pool, sync)
+    with pool.acquire() as conn:
+        sync.refresh(conn)
+    assert sync.tag_index.search(["sheep"]) == post_ids
+    create_post(pool, ["wool"])
+    assert catch_up(pool, sync)
+    assert len(sync.tag_index.search(["wool"])) == 1
@@ -0,0 +1,127 @@
+import time
+
+import pytest
+
+from db import ConnectionPool
+from init_db import migrate
+from sessions import SESSION_TTL, TOUCH_INTERVAL, FakeRedis, RedisSessionBackend, SessionBackend, SessionStore, SQLiteSessionBackend
+
+USER = {"id": 1, "username": "shepherd", "is_admin": False}
+
+class Clock:
+    """Stands in for time.time so expiry can be tested without sleeping"""
+
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "time", clock)
+    return clock
+
+@pytest.fixture(params=["sqlite", "redis"])
+def backend(request, tmp_path):
+    if request.param == "redis":
+        yield RedisSessionBackend(FakeRedis())
+        return
+    db_name = str(tmp_path / "sessions.db")
+    migrate(db_name)
+    pool = ConnectionPool(db_name)
+    with pool.acquire() as conn:
+        conn.execute(
+            "INSERT INTO users (id, username, password_hash, created_at) VALUES (?, ?, '', datetime('now'))",
+            (USER["id"], USER["username"])
+        )
+    yield SQLiteSessionBackend(pool.acquire)
+    pool.close_all()
+
+def test_backend_is_abstract():
+    with pytest.raises(TypeError):
+        SessionBackend()
+
+def test_save_load_delete(backend, clock):
+    backend.save("t1", USER, clock.now + 60)
+    user, expires_at = backend.load("t1")
+    assert user == USER
+    assert expires_at == pytest.approx(clock.now + 60, abs=1)
+    assert backend.load("t2") is None
+    backend.delete("t1")
+    assert backend.load("t1") is None
+
+def test_expiry(backend, clock):
+    backend.save("t1", USER, clock.now + 60)
+    clock.now += 61
+    assert backend.load("t1") is None
+
+def test_touch_extends_expiry(backend, clock):
+    backend.save("t1", USER, clock.now + 60)
+    backend.touch("t1", clock.now + 600)
+    clock.now += 300
+    user, expires_at = backend.load("t1")
+    assert user == USER
+    assert expires_at == pytest.approx(clock.now + 300, abs=1)
+
+def test_touch_does_not_recreate_deleted_session(backend, clock):
+    backend.save("t1", USER, clock.now + 60)
+    backend.delete("t1")
+    backend.touch("t1", clock.now + 600)
+    assert backend.load("t1") is None
+
+def test_store_create_get_delete(backend, clock):
+    store = SessionStore(backend)
+    token = store.create(USER)
+    assert store.get(token) == USER
+    assert store.get("unknown") is None
+    store.delete(token)
+    assert store.get(token) is None
+
+def test_store_slides_expiry(backend, clock):
+    store = SessionStore(backend)
+    token = store.create(USER)
+    clock.now += TOUCH_INTERVAL + 1
+    assert store.get(token) == USER
+    _, expires_at = backend.load(token)
+    assert expires_at == pytest.approx(clock.now + SESSION_TTL, abs=1)
+
+def test_store_expires_idle_sessions(backend, clock):
+    store = SessionStore(backend)
+    token = store.create(USER)
+    clock.now += SESSION_TTL + 1
+    assert store.get(token) is None
+
+def test_store_sees_logout_from_another_worker(backend, clock):
+    worker, other_worker = SessionStore(backend), SessionStore(backend)
+    token = worker.create(USER)
+    assert other_worker.get(token) == USER
+    worker.delete(token)
+    clock.now += other_worker.cache_ttl + 1
+    assert other_worker.get(token) is None
+
+def test_redis_touch_racing_logout(clock):
+    class LogoutDuringTouch:
+        """Client whose session key is deleted by another worker right after the first command touch() sends"""
+
+        def __init__(self, client):
+            self.client = client
+            self.logged_out = False
+
+        def __getattr__(self, name):
+            def command(key, *args, **kwargs):
+                result = getattr(self.client, name)(key, *args, **kwargs)
+                if not self.logged_out:
+                    self.client.delete(key)
+                    self.logged_out = True
+                return result
+            return command
+
+    redis = FakeRedis()
+    backend = RedisSessionBackend(redis)
+    backend.save("t1", USER, clock.now + 60)
+    backend.client = LogoutDuringTouch(redis)
+    backend.touch("t1", clock.now + 600)
+    backend.client = redis
+    assert backend.load("t1") is None
@@ -0,0 +1,39 @@
+import os
+import sqlite3
+
+from init_db import create_tables, migrate
+
+def test_migration_moves_referenced_legacy_uploads_and_sweeps_the_rest(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("uploads")
+    for name in ("1762474381.014781_vanillabel.png", "1762469619.55052_vanillabel.png", "1762470705.075576_bweh.png"):
+        with open(os.path.join("uploads", name), "wb") as f:
+            f.write(name.encode())
+    conn = sqlite3.connect("sheepbooru.db")
+    create_tables(conn.cursor())  # a pre-migration database
+    conn.execute("INSERT INTO users (username, password_hash, created_at) VALUES ('shepherd', '', '2025-11-06')")
+    conn.execute(
+        "INSERT INTO posts (image_filename, uploader_id, upload_date) VALUES ('1762474381.014781_vanillabel.png', 1, '2025-11-06')"
+    )
+    conn.commit()
+    conn.close()
+
+    migrate("sheepbooru.db")
+
+    conn = sqlite3.connect("sheepbooru.db")
+    path = conn.execute("SELECT image_filename FROM posts").fetchone()[0]
+    conn.close()
+    with open(os.path.join("uploads", path), "rb") as f:
+        assert f.read() == b"1762474381.014781_vanillabel.png"
+    assert [name for name in os.listdir("uploads") if os.path.isfile(os.path.join("uploads", name))] == []
+    log = capsys.readouterr().out
+    assert "removed unreferenced legacy upload: 1762469619.55052_vanillabel.png" in log
+    assert "removed unreferenced legacy upload: 1762470705.075576_bweh.png" in log
+
+def test_migrating_an_empty_database_keeps_legacy_uploads(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("uploads")
+    with open(os.path.join("uploads", "1762470539.475888_catto.png"), "wb") as f:
+        f.write(b"catto")
+    migrate("sheepbooru.db")
+    assert os.listdir("uploads") == ["1762470539.475888_catto.png"]
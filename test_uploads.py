@@ -0,0 +1,69 @@
+import os
+import struct
+import zlib
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from derivatives import DerivativePipeline
+
+def png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+def blank_png(width: int, height: int) -> bytes:
+    """A black 1-bit PNG, compressed row by row so huge dimensions stay cheap to build"""
+    compressor = zlib.compressobj(9)
+    row = b"\0" * (1 + (width + 7) // 8)  # filter byte + packed pixels
+    data = b"".join(compressor.compress(row) for _ in range(height)) + compressor.flush()
+    header = struct.pack(">IIBBBBB", width, height, 1, 0, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + png_chunk(b"IHDR", header) + png_chunk(b"IDAT", data) + png_chunk(b"IEND", b"")
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """Signed-in client of an app running on an empty database in tmp_path"""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(main.UPLOAD_DIR)
+    with TestClient(main.app) as client:
+        client.post("/api/auth/register", json={"username": "shepherd", "password": "secret1"})
+        client.post("/api/auth/login", json={"username": "shepherd", "password": "secret1"})
+        yield client
+
+def staged_files():
+    return [name for name in os.listdir(main.UPLOAD_DIR) if name.startswith(".upload-")]
+
+def upload(client, image: bytes):
+    return client.post("/api/posts", files={"image": ("image.png", image, "image/png")}, data={"tags": "sheep"})
+
+def test_decompression_bomb_is_accepted_without_a_hash(client):
+    bomb = blank_png(15000, 15000)
+    assert len(bomb) < 100_000
+    response = upload(client, bomb)
+    assert response.status_code == 201
+    assert response.json()["duplicates"] == []
+    assert staged_files() == []
+
+def test_hashing_failure_does_not_fail_the_upload(client, monkeypatch):
+    def broken(fn, *args):
+        raise BrokenProcessPool("worker died")
+    monkeypatch.setattr(main.derivative_pipeline, "run", broken)
+    response = upload(client, blank_png(64, 64))
+    assert response.status_code == 201
+    assert staged_files() == []
+
+def test_pipeline_replaces_a_broken_pool(tmp_path):
+    pipeline = DerivativePipeline(str(tmp_path), workers=1)
+    try:
+        with pytest.raises(BrokenProcessPool):
+            pipeline.run(os._exit, 1)
+        assert pipeline.run(abs, -3) == 3
+    finally:
+        pipeline.shutdown()
+
+def test_oversized_upload_is_rejected_with_cors_headers(client):
+    origin = "http://localhost:5173"
+    body = b"\0" * (main.MAX_UPLOAD_BYTES + 2 * 1024 * 1024)
+    response = client.post("/api/posts", content=body, headers={"Origin": origin, "Content-Type": "application/octet-stream"})
+    assert response.status_code == 413
+    assert response.headers.get("access-control-allow-origin") == origin
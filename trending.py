@@ -0,0 +1,39 @@
+import datetime
+import math
+
+# Favorites older than this don't count towards trending
+TRENDING_WINDOW = datetime.timedelta(days=7)
+
+# A favorite's weight halves every this many seconds
+TRENDING_HALF_LIFE = 24 * 3600
+
+# How often the trending_posts table is rebuilt
+TRENDING_REFRESH_INTERVAL = 300
+
+def trending_scores(cursor, now: datetime.datetime) -> dict:
+    """Sum of exponentially decayed favorites per post over the trending window"""
+    cursor.execute(
+        "SELECT post_id, favorited_at FROM favorites WHERE favorited_at >= ?",
+        ((now - TRENDING_WINDOW).isoformat(),)
+    )
+    decay = math.log(2) / TRENDING_HALF_LIFE
+    scores = {}
+    for post_id, favorited_at in cursor.fetchall():
+        age = (now - datetime.datetime.fromisoformat(favorited_at)).total_seconds()
+        scores[post_id] = scores.get(post_id, 0.0) + math.exp(-decay * max(age, 0.0))
+    return scores
+
+def refresh_trending(conn) -> int:
+    """Rebuild trending_posts from recent favorites in one transaction; returns the number of posts ranked
+
+    Readers keep seeing the previous ranking until the new one commits.
+    """
+    cursor = conn.cursor()
+    scores = trending_scores(cursor, datetime.datetime.now())
+    cursor.execute("DELETE FROM trending_posts")
+    cursor.executemany(
+        "INSERT INTO trending_posts (post_id, score) SELECT ?, ? WHERE EXISTS (SELECT 1 FROM posts WHERE id = ?)",
+        [(post_id, score, post_id) for post_id, score in scores.items()]
+    )
+    conn.commit()
+    return len(scores)